@@ -0,0 +1,200 @@
+import os
+import numpy as np
+import pandas as pd
+
+# Columns of the daily ticket table (st.session_state.daily_tickets)
+TICKET_COLUMNS = ["Id", "Nombre", "Habla a", "Ticket", "Familia", "Latitud (y)", "Longitud (x)",
+                  "Provincia", "Distrito", "Importe de la entrega"]
+
+
+def empty_tickets():
+    return pd.DataFrame(columns=TICKET_COLUMNS)
+
+
+def normalize_keys(values):
+    """Lookup key for addresses/names: stripped, lower case. Missing values become ""."""
+    values = pd.Series(values)
+    return values.astype(str).str.strip().str.lower().where(values.notna(), "")
+
+
+def _key_rows(master):
+    """
+    Normalized key -> master row position, in one vectorized pass. Returns (keys, rows).
+    Same precedence as the old row-by-row address_map: a 'domicilio' key always
+    points to the last row with that domicilio; 'Nombre' and 'Ubicacion' keys only
+    fill keys not taken yet, first row wins (Nombre before Ubicacion within a row).
+    """
+    rows = np.arange(len(master))
+    parts = []
+    if 'domicilio' in master.columns:
+        dom = pd.DataFrame({'key': normalize_keys(master['domicilio']).to_numpy(), 'row': rows})
+        parts.append(dom[dom['key'] != ""].drop_duplicates('key', keep='last'))
+
+    others = []
+    for priority, col in enumerate(['Nombre', 'Ubicacion']):
+        if col in master.columns:
+            others.append(pd.DataFrame({'key': normalize_keys(master[col]).to_numpy(), 'row': rows, 'priority': priority}))
+    if others:
+        others = pd.concat(others, ignore_index=True).sort_values(['row', 'priority'], kind='stable')
+        parts.append(others[others['key'] != ""].drop_duplicates('key', keep='first')[['key', 'row']])
+
+    if not parts:
+        return np.array([], dtype=str), np.array([], dtype=np.int32)
+    # Earlier parts win on conflicts (domicilio over Nombre/Ubicacion)
+    index = pd.concat(parts, ignore_index=True).drop_duplicates('key', keep='first')
+    return index['key'].to_numpy(dtype=str), index['row'].to_numpy(dtype=np.int32)
+
+
+class DistrictSuffixTrie:
+    """
+    Normalized district names stored reversed in a character trie, so every
+    district an address ends with is found in one walk over its last characters
+    (time bounded by the address length, not by the ~1,800 districts).
+    """
+
+    _END = ""  # Child key marking "a district ends here" (never a real character)
+
+    def __init__(self, districts=()):
+        self.root = {}
+        self.size = 0
+        for d in districts:
+            self.add(d)
+
+    def add(self, district):
+        if not district:
+            return
+        node = self.root
+        for ch in reversed(district):
+            node = node.setdefault(ch, {})
+        if self._END not in node:
+            node[self._END] = district
+            self.size += 1
+
+    def __len__(self):
+        return self.size
+
+    def suffixes(self, value):
+        """Districts `value` ends with, longest first (e.g. "san juan de lurigancho" before "san juan")."""
+        found = []
+        node = self.root
+        for ch in reversed(value):
+            node = node.get(ch)
+            if node is None:
+                break
+            if self._END in node:
+                found.append(node[self._END])
+        found.reverse()
+        return found
+
+
+class AddressIndex:
+    """
+    Array-backed lookup from normalized address/name keys to int32 master row
+    positions (replaces the old address_map of row Series). Enrichment fields are
+    then taken column-wise from the master frame with those positions.
+
+    Holds only a hashed key Index, an int32 array and the district names, so it is
+    small, shared read-only between sessions, and saved next to the master snapshot
+    (save/load) instead of being rebuilt interactively.
+    """
+
+    def __init__(self, keys, rows, districts):
+        self.keys = pd.Index(keys)
+        self.rows = np.asarray(rows, dtype=np.int32)
+        self.districts = list(districts)
+        self.district_trie = DistrictSuffixTrie(self.districts)
+
+    @classmethod
+    def build(cls, master):
+        keys, rows = _key_rows(master)
+        districts = []
+        if 'distrito' in master.columns:
+            districts = [str(d).strip().lower() for d in master['distrito'].unique() if pd.notna(d)]
+        return cls(keys, rows, districts)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, key):
+        """Row position for one normalized key, or None."""
+        pos = self.keys.get_indexer([key])[0]
+        return int(self.rows[pos]) if pos >= 0 else None
+
+    def lookup(self, keys):
+        """Row positions (int32) for normalized keys, -1 where missing."""
+        pos = self.keys.get_indexer(pd.Index(keys))
+        return np.where(pos >= 0, self.rows.take(pos), -1).astype(np.int32)
+
+    def save(self, path, token=""):
+        """Writes the index as .npz; `token` identifies the master version it was built from."""
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, keys=self.keys.to_numpy(dtype=str), rows=self.rows,
+                 districts=np.array(self.districts, dtype=str), token=np.array(token))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, token=""):
+        """Index saved by save(), or None if missing, unreadable or built for another version."""
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if str(data['token']) != token:
+                    return None
+                return cls(data['keys'], data['rows'], data['districts'].tolist())
+        except (OSError, ValueError, KeyError):
+            return None
+
+
+def district_stripped(input_val, district_trie):
+    """Candidate keys for the fallback: the address without each trailing district it ends with, longest district first."""
+    # Strip district, trailing spaces and separators left hanging (e.g. "Av. Peru, ")
+    return [input_val[:-len(d)].strip().rstrip(' ,.-') for d in district_trie.suffixes(input_val)]
+
+
+def match_addresses(inputs, address_index):
+    """
+    Master row position for each normalized input (-1 = not found).
+    Exact matches are a single vectorized hash lookup. Distinct unmatched values
+    then get their district-stripped candidates looked up in one more batch; the
+    first candidate found (longest district) wins.
+    """
+    inputs = pd.Series(inputs).fillna("").astype(str)
+    rows = address_index.lookup(inputs)
+    missing = rows < 0
+    if missing.any() and len(address_index.district_trie):
+        unmatched = inputs[missing].unique()
+        candidates = [(val, key) for val in unmatched for key in district_stripped(val, address_index.district_trie)]
+        fallback = {}
+        if candidates:
+            vals, keys = zip(*candidates)
+            for val, row in zip(vals, address_index.lookup(keys)):
+                if row >= 0 and val not in fallback:
+                    fallback[val] = row
+        rows[missing] = inputs[missing].map(fallback).fillna(-1).to_numpy(dtype=np.int32)
+    return rows
+
+
+def build_ticket_frame(master, rows, tickets, familias):
+    """Ticket table for matched master rows, with enrichment taken column-wise."""
+    office = master.take(rows)
+    name_col = 'domicilio' if 'domicilio' in master.columns else 'Nombre'
+    # USER REQUEST: Use Department (DEPARTAMENTO) for main grouping
+    if 'departamento' in master.columns:
+        provincia = office['departamento'].astype(str).str.strip().str.upper()
+    elif 'provincia' in master.columns:
+        provincia = office['provincia'].astype(str).str.strip().str.upper()
+    else:
+        provincia = 'DESCONOCIDA'
+    distrito = office['distrito'].astype(str).str.strip().str.upper() if 'distrito' in master.columns else 'DESCONOCIDO'
+
+    return pd.DataFrame({
+        "Id": office['Id'].to_numpy() if 'Id' in master.columns else None,
+        "Nombre": office[name_col].to_numpy(),
+        "Habla a": office['Habla a'].to_numpy() if 'Habla a' in master.columns else '',
+        "Ticket": np.asarray(tickets),
+        "Familia": np.asarray(familias),
+        "Latitud (y)": office['Latitud (y)'].to_numpy(),
+        "Longitud (x)": office['Longitud (x)'].to_numpy(),
+        "Provincia": provincia.to_numpy() if isinstance(provincia, pd.Series) else provincia,
+        "Distrito": distrito.to_numpy() if isinstance(distrito, pd.Series) else distrito,
+        "Importe de la entrega": 1
+    }, columns=TICKET_COLUMNS)
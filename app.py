@@ -3,11 +3,22 @@ import streamlit as st
 import pandas as pd
 import folium
 from streamlit_folium import st_folium
-from vrp_solver import solve_vrp_data, format_solution, generate_folium_map
+from route_planning import (city_group, build_job, group_solver_kwargs, add_walker_bases,
+                            DEFAULT_SOLVER_WORKERS, STRATEGIES, STRATEGY_GLOBAL, STRATEGY_DISTRICT, STRATEGY_ZONES)
+from solve_queue import SolveQueue, SOLVE_QUEUE_DIR, STATE_LABELS, QUEUED, DONE, FAILED
+from vrp_portfolio import DEFAULT_PORTFOLIO_WORKERS
+from fleet import read_fleet_table, city_fleet, fleet_size
+from walker_bases import read_personnel_bases, locate_bases, city_bases
+from time_windows import DAY_START
+from master_db import MasterStore, open_master_store, source_version, MASTER_FILE_PATH
+from address_index import TICKET_COLUMNS, empty_tickets
+from ticket_import import read_preview, import_tickets
 import io
 import os
 import math
 import json
+import time
+import datetime
 
 st.set_page_config(page_title="Gestión de Rutas - JLMarketing", layout="wide", page_icon="🚛")
 
@@ -126,83 +137,34 @@ st.markdown("""
 if 'stage' not in st.session_state:
     st.session_state.stage = 'input_tickets' # input_tickets, fleet_config, results
 if 'daily_tickets' not in st.session_state:
-    st.session_state.daily_tickets = [] # List of dicts
-if 'master_db' not in st.session_state:
-    st.session_state.master_db = None
+    st.session_state.daily_tickets = empty_tickets() # Ticket table (address_index.TICKET_COLUMNS)
+if 'uploaded_master' not in st.session_state:
+    st.session_state.uploaded_master = None # Session-only MasterStore when the workbook is missing
 if 'optimization_result' not in st.session_state:
     st.session_state.optimization_result = None
+if 'active_run' not in st.session_state:
+    st.session_state.active_run = None # Id of the last run submitted to / opened from the solve queue
+if 'fleet_table' not in st.session_state:
+    st.session_state.fleet_table = None # Optional fleet table (fleet.FLEET_COLUMNS) loaded in the fleet stage
+if 'walker_bases' not in st.session_state:
+    st.session_state.walker_bases = None # Optional walker bases (walker_bases.BASE_COLUMNS) from the personnel list
 
 # --- CONSTANTS ---
-MASTER_FILE_PATH = "Base Arequipa .xlsx"
-DEPARTMENT_DEPOTS = {
-    "AREQUIPA": (-16.398803, -71.536906), # Plaza de Armas Arequipa
-    "LIMA": (-12.046374, -77.042793), # Plaza Mayor Lima
-    "CUSCO": (-13.516806, -71.979043), # Plaza de Armas Cusco
-    "LA LIBERTAD": (-8.111867, -79.028689), # Plaza de Armas Trujillo
-    "LAMBAYEQUE": (-6.771373, -79.840883), # Parque Principal Chiclayo
-    "PIURA": (-5.194493, -80.632821), # Plaza de Armas Piura
-    "JUNIN": (-12.065133, -75.204863), # Plaza Constitución Huancayo
-    "ANCASH": (-9.527376, -77.528414), # Plaza de Armas Huaraz
-    "ICA": (-14.063852, -75.729092), # Plaza de Armas Ica
-    "TACNA": (-18.013998, -70.252378), # Plaza de Armas Tacna
-    "PUNO": (-15.840291, -70.028249), # Plaza de Armas Puno
-    "CAJAMARCA": (-7.163784, -78.500272), # Plaza de Armas Cajamarca
-    "LORETO": (-3.749117, -73.244367), # Plaza de Armas Iquitos
-    "SAN MARTIN": (-6.495000, -76.368300), # Plaza de Armas Tarapoto approx
-    "HUANUCO": (-9.929562, -76.239617), # Plaza de Armas Huánuco
-    "AYACUCHO": (-13.160444, -74.225725) # Plaza Mayor Ayacucho
-}
-
-import shutil
+# MASTER_FILE_PATH (master_db) and DEPARTMENT_DEPOTS (route_planning) are shared with batch_plan.py
 
 # --- HELPER FUNCTIONS ---
-@st.cache_data
-def load_master_db(path):
-    if not os.path.exists(path):
-        return None
-    try:
-        # Try reading directly
-        df = pd.read_excel(path, sheet_name='Hoja2') # Updated to Hoja2 as per user request
-        df.columns = df.columns.str.strip()
-        
-        # COLUMN MAPPING (New DB -> App Schema)
-        # We map: Lat -> Latitud (y), Long -> Longitud (x), gerencia -> Habla a
-        rename_map = {
-            'Lat': 'Latitud (y)',
-            'Long': 'Longitud (x)',
-            'gerencia': 'Habla a'
-        }
-        df.rename(columns=rename_map, inplace=True)
+@st.cache_resource(max_entries=1, show_spinner="Cargando Base Maestra...")
+def load_master_store(path, version):
+    # One MasterStore for all sessions; `version` changes when the workbook does
+    return open_master_store(path)
 
-        # FORCE NUMERIC
-        for col in ['Latitud (y)', 'Longitud (x)']:
-            if col in df.columns:
-                df[col] = pd.to_numeric(df[col], errors='coerce')
-        return df
-    except PermissionError:
-        # File might be open. Copy to temp and read.
-        try:
-            temp_path = "temp_master_copy.xlsm" # Consider renaming to .xlsx if source is xlsx
-            shutil.copy2(path, temp_path)
-            df = pd.read_excel(temp_path, sheet_name='Hoja2')
-            df.columns = df.columns.str.strip()
-            
-            # COLUMN MAPPING (New DB -> App Schema)
-            rename_map = {
-                'Lat': 'Latitud (y)',
-                'Long': 'Longitud (x)',
-                'gerencia': 'Habla a'
-            }
-            df.rename(columns=rename_map, inplace=True)
-
-            # FORCE NUMERIC
-            for col in ['Latitud (y)', 'Longitud (x)']:
-                if col in df.columns:
-                    df[col] = pd.to_numeric(df[col], errors='coerce')
-            return df
-        except Exception as e:
-            st.error(f"El archivo parece estar abierto y no se pudo copiar. Por favor ciérrelo. Error: {e}")
-            return None
+def get_master_store(path):
+    # Compiled snapshot (cache_maestra/) unless the workbook changed; see master_db.py
+    try:
+        return load_master_store(path, source_version(path))
+    except PermissionError as e:
+        st.error(f"El archivo parece estar abierto y no se pudo copiar. Por favor ciérrelo. Error: {e}")
+        return None
     except Exception as e:
         st.error(f"Error al cargar la base de datos maestra: {e}")
         return None
@@ -217,10 +179,37 @@ def style_dataframe(df):
         {'selector': 'th', 'props': [('background-color', '#CCD3D9'), ('color', '#262262'), ('font-weight', 'bold')]}
     ])
 
+@st.cache_resource
+def get_solve_queue():
+    # One queue per server process: bounds concurrent runs across all sessions (see solve_queue.py)
+    return SolveQueue(SOLVE_QUEUE_DIR)
+
+@st.fragment(run_every=2)
+def render_run_progress(solve_queue, run_id):
+    # Polls the run's status file; a full rerun picks up the results once it ends
+    status = solve_queue.status(run_id)
+    if status is None:
+        return
+    if status['state'] in (DONE, FAILED):
+        st.rerun()
+    if status['state'] == QUEUED:
+        ahead = solve_queue.position(run_id)
+        st.info(f"⏳ En cola: {ahead} optimización(es) antes que esta." if ahead else "⏳ En cola: comienza en breve.")
+    st.progress(float(status.get('progress', 0.0)), text=f"{STATE_LABELS.get(status['state'], status['state'])}: {status.get('message', '')}")
+    st.caption(f"{status.get('finished_groups', 0)} de {status.get('groups', 0)} grupos · ID {run_id}")
+
+def open_run(run_id):
+    # The run id also goes in the URL, so a page reload comes back to it
+    st.session_state.active_run = run_id
+    st.query_params["run"] = run_id
+    st.session_state.stage = 'solving'
+
 def reset_app():
     st.session_state.stage = 'input_tickets'
-    st.session_state.daily_tickets = []
+    st.session_state.daily_tickets = empty_tickets()
     st.session_state.optimization_result = None
+    st.session_state.active_run = None
+    st.query_params.clear()
 
 # --- AUTHENTICATION & LOGIN ---
 # Hardcoded Users (Datos extraídos de Personal Mystery Shopper.xlsx - NO requiere archivo en ejecución)
@@ -280,7 +269,8 @@ def load_assignments():
             pass
     return {}
 
-def render_route_details(vehicle_route, vid, v_type, is_admin=False, route_city="AREQUIPA", unique_key_suffix=""):
+def render_route_details(vehicle_route, vid, v_type, is_admin=False, route_city="AREQUIPA", unique_key_suffix="",
+                         assigned_to=None, depot=None):
     icon = "🚙" if v_type == "Auto" else "🚶"
     
     # Use simple ID for display if possible, or handle string inputs gracefully
@@ -302,6 +292,9 @@ def render_route_details(vehicle_route, vid, v_type, is_admin=False, route_city=
 
             # If no users found for city, show message or defaults
             options = [""] + list(filtered_users.keys())
+            # Route planned from a walker's own base: preselect that walker
+            if assigned_to in USERS_DB and assigned_to not in options:
+                options.append(assigned_to)
             
             # Unique Key Construction
             widget_key = f"assign_{vid}{unique_key_suffix}"
@@ -311,7 +304,7 @@ def render_route_details(vehicle_route, vid, v_type, is_admin=False, route_city=
                 options, 
                 format_func=format_func,
                 key=widget_key,
-                index=0
+                index=options.index(assigned_to) if assigned_to in options else 0
             ) 
             if not filtered_users:
                 st.warning(f"No hay encuestadores registrados en {route_city}") 
@@ -319,8 +312,8 @@ def render_route_details(vehicle_route, vid, v_type, is_admin=False, route_city=
         # VISUAL FLOW SEQUENCE & MAPS LINK
         path_steps = []
         
-        # Origin & Dest: Centro de Arequipa
-        depot_coords = "-16.398803,-71.536906"
+        # Origin & Dest: the route's depot (walker's base), else Centro de Arequipa
+        depot_coords = f"{depot[0]},{depot[1]}" if depot else "-16.398803,-71.536906"
         
         # Collect Waypoints
         waypoints_list = []
@@ -453,12 +446,8 @@ with st.sidebar:
 
     st.divider()
     if st.button("🔄 Recargar Base Maestra"):
-        load_master_db.clear()
-        # clear session state caches
-        if 'address_map' in st.session_state:
-            del st.session_state.address_map
-        if 'districts_list' in st.session_state:
-            del st.session_state.districts_list
+        load_master_store.clear()
+        st.session_state.uploaded_master = None
         st.cache_data.clear()
         st.success("Base Maestra recargada. Reiniciando...")
         st.rerun()
@@ -491,6 +480,24 @@ if st.session_state.role != 'admin':
     
     st.stop() # Stop here for non-admins
 
+# --- SOLVE QUEUE ---
+solve_queue = get_solve_queue()
+# A page reload starts a new session but the run keeps going: ?run=<id> reopens it
+run_param = st.query_params.get("run")
+if run_param and st.session_state.active_run is None and solve_queue.status(run_param):
+    open_run(run_param)
+
+with st.sidebar:
+    recent_runs = solve_queue.runs(owner=st.session_state.username, limit=5)
+    if recent_runs:
+        st.divider()
+        st.write("**Optimizaciones recientes**")
+        for run in recent_runs:
+            when = time.strftime("%d/%m %H:%M", time.localtime(run['submitted']))
+            if st.button(f"{when} · {run.get('label', '')} · {STATE_LABELS.get(run['state'], run['state'])}", key=f"run_{run['run_id']}"):
+                open_run(run['run_id'])
+                st.rerun()
+
 # --- APP HEADER (Admin Only) ---
 # --- APP HEADER ---
 # 1. Logo (Left Aligned)
@@ -509,20 +516,22 @@ if st.button("🔄 Reiniciar Aplicación"):
     st.rerun()
 
 # --- LOAD DATABASE (ONCE) ---
-if st.session_state.master_db is None:
-    df_db = load_master_db(MASTER_FILE_PATH)
-    if df_db is not None:
-        st.session_state.master_db = df_db
-        st.success("✅ Base de Datos de Oficinas cargada correctamente.")
+# Shared by all sessions (st.cache_resource); only rebuilt when the workbook changes
+master_store = get_master_store(MASTER_FILE_PATH) or st.session_state.uploaded_master
+if master_store is None:
+    st.error(f"❌ No se encontró el archivo maestro en: {MASTER_FILE_PATH}")
+    uploaded = st.file_uploader("Por favor cargue el archivo 'VRP_Spreadsheet_Solver_v3.8 14.05.xlsm' manualmente:", type=["xlsx", "xlsm"])
+    if uploaded:
+        df_uploaded = pd.read_excel(uploaded, sheet_name='1 ubicaciones')
+        df_uploaded.columns = df_uploaded.columns.str.strip()
+        st.session_state.uploaded_master = MasterStore(df_uploaded)
+        st.rerun()
     else:
-        st.error(f"❌ No se encontró el archivo maestro en: {MASTER_FILE_PATH}")
-        uploaded = st.file_uploader("Por favor cargue el archivo 'VRP_Spreadsheet_Solver_v3.8 14.05.xlsm' manualmente:", type=["xlsx", "xlsm"])
-        if uploaded:
-            st.session_state.master_db = pd.read_excel(uploaded, sheet_name='1 ubicaciones')
-            st.session_state.master_db.columns = st.session_state.master_db.columns.str.strip()
-            st.rerun()
-        else:
-            st.stop()
+        st.stop()
+elif not st.session_state.get('master_db_announced'):
+    st.session_state.master_db_announced = True
+    st.success("✅ Base de Datos de Oficinas cargada correctamente.")
+master_db = master_store.df # Read-only, never modify in place
 
 # --- STAGE 1: INGRESO DE TICKETS ---
 if st.session_state.stage == 'input_tickets':
@@ -537,8 +546,8 @@ if st.session_state.stage == 'input_tickets':
             st.subheader("Nuevo Ticket Individual")
 
             # --- CLIENT FILTER ---
-            if 'Habla a' in st.session_state.master_db.columns:
-                clients = sorted(st.session_state.master_db['Habla a'].astype(str).unique().tolist())
+            if 'Habla a' in master_db.columns:
+                clients = master_store.clients
                 selected_client = st.selectbox("Filtrar por Cliente", options=["Todos"] + clients)
             else:
                 options_clients = ["Todos"]
@@ -546,10 +555,10 @@ if st.session_state.stage == 'input_tickets':
 
             # Filter Options
             if selected_client != "Todos":
-                filtered_db = st.session_state.master_db[st.session_state.master_db['Habla a'].astype(str) == selected_client]
+                filtered_db = master_db[master_db['Habla a'].astype(str) == selected_client]
                 office_options = filtered_db['domicilio'].astype(str).unique().tolist() if 'domicilio' in filtered_db.columns else filtered_db['Nombre'].unique().tolist()
             else:
-                office_options = st.session_state.master_db['domicilio'].astype(str).unique().tolist() if 'domicilio' in st.session_state.master_db.columns else st.session_state.master_db['Nombre'].unique().tolist()
+                office_options = master_db['domicilio'].astype(str).unique().tolist() if 'domicilio' in master_db.columns else master_db['Nombre'].unique().tolist()
 
             # --- MANUAL ENTRY FORM ---
             with st.form("ticket_form", clear_on_submit=True):
@@ -566,8 +575,8 @@ if st.session_state.stage == 'input_tickets':
                     else:
                         # Find coords for selected office
                         # If domicilio is used, match on 'domicilio', otherwise 'Nombre'
-                        col_to_match = 'domicilio' if 'domicilio' in st.session_state.master_db.columns else 'Nombre'
-                        office_data = st.session_state.master_db[st.session_state.master_db[col_to_match].astype(str) == str(selected_office)].iloc[0]
+                        col_to_match = 'domicilio' if 'domicilio' in master_db.columns else 'Nombre'
+                        office_data = master_db[master_db[col_to_match].astype(str) == str(selected_office)].iloc[0]
                         
                         # --- DATA ENRICHMENT ---
                         # Extract City (Provincia/Departamento) and District (Distrito)
@@ -575,7 +584,8 @@ if st.session_state.stage == 'input_tickets':
                         provincia = str(office_data.get('departamento', office_data.get('provincia', 'Desconocida'))).strip().upper()
                         distrito = str(office_data.get('distrito', 'Desconocido')).strip().upper()
                         
-                        st.session_state.daily_tickets.append({
+                        new_ticket = pd.DataFrame([{
+                            "Id": office_data.get('Id'), # Master DB office ID (distance cache key)
                             "Nombre": selected_office,
                             "Habla a": office_data.get('Habla a', ''),
                             "Ticket": ticket_id,
@@ -585,7 +595,8 @@ if st.session_state.stage == 'input_tickets':
                             "Provincia": provincia, # Used as City
                             "Distrito": distrito,
                             "Importe de la entrega": 1 
-                        })
+                        }], columns=TICKET_COLUMNS)
+                        st.session_state.daily_tickets = pd.concat([st.session_state.daily_tickets, new_ticket], ignore_index=True)
                         st.toast(f"Ticket {ticket_id} agregado!", icon="👍")
         
         # --- TAB IMPORT ---
@@ -595,167 +606,63 @@ if st.session_state.stage == 'input_tickets':
             
             if uploaded_tickets:
                 try:
-                    if uploaded_tickets.name.endswith('.csv'):
-                        df_upload = pd.read_csv(uploaded_tickets)
-                    else:
-                        df_upload = pd.read_excel(uploaded_tickets)
-                    
-                    st.write("Vista Previa:", df_upload.head(3))
+                    # Only the first rows are parsed here; the file is streamed on "Procesar"
+                    st.write("Vista Previa:", read_preview(uploaded_tickets, uploaded_tickets.name))
                     
                     if st.button("Procesar Archivo"):
-                        # Column Mapping Logic
-                        # We need 'Domicilio' (to match Master DB), 'Ticket', 'Familia'
-                        cols = df_upload.columns.str.lower()
+                        # --- OPTIMIZATION: STREAMED, VECTORIZED LOOKUP ---
+                        # Chunks of IMPORT_CHUNK_ROWS rows are parsed and matched against the
+                        # shared MasterStore (AddressIndex + TrigramIndex), then released
+                        progress_bar = st.progress(0.0, text="Procesando direcciones...")
+                        status_text = st.empty()
                         
-                        # Guess column names - Prioritize Domicilio/Direccion
-                        col_oficina = next((c for c in df_upload.columns if 'domicilio' in c.lower() or 'direccion' in c.lower()), None)
-                        if not col_oficina:
-                             col_oficina = next((c for c in df_upload.columns if 'oficina' in c.lower() or 'nombre' in c.lower()), None)
-                             
-                        col_ticket = next((c for c in df_upload.columns if 'ticket' in c.lower() or 'numero' in c.lower()), None)
-                        col_familia = next((c for c in df_upload.columns if 'familia' in c.lower()), None)
+                        def on_progress(progress, added, unmatched):
+                            progress_bar.progress(progress, text=f"Procesando direcciones... {int(progress * 100)}%")
+                            status_text.caption(f"{added} tickets agregados, {unmatched} sin coincidencia hasta ahora.")
                         
-                        if not col_oficina:
-                            st.error("No se encontró columna para 'Domicilio', 'Direccion' o 'Oficina'.")
+                        try:
+                            new_tickets, df_unmatched, fuzzy_accepted = import_tickets(
+                                uploaded_tickets, uploaded_tickets.name, master_store, on_progress=on_progress)
+                        except ValueError as e:
+                            st.error(str(e))
                         else:
-                            success_count = 0
-                            fail_count = 0
-                            unmatched_rows = [] # To store failed inputs
-                            
-                            # --- OPTIMIZATION: BUILD LOOKUP DICTIONARY ---
-                            # Pre-compute normalized map for O(1) access
-                            if 'address_map' not in st.session_state:
-                                master = st.session_state.master_db
-                                addr_map = {}
-                                
-                                # Helper to normalize
-                                def normalize_key(s):
-                                    if pd.isna(s): return ""
-                                    return str(s).strip().lower()
-                                
-                                for idx, row in master.iterrows():
-                                    # Map Domicilio
-                                    if 'domicilio' in master.columns:
-                                        k = normalize_key(row['domicilio'])
-                                        if k: addr_map[k] = row
-                                    
-                                    # Map Nombre
-                                    k_nom = normalize_key(row['Nombre'])
-                                    if k_nom: 
-                                        if k_nom not in addr_map: # Prefer Domicilio if conflict? Or just add
-                                            addr_map[k_nom] = row
-                                            
-                                    # Map Ubicación (just in case)
-                                    if 'Ubicacion' in master.columns:
-                                        k_ubi = normalize_key(row['Ubicacion'])
-                                        if k_ubi and k_ubi not in addr_map:
-                                             addr_map[k_ubi] = row
-                                             
-                                             
-                                st.session_state.address_map = addr_map
-                                
-                                # Pre-compute normalized districts for suffix stripping
-                                if 'districts_list' not in st.session_state:
-                                    if 'distrito' in master.columns:
-                                        # Sort by length desc to match longest first (e.g. "San Juan de Lurigancho" before "San Juan")
-                                        dists = sorted([str(d).strip().lower() for d in master['distrito'].unique() if pd.notna(d)], key=len, reverse=True)
-                                        st.session_state.districts_list = dists
-                                    else:
-                                        st.session_state.districts_list = []
-                            
-                            address_map = st.session_state.address_map
-                            districts_list = st.session_state.districts_list
-                            
-                            # Process Uploaded Rows
-                            # Show progress bar for large files
-                            progress_text = "Procesando direcciones..."
-                            my_bar = st.progress(0, text=progress_text)
-                            total_rows = len(df_upload)
-                            
-                            processed_rows = 0
-                            
-                            for _, row in df_upload.iterrows():
-                                processed_rows += 1
-                                if processed_rows % 100 == 0:
-                                    my_bar.progress(min(processed_rows / total_rows, 1.0), text=f"{progress_text} ({processed_rows}/{total_rows})")
-                                
-                                input_val = str(row[col_oficina]).strip().lower()
-                                
-                                # Direct Lookup O(1)
-                                office_data = address_map.get(input_val)
-                                
-                                # Fallback: District Suffix Stripping
-                                if office_data is None and districts_list:
-                                    # Check if input ends with any known district
-                                    for d in districts_list:
-                                        if input_val.endswith(d):
-                                            # Strip district and trailing spaces
-                                            stripped_val = input_val[:-len(d)].strip()
-                                            # Remove common separators if left hanging (e.g. "Av. Peru, ")
-                                            stripped_val = stripped_val.rstrip(' ,.-')
-                                            
-                                            # Try finding the stripped value
-                                            office_data = address_map.get(stripped_val)
-                                            if office_data is not None:
-                                                break # Found match!
-                                                
-                                match_found = office_data is not None
-                                
-                                if match_found:
-                                    # Use matching name (preferred Domicilio if column exists)
-                                    final_name = office_data['domicilio'] if 'domicilio' in office_data else office_data['Nombre']
-                                    
-                                    # --- DATA ENRICHMENT ---
-                                    # USER REQUEST: Use Department (DEPARTAMENTO) for main grouping
-                                    provincia = str(office_data.get('departamento', office_data.get('provincia', 'Desconocida'))).strip().upper()
-                                    distrito = str(office_data.get('distrito', 'Desconocido')).strip().upper()
-                                    
-                                    st.session_state.daily_tickets.append({
-                                        "Nombre": final_name,
-                                        "Habla a": office_data.get('Habla a', ''),
-                                        "Ticket": row[col_ticket] if col_ticket else "N/A",
-                                        "Familia": row[col_familia] if col_familia else "General",
-                                        "Latitud (y)": office_data['Latitud (y)'],
-                                        "Longitud (x)": office_data['Longitud (x)'],
-                                        "Provincia": provincia,
-                                        "Distrito": distrito,
-                                        "Importe de la entrega": 1
-                                    })
-                                    success_count += 1
-                                else:
-                                    fail_count += 1
-                                    # Record failure
-                                    row_copy = row.copy()
-                                    row_copy['Razón'] = 'No encontrado en Base Maestra'
-                                    row_copy['Input Normalizado'] = input_val
-                                    unmatched_rows.append(row_copy)
-                            
-                            my_bar.empty()
+                            st.session_state.daily_tickets = pd.concat([st.session_state.daily_tickets, new_tickets], ignore_index=True)
+                            success_count = len(new_tickets)
+                            progress_bar.progress(1.0, text="Archivo procesado.")
+                            fail_count = len(df_unmatched)
                                     
                             st.success(f"Procesado: {success_count} tickets agregados.")
+                            if len(fuzzy_accepted) > 0:
+                                st.info(f"🔎 {len(fuzzy_accepted)} direcciones resueltas por similitud. Revíselas:")
+                                st.dataframe(fuzzy_accepted, use_container_width=True, hide_index=True)
                             if fail_count > 0:
                                 st.warning(f"⚠️ {fail_count} direcciones no encontradas. Descargue el reporte para corregirlas.")
                                 
-                                # Convert unmatched to DF and offer download
-                                if unmatched_rows:
-                                    df_unmatched = pd.DataFrame(unmatched_rows)
-                                    csv_unmatched = df_unmatched.to_csv(index=False).encode('utf-8')
-                                    st.download_button(
-                                        label="📥 Descargar Direcciones No Encontradas (CSV)",
-                                        data=csv_unmatched,
-                                        file_name="direcciones_no_encontradas.csv",
-                                        mime="text/csv"
-                                    )
+                                # Offer unmatched rows as download
+                                csv_unmatched = df_unmatched.to_csv(index=False).encode('utf-8')
+                                st.download_button(
+                                    label="📥 Descargar Direcciones No Encontradas (CSV)",
+                                    data=csv_unmatched,
+                                    file_name="direcciones_no_encontradas.csv",
+                                    mime="text/csv"
+                                )
                                 
                 except Exception as e:
                     st.error(f"Error procesando: {e}")
 
     with col_table:
         st.subheader("📋 Lista de Pendientes")
-        if st.session_state.daily_tickets:
-            df_display = pd.DataFrame(st.session_state.daily_tickets)
+        if not st.session_state.daily_tickets.empty:
+            df_display = st.session_state.daily_tickets
             st.dataframe(style_dataframe(df_display[['Nombre', 'Ticket', 'Familia']]), use_container_width=True)
             
+            # Cancelled tickets (e.g. mid-day changes after routes were computed)
+            to_remove = st.multiselect("Quitar tickets", options=list(df_display.index),
+                                       format_func=lambda i: f"{df_display.at[i, 'Ticket']} - {df_display.at[i, 'Nombre']}")
+            if to_remove and st.button("🗑️ Quitar seleccionados"):
+                st.session_state.daily_tickets = df_display.drop(index=to_remove).reset_index(drop=True)
+                st.rerun()
+            
             if st.button("✅ Confirmar y Configurar Flota", type="primary"):
                 st.session_state.stage = 'fleet_config'
                 st.rerun()
@@ -774,15 +681,58 @@ elif st.session_state.stage == 'fleet_config':
         
         # USER REQUEST: ONLY WALKERS, PER CITY
         # 1. Detect Cities from Tickets
-        df_tickets = pd.DataFrame(st.session_state.daily_tickets)
+        df_tickets = st.session_state.daily_tickets.copy()
         if 'Provincia' in df_tickets.columns:
             unique_cities = sorted(df_tickets['Provincia'].unique())
         else:
             unique_cities = ["Desconocida"]
             
         walkers_per_city = {}
+        fleets_per_city = {}
+        bases_per_city = {}
         total_walkers = 0
         
+        # Optional fleet table (vehicles sheet): class, capacity, speed, shift and depots per vehicle
+        with st.expander("🚚 Flota detallada (opcional)", expanded=st.session_state.fleet_table is not None):
+            st.caption("Columnas: Tipo (Auto, Moto, Caminante), Numero de vehiculos, Capacidad, Velocidad (km/h), "
+                       "Jornada (h), Inicio, Fin y opcionalmente Departamento. Las celdas vacías usan los valores generales de abajo.")
+            fleet_file = st.file_uploader("Cargar tabla de flota", type=["xlsx", "xls", "csv"], key="fleet_upload")
+            # Read once per uploaded file, so "Quitar" is not undone by the next rerun
+            if fleet_file is not None and st.session_state.get('fleet_file_id') != fleet_file.file_id:
+                st.session_state.fleet_file_id = fleet_file.file_id
+                try:
+                    st.session_state.fleet_table = read_fleet_table(fleet_file, fleet_file.name)
+                except (ValueError, OSError) as e:
+                    st.session_state.fleet_table = None
+                    st.error(f"Error leyendo la flota: {e}")
+            if st.session_state.fleet_table is not None:
+                st.dataframe(st.session_state.fleet_table, use_container_width=True)
+                if st.button("🗑️ Quitar tabla de flota"):
+                    st.session_state.fleet_table = None
+                    st.rerun()
+
+        # Optional personnel list: each walker starts and ends at home / assigned base instead of the plaza
+        with st.expander("🏠 Bases de caminantes (opcional)", expanded=st.session_state.walker_bases is not None):
+            st.caption("Lista de personal con CORREO, ENCUESTADOR, CIUDAD y LATITUD / LONGITUD de su casa o base "
+                       "(o su DISTRITO, ubicado en el centro de sus oficinas).")
+            bases_file = st.file_uploader("Cargar lista de personal", type=["xlsx", "xls", "csv"], key="bases_upload")
+            if bases_file is not None and st.session_state.get('bases_file_id') != bases_file.file_id:
+                st.session_state.bases_file_id = bases_file.file_id
+                try:
+                    st.session_state.walker_bases = locate_bases(read_personnel_bases(bases_file, bases_file.name), master_db)
+                except (ValueError, OSError) as e:
+                    st.session_state.walker_bases = None
+                    st.error(f"Error leyendo la lista de personal: {e}")
+            if st.session_state.walker_bases is not None:
+                bases_df = st.session_state.walker_bases
+                unlocated = bases_df['Latitud (y)'].isna().sum()
+                st.dataframe(bases_df, use_container_width=True)
+                if unlocated:
+                    st.warning(f"{unlocated} caminantes sin ubicación: no se usarán.")
+                if st.button("🗑️ Quitar lista de personal"):
+                    st.session_state.walker_bases = None
+                    st.rerun()
+        
         st.write("**Configuración por Departamento:**")
         
         strategies_per_city = {}
@@ -791,14 +741,33 @@ elif st.session_state.stage == 'fleet_config':
             with st.container():
                 st.subheader(f"📍 {city}")
                 c1, c2 = st.columns(2)
-                # Walker Count
-                count = c1.number_input(f"Caminantes en {city}", min_value=0, value=5, key=f"walkers_{city}")
+                # Walker Count (or the department's walkers of the personnel list / rows of the fleet table)
+                c_fleet = city_fleet(st.session_state.fleet_table, city)
+                c_bases = city_bases(st.session_state.walker_bases, city)
+                if c_bases is not None:
+                    # Walkers of the personnel list, each from their own base
+                    available = c1.multiselect(f"Caminantes disponibles hoy en {city}", c_bases.index.tolist(),
+                                               default=c_bases.index.tolist(), key=f"bases_{city}",
+                                               format_func=lambda i, b=c_bases: b.at[i, 'Encuestador'])
+                    c_bases = c_bases.loc[available].reset_index(drop=True)
+                    others = c_fleet[c_fleet['Tipo'] != 'Walker'] if c_fleet is not None else None
+                    count = len(c_bases) + fleet_size(others)
+                    if others is not None and not others.empty:
+                        c1.caption(f"Más {fleet_size(others)} vehículos de la tabla de flota")
+                elif c_fleet is not None:
+                    count = fleet_size(c_fleet)
+                    c1.metric(f"Recursos en {city}", count, help="Según la tabla de flota")
+                    c1.caption(", ".join(f"{v_type}: {n}" for v_type, n in c_fleet.groupby('Tipo')['Numero de vehiculos'].sum().items()))
+                else:
+                    count = c1.number_input(f"Caminantes en {city}", min_value=0, value=5, key=f"walkers_{city}")
                 walkers_per_city[city] = count
+                fleets_per_city[city] = c_fleet
+                bases_per_city[city] = c_bases
                 
                 # Strategy Selection Per City
                 strat = c2.radio(
                     f"Estrategia para {city}",
-                    ["Global (Por Ciudad)", "Por Distrito"],
+                    STRATEGIES,
                     key=f"strat_{city}",
                     horizontal=True
                 )
@@ -806,7 +775,7 @@ elif st.session_state.stage == 'fleet_config':
 
                 # District Selection if Strategy is "Por Distrito" (Moved here for better UX)
                 # District Selection if Strategy is "Por Distrito" (Moved here for better UX)
-                if strat == "Por Distrito":
+                if strat == STRATEGY_DISTRICT:
                      # Get districts for this city
                      c_df = df_tickets[df_tickets['Provincia'] == city]
                      all_districts = sorted(c_df['Distrito'].unique())
@@ -818,7 +787,8 @@ elif st.session_state.stage == 'fleet_config':
                          key=f"sel_dist_{city}_cfg"
                      )
                      
-                elif strat == "Global (Por Ciudad)":
+                elif strat in (STRATEGY_GLOBAL, STRATEGY_ZONES):
+                     # Zones use the same district selection as Global
                      c_df = df_tickets[df_tickets['Provincia'] == city]
                      all_districts = sorted(c_df['Distrito'].unique())
                      
@@ -867,12 +837,28 @@ elif st.session_state.stage == 'fleet_config':
         # User requested NO TIME RESTRICTION -> Set default to very high (100h)
         # User requested NO TIME RESTRICTION -> Set default to very high (100h)
         max_work_hours = col_adv_2.number_input("Jornada Maxima (horas)", min_value=1, value=100, help="Deje un valor alto (ej. 100) para no restringir por tiempo.")
+        # Reference of the offices' opening hours (columns Hora apertura / Hora cierre of the tickets)
+        day_start = st.time_input("Hora de salida", value=datetime.time.fromisoformat(DAY_START),
+                                  help="Inicio de la jornada; los horarios de atención de las oficinas se miden desde esta hora.")
 
         # Distance Constraint
         max_dist_km = st.number_input("Distancia Máx. por Caminante (km)", min_value=1, value=20, help="Límite de recorrido total por caminante.")
 
         tf_factor = 1.0
         
+        # Each city/district group is solved in its own process
+        solver_workers = st.number_input("Procesos en paralelo", min_value=1, value=DEFAULT_SOLVER_WORKERS, help="Grupos (ciudad/distrito) resueltos a la vez.")
+        
+        # Portfolio: several search strategies race on each group and the best one is kept
+        use_portfolio = st.checkbox("🏁 Búsqueda en portafolio (multinúcleo)", value=False, disabled=DEFAULT_PORTFOLIO_WORKERS < 2,
+                                    help="Prueba varias estrategias del optimizador a la vez en cada grupo y se queda con la mejor. Requiere varios núcleos; los grupos se resuelven de a uno.")
+        
+        # Mid-day changes: start from the routes already computed instead of from scratch
+        incremental = False
+        if st.session_state.optimization_result:
+            incremental = st.checkbox("⚡ Re-optimizar desde las rutas anteriores", value=True,
+                                      help="Conserva las asignaciones actuales, inserta los tickets nuevos y quita los cancelados. Mucho más rápido que recalcular todo.")
+        
         col_act_1, col_act_2 = st.columns(2)
         if col_act_1.button("🔙 Volver"):
             st.session_state.stage = 'input_tickets'
@@ -882,187 +868,62 @@ elif st.session_state.stage == 'fleet_config':
             # Prepare Data & Run Solver Logic
             
             # Common params
-            # User wants efficient routes, give solver more time (60s)
+            # Upper bound per group: small districts get a few seconds (adaptive budget)
+            # and every search stops once its objective stops improving
             solver_time_limit = 60
             forced_max_hours = max_work_hours # Respect the input which we increased default for
             
-            all_solutions = []
-            
-            with st.spinner("Calculando rutas multi-ciudad (Optimizando)..."):
+            with st.spinner("Preparando grupos..."):
                 try:
-                    # Progress Bar Setup
-                    progress_bar = st.progress(0)
-                    status_text = st.empty()
-                    
-                    # Estimate total steps for progress
-                    # Global: 1 step per city
-                    # District: 1 step per district per city
-                    total_steps = 0
-                    # Estimate total steps for progress
-                    total_steps = 0
-                    for c in unique_cities:
-                        strat = strategies_per_city.get(c, "Global (Por Ciudad)")
-                        if strat == "Global (Por Ciudad)":
-                            total_steps += 1
-                        else:
-                            # Count districts
-                            c_df = df_tickets[df_tickets['Provincia'] == c]
-                            total_steps += len(c_df['Distrito'].unique())
-                    
-                    if total_steps == 0: total_steps = 1
-                    current_step = 0
-                    
-                    def update_main_progress(step_idx, stage_desc=""):
-                        val = min(1.0, step_idx / total_steps)
-                        progress_bar.progress(val)
-                        status_text.text(f"Procesando ({int(val*100)}%): {stage_desc}")
-
-                    # ITERATE CITIES
-                    # Use enumerate for manual step tracking if needed, 
-                    # but we track current_step manually to handle nested loops better
-                    
-                    for city_idx, city in enumerate(unique_cities):
+                    # 1. BUILD ONE JOB PER GROUP (City or City-District)
+                    jobs = []
+                    previous_results = {}
+                    if incremental:
+                        previous_results = {(res.city, res.group): res for res in st.session_state.optimization_result}
+                    for city in unique_cities:
                         # Filter tickets for this city
                         city_tickets = df_tickets[df_tickets['Provincia'] == city].copy()
                         if city_tickets.empty: continue
                         
                         city_walkers = walkers_per_city.get(city, 1)
-                        current_city_strategy = strategies_per_city.get(city, "Global (Por Ciudad)")
+                        current_city_strategy = strategies_per_city.get(city, STRATEGY_GLOBAL)
                         
                         if city_walkers == 0:
                             st.warning(f"⚠️ {city} omitido (0 caminantes asignados).")
-                            # Try to advance progress bar logically
-                            steps_for_this_city = 1
-                            if current_city_strategy == "Por Distrito":
-                                c_df_temp = df_tickets[df_tickets['Provincia'] == city]
-                                steps_for_this_city = len(c_df_temp['Distrito'].unique())
-                            current_step += steps_for_this_city
-                            update_main_progress(current_step, f"Omitido {city}")
                             continue
                         
                         # LOGIC BRANCH: STRATEGY
-                        if current_city_strategy == "Global (Por Ciudad)":
-                            # --- CASE A: GLOBAL (Multi-District) ---
-                            # Retrieve selection (List)
-                            selected_districts = st.session_state.get(f"sel_dist_{city}_cfg", [])
-                            if not selected_districts: 
-                                # Default to all if missing
-                                c_df = df_tickets[df_tickets['Provincia'] == city]
-                                selected_districts = sorted(c_df['Distrito'].unique())
-                            
-                            # Filter tickets
-                            city_tickets = city_tickets[city_tickets['Distrito'].isin(selected_districts)]
-                            
-                            if city_tickets.empty:
-                                st.warning(f"No hay tickets en los distritos seleccionados para {city} (Global).")
-                                continue
-                                
-                            # Group by Location
-                            df_grouped = city_tickets.groupby(['Nombre', 'Latitud (y)', 'Longitud (x)', 'Habla a', 'Provincia', 'Distrito']).agg({
-                                'Importe de la entrega': 'sum',
-                                'Ticket': lambda x: ', '.join(x.astype(str)), 
-                                'Familia': lambda x: ', '.join(x.unique())
-                            }).reset_index()
-
-                            # Depot Location (Department Capital)
-                            depot_lat, depot_lon = DEPARTMENT_DEPOTS.get(city, (-16.398803, -71.536906))
-                            if city not in DEPARTMENT_DEPOTS and city != "Desconocida":
-                                if not city_tickets.empty:
-                                    depot_lat = city_tickets['Latitud (y)'].mean()
-                                    depot_lon = city_tickets['Longitud (x)'].mean()
-
-                            depot_row = pd.DataFrame([{
-                                'Nombre': f'DEPOT {city} (Plaza de Armas)', 
-                                'Latitud (y)': depot_lat, 
-                                'Longitud (x)': depot_lon, 
-                                'Habla a': 'JLMarketing',
-                                'Importe de la entrega': 0,
-                                'Ticket': 'Inicio',
-                                'Familia': 'Base',
-                                'Provincia': city,
-                                'Distrito': 'BASE'
-                            }])
-
-                            df_final = pd.concat([depot_row, df_grouped], ignore_index=True)
-                            
-                            def sub_callback(msg):
-                                status_text.text(f"[{city}] {msg}")
-                                
-                            sol, rout, man, dat, df_cl = solve_vrp_data(
-                                df_final, 0, city_walkers, max_capacity, traffic_factor=tf_factor,
-                                service_time_per_ticket_mins=service_time, max_work_hours=forced_max_hours,
-                                max_seconds=solver_time_limit,
-                                max_distance_km=max_dist_km,
-                                status_callback=sub_callback
-                            )
-                            
-                            current_step += 1
-                            update_main_progress(current_step, f"Finalizado {city}")
-                            
-                            if sol:
-                                all_solutions.append((sol, rout, man, dat, df_cl, city, "Global"))
-
-                        elif current_city_strategy == "Por Distrito":
-                            # --- CASE B: PER DISTRICT (Single) ---
-                            # Retrieve selection (Single String)
-                            selected_district = st.session_state.get(f"sel_dist_{city}_cfg", None)
-                            
-                            if not selected_district:
-                                st.warning(f"No se seleccionó ningún distrito para {city}.")
-                                continue
-                                
-                            dist_tickets = city_tickets[city_tickets['Distrito'] == selected_district].copy()
-                            if dist_tickets.empty:
-                                st.warning(f"No hay tickets en {selected_district}.")
-                                continue
-                                
-                            # Use ALL walkers for this Single District
-                            assigned_walkers = city_walkers
-                            
-                            df_grouped = dist_tickets.groupby(['Nombre', 'Latitud (y)', 'Longitud (x)', 'Habla a', 'Provincia', 'Distrito']).agg({
-                                'Importe de la entrega': 'sum',
-                                'Ticket': lambda x: ', '.join(x.astype(str)), 
-                                'Familia': lambda x: ', '.join(x.unique())
-                            }).reset_index()
-                            
-                            # Depot: Mean of district (Start/End in district)
-                            depot_lat = dist_tickets['Latitud (y)'].mean()
-                            depot_lon = dist_tickets['Longitud (x)'].mean()
-
-                            depot_row = pd.DataFrame([{
-                                'Nombre': f'DEPOT {city}-{selected_district} (Calculado: Promedio de Tickets)', 
-                                'Latitud (y)': depot_lat, 
-                                'Longitud (x)': depot_lon, 
-                                'Habla a': 'JLMarketing',
-                                'Importe de la entrega': 0,
-                                'Ticket': 'Inicio',
-                                'Familia': 'Base',
-                                'Provincia': city,
-                                'Distrito': selected_district
-                            }])
-                            
-                            df_final = pd.concat([depot_row, df_grouped], ignore_index=True)
-                            
-                            def sub_callback(msg):
-                                status_text.text(f"[{city}-{selected_district}] {msg}")
-                                
-                            sol, rout, man, dat, df_cl = solve_vrp_data(
-                                df_final, 0, assigned_walkers, max_capacity, traffic_factor=tf_factor,
-                                service_time_per_ticket_mins=service_time, max_work_hours=forced_max_hours,
-                                max_seconds=solver_time_limit,
-                                max_distance_km=max_dist_km,
-                                status_callback=sub_callback
-                            )
-                            
-                            current_step += 1
-                            update_main_progress(current_step, f"Finalizado {selected_district}")
-                            
-                            if sol:
-                                all_solutions.append((sol, rout, man, dat, df_cl, city, selected_district))
-
-                    if all_solutions:
-                        st.session_state.optimization_result = all_solutions # Store List
-                        st.session_state.stage = 'results'
+                        # Global / Zonas: list of districts; Por Distrito: single district (all walkers on it)
+                        # "Por Zonas" solves the same group split into geographic clusters
+                        selected_districts = st.session_state.get(f"sel_dist_{city}_cfg", None)
+                        try:
+                            group_label, use_zones, df_final = city_group(city_tickets, city, current_city_strategy, selected_districts)
+                        except ValueError as e:
+                            st.warning(str(e))
+                            continue
+                        
+                        group_fleet = fleets_per_city.get(city)
+                        if bases_per_city.get(city) is not None:
+                            df_final, group_fleet = add_walker_bases(df_final, bases_per_city[city], group_fleet)
+                        
+                        jobs.append(build_job(
+                            city, group_label, df_final, city_walkers, max_capacity, use_zones,
+                            group_solver_kwargs(city, service_time, forced_max_hours, solver_time_limit, max_dist_km,
+                                                traffic_factor=tf_factor, fleet=group_fleet,
+                                                day_start=day_start.strftime("%H:%M")),
+                            previous=previous_results.get((city, group_label)),
+                            # Portfolio races use every core, so groups run one at a time
+                            portfolio_workers=DEFAULT_PORTFOLIO_WORKERS if use_portfolio else 0))
+                    
+                    # 2. SUBMIT TO THE SOLVE QUEUE
+                    # Solved in the background (solve_queue.py): survives reloads and
+                    # runs from several coordinators are taken one after another
+                    if jobs:
+                        group_workers = 1 if use_portfolio else solver_workers
+                        cities = sorted({job['city'] for job in jobs})
+                        run_id = solve_queue.submit(jobs, owner=st.session_state.username, max_workers=group_workers,
+                                                    label=f"{', '.join(cities[:3])}{'...' if len(cities) > 3 else ''} ({len(jobs)} grupos)")
+                        open_run(run_id)
                         st.rerun()
                     else:
                         st.error("No se pudo generar ninguna solución. Verifique los datos.")
@@ -1077,27 +938,54 @@ elif st.session_state.stage == 'fleet_config':
     with col_summary:
         st.write(f"**Total Tickets:** {len(st.session_state.daily_tickets)}")
         st.write("**Oficinas a visitar:**")
-        df_display = pd.DataFrame(st.session_state.daily_tickets)
+        df_display = st.session_state.daily_tickets
         # Group by office name and count tickets
         office_counts = df_display.groupby('Nombre').size().reset_index(name='Tickets')
         st.dataframe(office_counts, use_container_width=True, hide_index=True)
 
+# --- STAGE 2B: OPTIMIZACION EN CURSO ---
+elif st.session_state.stage == 'solving':
+    st.header("⏳ Optimización en Curso")
+    run_id = st.session_state.active_run
+    run_status = solve_queue.status(run_id) if run_id else None
+    
+    if run_status is None:
+        st.error("No se encontró la optimización solicitada.")
+    elif run_status['state'] == DONE:
+        run_results = solve_queue.results(run_id)
+        if run_results:
+            st.session_state.optimization_result = run_results # Store List
+            st.session_state.stage = 'results'
+            st.rerun()
+        st.error("No se pudo generar ninguna solución. Verifique los datos.")
+    elif run_status['state'] == FAILED:
+        st.error(run_status.get('message', "Error calculando rutas."))
+    else:
+        render_run_progress(solve_queue, run_id)
+        st.caption("Puede cerrar o recargar la página: la optimización continúa en el servidor y se puede abrir desde 'Optimizaciones recientes'.")
+    
+    if st.button("🔙 Volver a Configuración"):
+        st.session_state.stage = 'fleet_config'
+        st.rerun()
+
 # --- STAGE 3: RESULTADOS ---
 elif st.session_state.stage == 'results':
     st.header("3️⃣ Rutas Optimizadas")
     
     if st.session_state.optimization_result:
         results_list = st.session_state.optimization_result
-        if not isinstance(results_list, list):
-            # Backward compatibility or fallback
-            results_list = [(*results_list, "General", "General")] 
+        
+        # Mid-day ticket changes: edit the list, then re-optimize from these routes
+        if st.button("✏️ Modificar Tickets y Re-optimizar"):
+            st.session_state.stage = 'input_tickets'
+            st.rerun()
             
         # Tabs for each Result Group (City/District)
         tab_names = []
         for res in results_list:
-            # Struct: (sol, rout, man, dat, df_cl, city, grouping_val)
-            city_name = res[5]
-            group_val = res[6]
+            # Struct: route_result.RouteResult (no live solver objects)
+            city_name = res.city
+            group_val = res.group
             if group_val == "Global":
                 tab_names.append(f"📍 {city_name}")
             else:
@@ -1117,91 +1005,29 @@ elif st.session_state.stage == 'results':
         
         for idx, tab in enumerate(tabs):
             with tab:
-                solution, routing, manager, data, df_cleaned_res, r_city, r_group = results_list[idx]
+                res = results_list[idx]
+                df_cleaned_res, r_city, r_group = res.stops, res.city, res.group
                 
                 # --- METRICS & MAP ---
-                max_route_distance = 0
-                total_distance = 0
-                total_load = 0
-                
-                # Extract Routes Logic (Copied/Adapted)
-                routes = []
-                for vehicle_id in range(data['num_vehicles']):
-                    if not routing.IsVehicleUsed(solution, vehicle_id): continue
-                    
-                    index = routing.Start(vehicle_id)
-                    route_dist = 0
-                    route_load = 0
-                    route_geometry = []
-                    
-                    while not routing.IsEnd(index):
-                        node_index = manager.IndexToNode(index)
-                        route_load += data['demands'][node_index]
-                        
-                        # Geometry
-                        lat = df_cleaned_res.iloc[node_index]['Latitud (y)']
-                        lon = df_cleaned_res.iloc[node_index]['Longitud (x)']
-                        route_geometry.append((lat, lon))
-                        
-                        previous_index = index
-                        index = solution.Value(routing.NextVar(index))
-                        
-                        step_dist = routing.GetArcCostForVehicle(previous_index, index, vehicle_id)
-                        route_dist += step_dist
-                        
-                    # End Node
-                    node_index = manager.IndexToNode(index)
-                    lat = df_cleaned_res.iloc[node_index]['Latitud (y)']
-                    lon = df_cleaned_res.iloc[node_index]['Longitud (x)']
-                    route_geometry.append((lat, lon))
-                    
-                    if route_dist >= 0: # Only active routes
-                        # Convert dist (meters appx)
-                        dist_km = route_dist / 1000 
-                        max_route_distance = max(max_route_distance, dist_km)
-                        total_distance += dist_km
-                        total_load += route_load
-                        
-                        # Global unique ID for saving (combine city index + vehicle ID)
-                        # To ensure uniqueness across tabs if needed, though VID is per solver instance.
-                        # We used vid directly before. It might clash if VID 0 exists in both Arequipa and Lima tabs.
-                        # Resolution: Make key composite in session_state? "assign_{city}_{vid}"
-                        # BUT render_route_details uses key f"assign_{vid}".
-                        # We must update key in render_route_details? 
-                        # Or just use VID? Since user inputs are stored by key, if key is same, inputs clash.
-                        # FIX: We need unique key in render_route_details.
-                        # Let's verify render_route_details key. It uses f"assign_{vid}".
-                        # If we have 2 tabs with VID 0, they will share the input!
-                        # We need to change render_route_details to accept a key prefix.
-                        
-                        routes.append({
-                            "vehicle_id": vehicle_id,
-                            "distance_km": dist_km,
-                            "stops": len(route_geometry) - 2, # Exclude depot start/end
-                            "load": route_load,
-                            "geometry": route_geometry,
-                            "type": "Caminante" 
-                        })
+                # Single extraction pass (memoized on the result): geometry, markers and itineraries per route
+                routes = res.route_views()
+                total_distance = sum(r['distance_km'] for r in routes)
+                max_route_distance = max((r['distance_km'] for r in routes), default=0)
+                total_load = sum(r['load'] for r in routes)
 
                 # --- DROPPED NODES CHECK ---
-                # Count unique non-depot nodes visited
-                visited_nodes = set()
-                for vehicle_id in range(data['num_vehicles']):
-                    if not routing.IsVehicleUsed(solution, vehicle_id): continue
-                    index = routing.Start(vehicle_id)
-                    while not routing.IsEnd(index):
-                        node_index = manager.IndexToNode(index)
-                        if node_index != 0: # Skip depot
-                            visited_nodes.add(node_index)
-                        index = solution.Value(routing.NextVar(index))
-                
-                total_tickets_in_group = len(df_cleaned_res) - 1
-                dropped = total_tickets_in_group - len(visited_nodes)
+                # Non-depot nodes no vehicle visits (collected at extraction)
+                dropped = len(res.dropped)
                 
                 if dropped > 0:
                      st.error(f"⚠️ {dropped} tickets NO pudieron ser asignados (Falta de tiempo/recursos). Considere aumentar caminantes o tiempo límite.")
                 else:
                      st.success("✅ Todos los tickets fueron asignados correctamente.")
+                # Offices rejected before the solve by the opening hours pre-check (part of the dropped ones)
+                window_rejected = (getattr(res, 'profile', None) or {}).get('window_rejected', 0)
+                if window_rejected:
+                     st.warning(f"🕒 {window_rejected} oficinas no se pueden visitar dentro de su horario de atención "
+                                f"(ni yendo directo desde la base). Revise su horario o la hora de salida.")
 
                 # Display Metrics
                 c1, c2, c3 = st.columns(3)
@@ -1209,10 +1035,35 @@ elif st.session_state.stage == 'results':
                 c2.metric("Ruta + Larga", f"{max_route_distance:.2f} km")
                 c3.metric("Tickets Atendidos", total_load)
                 
+                # --- SOLVER PROFILE ---
+                profile = getattr(res, 'profile', None)
+                if profile:
+                    with st.expander("⏱️ Perfil del optimizador"):
+                        def fmt_s(value):
+                            return f"{value:.1f} s" if value is not None else "-"
+                        p1, p2, p3, p4 = st.columns(4)
+                        p1.metric("Matriz", fmt_s(profile.get('matrix_seconds')))
+                        p2.metric("Modelo", fmt_s(profile.get('model_seconds')))
+                        p3.metric("Primera solución", fmt_s(profile.get('first_solution_seconds')))
+                        p4.metric("Mejor solución", fmt_s(profile.get('best_seconds')))
+                        p5, p6, p7, p8 = st.columns(4)
+                        p5.metric("Búsqueda", f"{fmt_s(profile.get('search_seconds'))} / {profile.get('budget_seconds', '-')} s")
+                        p6.metric("Soluciones", profile.get('solutions', 0))
+                        p7.metric("Objetivo", f"{profile['objective']:,}" if profile.get('objective') is not None else "-")
+                        p8.metric("No asignados", profile.get('dropped', 0))
+                        st.caption(f"Método: {profile.get('solver', '-')} · {profile.get('locations', 0)} ubicaciones · "
+                                   f"{profile.get('vehicles', 0)} recursos"
+                                   + (" · detenido al estancarse" if profile.get('stopped_early') else "")
+                                   + (f" · ganador: {profile['winner']}" if profile.get('winner') else "")
+                                   + (f" · {profile['window_offices']} con horario, {profile.get('pruned_arcs', 0):,} arcos descartados"
+                                      if profile.get('window_offices') else ""))
+                        if len(profile.get('trace', [])) > 1:
+                            st.line_chart(pd.DataFrame(profile['trace'], columns=['Segundos', 'Objetivo']).set_index('Segundos'))
+                
                 # Display Map (Folium)
                 # We reuse the map logic
-                center_lat = df_cleaned_res.iloc[0]['Latitud (y)']
-                center_lon = df_cleaned_res.iloc[0]['Longitud (x)']
+                center_lat = df_cleaned_res['Latitud (y)'].iat[0]
+                center_lon = df_cleaned_res['Longitud (x)'].iat[0]
                 m = folium.Map(location=[center_lat, center_lon], zoom_start=13)
                 
                 colors = ['red', 'blue', 'green', 'purple', 'orange', 'darkred', 'lightred', 'beige', 'darkblue', 'darkgreen', 'cadetblue', 'darkpurple', 'white', 'pink', 'lightblue', 'lightgreen', 'gray', 'black', 'lightgray']
@@ -1223,68 +1074,26 @@ elif st.session_state.stage == 'results':
                     
                     folium.PolyLine(r['geometry'], color=color, weight=2.5, opacity=1).add_to(m)
                     
-                    index = routing.Start(r['vehicle_id'])
-                    step = 0
-                    while not routing.IsEnd(index):
-                        node_index = manager.IndexToNode(index)
-                        row = df_cleaned_res.iloc[node_index]
-                        
-                        icon_color = color
+                    for step, (lat, lon, popup) in enumerate(r['markers']):
                         icon_type = "info-sign"
                         if step == 0: icon_type = "home" 
                         
                         folium.Marker(
-                            location=[row['Latitud (y)'], row['Longitud (x)']],
-                            popup=f"{row['Nombre']} ({row['Habla a']}) - {row.get('Ticket', '')}",
-                            icon=folium.Icon(color=icon_color, icon=icon_type)
+                            location=[lat, lon],
+                            popup=popup,
+                            icon=folium.Icon(color=color, icon=icon_type)
                         ).add_to(m)
                         
-                        index = solution.Value(routing.NextVar(index))
-                        step += 1
-                        
-                st_folium(m, height=400, width="100%", key=f"map_{city_name}_{group_val}_{idx}")
+                st_folium(m, height=400, width="100%", key=f"map_{r_city}_{r_group}_{idx}")
                 
                 st.subheader("📋 Detalle de Itinerarios")
                 
                 # --- ITINERARIES ---
                 for r in routes:
                     vid = r['vehicle_id']
-                    
-                    # Reconstruct DataFrame for this route
-                    route_rows = []
-                    index = routing.Start(vid)
-                    accum_time = 0
-                    
-                    while not routing.IsEnd(index):
-                        node_index = manager.IndexToNode(index)
-                        if node_index != 0: 
-                             row_data = df_cleaned_res.iloc[node_index].copy()
-                             accum_time += 15 
-                             row_data['AccumulatedDuration_Mins'] = accum_time
-                             route_rows.append(row_data)
-                        
-                        index = solution.Value(routing.NextVar(index))
-                        
-                    if route_rows:
-                        vehicle_route = pd.DataFrame(route_rows)
-                        
-                        # --- FIX KEY ERROR ---
-                        # Map internal DB names to what render_route_details expects
-                        if 'Nombre' in vehicle_route.columns:
-                            vehicle_route['LocationName'] = vehicle_route['Nombre']
-                        if 'Habla a' in vehicle_route.columns:
-                            vehicle_route['Client'] = vehicle_route['Habla a']
-                        
-                        # Map Coordinates for Google Maps
-                        if 'Latitud (y)' in vehicle_route.columns:
-                             vehicle_route['Latitude'] = vehicle_route['Latitud (y)']
-                        if 'Longitud (x)' in vehicle_route.columns:
-                             vehicle_route['Longitude'] = vehicle_route['Longitud (x)']
-                        
-                        # Add Order In Route (Simple index-based)
-                        vehicle_route['OrderInRoute'] = range(1, len(vehicle_route) + 1)
-
+                    vehicle_route = r['itinerary']
                         
+                    if not vehicle_route.empty:
                         # Use City+Group+VID as unique ID for saving
                         unique_suffix = f"_{r_city}_{r_group}"
                         unique_vid_key = f"{vid}{unique_suffix}"
@@ -1297,7 +1106,8 @@ elif st.session_state.stage == 'results':
                         }
                         
                         # Render using helper with specific city for this tab
-                        render_route_details(vehicle_route, vid, "Caminante", is_admin=True, route_city=r_city, unique_key_suffix=unique_suffix)
+                        render_route_details(vehicle_route, vid, "Caminante", is_admin=True, route_city=r_city, unique_key_suffix=unique_suffix,
+                                             assigned_to=r['vehicle_name'], depot=r['geometry'][0])
         
         # --- SAVE BUTTON ---
         st.markdown("---")
@@ -0,0 +1,261 @@
+"""
+Headless batch planner: the "Calcular Rutas" flow of app.py without a browser.
+
+    python batch_plan.py tickets.xlsx --master "Base Arequipa .xlsx" --output planificacion_hoy
+    python batch_plan.py tickets.csv --walkers 5 --city-walkers LIMA=12 --city-strategy LIMA=zonas
+    python batch_plan.py tickets.xlsx --fleet flota.xlsx
+    python batch_plan.py tickets.xlsx --bases personal.xlsx
+
+Tickets are matched against the master DB (exact, district-stripped and fuzzy, as
+the app's import), grouped per department (or per district) and every group is
+solved in parallel processes. With --bases, the walkers of the personnel list start
+and end at their own base. The output directory gets:
+    rutas.xlsx              Rutas / Resumen / No asignados / No encontrados / Similitud sheets
+    mapa_<CITY>_<GROUP>.html  one map per group
+    perfil_solver.jsonl     solver profile per group
+"""
+import os
+import sys
+import time
+import argparse
+import folium
+import pandas as pd
+
+from fleet import read_fleet_table, city_fleet, fleet_size
+from walker_bases import read_personnel_bases, locate_bases, city_bases
+from time_windows import DAY_START
+from master_db import open_master_store, MASTER_FILE_PATH
+from ticket_import import import_tickets
+from vrp_portfolio import DEFAULT_PORTFOLIO_WORKERS
+from route_planning import (city_group, build_job, group_solver_kwargs, add_walker_bases, run_solve_jobs, append_profiles,
+                            DEFAULT_SOLVER_WORKERS, STRATEGY_GLOBAL, STRATEGY_DISTRICT, STRATEGY_ZONES)
+
+# --- CONFIGURATION ---
+# Same defaults as the fleet configuration stage of the app
+DEFAULT_WALKERS = 5
+DEFAULT_CAPACITY = 50
+DEFAULT_SERVICE_MINUTES = 15
+DEFAULT_MAX_HOURS = 100
+DEFAULT_MAX_KM = 20
+DEFAULT_MAX_SECONDS = 60
+
+STRATEGY_NAMES = {'global': STRATEGY_GLOBAL, 'distrito': STRATEGY_DISTRICT, 'zonas': STRATEGY_ZONES}
+MAP_COLORS = ['red', 'blue', 'green', 'purple', 'orange', 'darkred', 'lightred', 'beige', 'darkblue', 'darkgreen',
+              'cadetblue', 'darkpurple', 'white', 'pink', 'lightblue', 'lightgreen', 'gray', 'black', 'lightgray']
+
+
+def parse_city_values(values, convert, option):
+    """CITY=VALUE pairs (repeated option) -> {CITY: converted value}."""
+    result = {}
+    for item in values or []:
+        city, sep, value = item.partition('=')
+        if not sep or not city.strip():
+            raise SystemExit(f"{option}: se esperaba CIUDAD=VALOR, se recibió '{item}'")
+        try:
+            result[city.strip().upper()] = convert(value.strip())
+        except (ValueError, KeyError):
+            raise SystemExit(f"{option}: valor inválido para {city}: '{value}'")
+    return result
+
+
+def plan_jobs(tickets, args, fleet=None, bases=None):
+    """
+    Jobs for every department (and district with the 'distrito' strategy), as the app builds them.
+    fleet: fleet table; departments with rows in it use those vehicles instead of --walkers.
+    bases: located walker bases; departments with walkers in it use those walkers, each
+    starting and ending at their base (plus the non-walker vehicles of the fleet table).
+    """
+    city_walkers = parse_city_values(args.city_walkers, int, '--city-walkers')
+    city_strategy = parse_city_values(args.city_strategy, lambda v: STRATEGY_NAMES[v.lower()], '--city-strategy')
+    portfolio_workers = DEFAULT_PORTFOLIO_WORKERS if args.portfolio else 0
+
+    jobs = []
+    for city in sorted(tickets['Provincia'].unique()):
+        city_tickets = tickets[tickets['Provincia'] == city]
+        c_fleet = city_fleet(fleet, city)
+        c_bases = city_bases(bases, city)
+        walkers = fleet_size(c_fleet) if c_fleet is not None else city_walkers.get(city, args.walkers)
+        if c_bases is not None:
+            walkers = len(c_bases) + fleet_size(c_fleet[c_fleet['Tipo'] != 'Walker'] if c_fleet is not None else None)
+        if walkers == 0:
+            print(f"{city}: omitido (0 caminantes).")
+            continue
+        strategy = city_strategy.get(city, STRATEGY_NAMES[args.strategy])
+        # The app solves one selected district; in batch every district is its own group
+        selections = sorted(city_tickets['Distrito'].unique()) if strategy == STRATEGY_DISTRICT else [None]
+        solver_kwargs = group_solver_kwargs(city, args.service_minutes, args.max_hours, args.max_seconds, args.max_km,
+                                            fleet=c_fleet, day_start=args.day_start)
+        for districts in selections:
+            try:
+                group, use_zones, df_final = city_group(city_tickets, city, strategy, districts)
+            except ValueError as e:
+                print(e)
+                continue
+            group_kwargs = solver_kwargs
+            if c_bases is not None:
+                df_final, group_fleet = add_walker_bases(df_final, c_bases, c_fleet)
+                group_kwargs = dict(solver_kwargs, fleet=group_fleet)
+            jobs.append(build_job(city, group, df_final, walkers, args.capacity, use_zones, group_kwargs,
+                                  portfolio_workers=portfolio_workers))
+    return jobs
+
+
+def group_map(res):
+    """Folium map of one group's routes (same drawing as the results stage of the app)."""
+    m = folium.Map(location=[res.stops['Latitud (y)'].iat[0], res.stops['Longitud (x)'].iat[0]], zoom_start=13)
+    for r in res.route_views():
+        color = MAP_COLORS[r['vehicle_id'] % len(MAP_COLORS)]
+        folium.PolyLine(r['geometry'], color=color, weight=2.5, opacity=1).add_to(m)
+        for step, (lat, lon, popup) in enumerate(r['markers']):
+            folium.Marker(location=[lat, lon], popup=popup,
+                          icon=folium.Icon(color=color, icon="home" if step == 0 else "info-sign")).add_to(m)
+    return m
+
+
+def route_tables(results):
+    """(stops of every route, one summary row per route, offices left unassigned) for the workbook."""
+    stops, summary, dropped = [], [], []
+    for res in results:
+        for r in res.route_views():
+            itinerary = r['itinerary']
+            stops.append(pd.DataFrame({
+                'Departamento': res.city,
+                'Grupo': res.group,
+                'Recurso': r['vehicle_id'] + 1,
+                'Tipo': r['vehicle_type'],
+                'Encuestador': r['vehicle_name'] or "",
+                'Orden': itinerary['OrderInRoute'],
+                'Oficina': itinerary['Nombre'],
+                'Cliente': itinerary.get('Habla a', ""),
+                'Ticket': itinerary.get('Ticket', ""),
+                'Familia': itinerary.get('Familia', ""),
+                'Distrito': itinerary.get('Distrito', ""),
+                'Latitud': itinerary['Latitude'],
+                'Longitud': itinerary['Longitude'],
+                'Minutos Acumulados': itinerary['AccumulatedDuration_Mins'],
+                'Hora apertura': itinerary.get('Hora apertura', ""),
+                'Hora cierre': itinerary.get('Hora cierre', ""),
+            }))
+            summary.append({'Departamento': res.city, 'Grupo': res.group, 'Recurso': r['vehicle_id'] + 1,
+                            'Tipo': r['vehicle_type'], 'Encuestador': r['vehicle_name'] or "", 'Paradas': r['stops'], 'Tickets': r['load'],
+                            'Distancia (km)': round(r['distance_km'], 2)})
+        if len(res.dropped):
+            lost = res.stops.take(res.dropped)
+            dropped.append(lost.assign(Departamento=res.city, Grupo=res.group))
+    return (pd.concat(stops, ignore_index=True) if stops else pd.DataFrame(),
+            pd.DataFrame(summary),
+            pd.concat(dropped, ignore_index=True) if dropped else pd.DataFrame())
+
+
+def safe_name(text):
+    return "".join(c if c.isalnum() or c in "-_" else "_" for c in str(text).strip())
+
+
+def write_outputs(results, df_unmatched, fuzzy_accepted, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    stops, summary, dropped = route_tables(results)
+    excel_path = os.path.join(output_dir, "rutas.xlsx")
+    with pd.ExcelWriter(excel_path) as writer:
+        stops.to_excel(writer, sheet_name="Rutas", index=False)
+        summary.to_excel(writer, sheet_name="Resumen", index=False)
+        dropped.to_excel(writer, sheet_name="No asignados", index=False)
+        df_unmatched.to_excel(writer, sheet_name="No encontrados", index=False)
+        fuzzy_accepted.to_excel(writer, sheet_name="Similitud", index=False)
+    print(f"Saved {excel_path}")
+
+    for res in results:
+        map_path = os.path.join(output_dir, f"mapa_{safe_name(res.city)}_{safe_name(res.group)}.html")
+        group_map(res).save(map_path)
+        print(f"Saved {map_path}")
+
+    append_profiles(results, os.path.join(output_dir, "perfil_solver.jsonl"))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Planificación de rutas por lote (sin navegador).")
+    parser.add_argument("tickets", help="Archivo de tickets (.xlsx, .xls o .csv) con columnas Domicilio, Ticket, Familia")
+    parser.add_argument("--master", default=MASTER_FILE_PATH, help="Base maestra (por defecto: %(default)s)")
+    parser.add_argument("--output", "-o", default=None, help="Carpeta de salida (por defecto: planificacion_<fecha>)")
+    parser.add_argument("--walkers", type=int, default=DEFAULT_WALKERS, help="Caminantes por departamento")
+    parser.add_argument("--city-walkers", action="append", metavar="CIUDAD=N", help="Caminantes para un departamento (repetible)")
+    parser.add_argument("--strategy", choices=sorted(STRATEGY_NAMES), default="global", help="Agrupación por defecto")
+    parser.add_argument("--city-strategy", action="append", metavar="CIUDAD=ESTRATEGIA", help="Agrupación para un departamento (repetible)")
+    parser.add_argument("--fleet", default=None, help="Tabla de flota (.xlsx con hoja '3.Vehículos', o .csv): "
+                        "Tipo, Numero de vehiculos, Capacidad, Velocidad (km/h), Jornada (h), Inicio, Fin, Departamento, Recurso")
+    parser.add_argument("--bases", default=None, help="Lista de personal (.xlsx o .csv) con CORREO, ENCUESTADOR, CIUDAD y "
+                        "LATITUD / LONGITUD (o DISTRITO): cada caminante sale y vuelve a su base")
+    parser.add_argument("--capacity", type=int, default=DEFAULT_CAPACITY, help="Tickets máximos por caminante")
+    parser.add_argument("--service-minutes", type=int, default=DEFAULT_SERVICE_MINUTES, help="Minutos de servicio por ticket")
+    parser.add_argument("--max-hours", type=int, default=DEFAULT_MAX_HOURS, help="Jornada máxima (horas)")
+    parser.add_argument("--day-start", default=DAY_START, help="Hora de salida (HH:MM), referencia de los horarios "
+                        "de atención 'Hora apertura' / 'Hora cierre' (por defecto: %(default)s)")
+    parser.add_argument("--max-km", type=float, default=DEFAULT_MAX_KM, help="Distancia máxima por caminante (km)")
+    parser.add_argument("--max-seconds", type=int, default=DEFAULT_MAX_SECONDS, help="Tiempo máximo de búsqueda por grupo")
+    parser.add_argument("--workers", type=int, default=DEFAULT_SOLVER_WORKERS, help="Grupos resueltos en paralelo")
+    parser.add_argument("--portfolio", action="store_true", help="Búsqueda en portafolio por grupo (usa todos los núcleos)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output_dir = args.output or time.strftime("planificacion_%Y%m%d_%H%M")
+
+    print(f"Loading master DB: {args.master}")
+    master_store = open_master_store(args.master)
+    if master_store is None:
+        print(f"No se encontró el archivo maestro en: {args.master}")
+        return 1
+
+    print(f"Importing tickets: {args.tickets}")
+    def on_progress(progress, added, unmatched):
+        print(f"  {int(progress * 100)}% - {added} tickets, {unmatched} sin coincidencia")
+    try:
+        with open(args.tickets, "rb") as upload:
+            tickets, df_unmatched, fuzzy_accepted = import_tickets(upload, args.tickets, master_store, on_progress=on_progress)
+    except (OSError, ValueError) as e:
+        print(f"Error procesando tickets: {e}")
+        return 1
+    print(f"{len(tickets)} tickets, {len(df_unmatched)} direcciones no encontradas, {len(fuzzy_accepted)} por similitud.")
+    if tickets.empty:
+        print("No hay tickets para planificar.")
+        return 1
+
+    fleet = None
+    if args.fleet:
+        try:
+            fleet = read_fleet_table(args.fleet)
+        except (OSError, ValueError) as e:
+            print(f"Error leyendo la flota: {e}")
+            return 1
+        print(f"Fleet table: {fleet_size(fleet)} vehicles in {len(fleet)} rows")
+
+    bases = None
+    if args.bases:
+        try:
+            bases = locate_bases(read_personnel_bases(args.bases), master_store.df)
+        except (OSError, ValueError) as e:
+            print(f"Error leyendo la lista de personal: {e}")
+            return 1
+        located = bases['Latitud (y)'].notna().sum()
+        print(f"Walker bases: {located} of {len(bases)} walkers located")
+
+    jobs = plan_jobs(tickets, args, fleet, bases)
+    if not jobs:
+        print("No hay grupos para resolver.")
+        return 1
+    # Portfolio races use every core, so groups run one at a time
+    workers = 1 if args.portfolio else args.workers
+    print(f"Solving {len(jobs)} groups with {min(workers, len(jobs))} processes...")
+
+    def on_done(finished, job, result):
+        status = "sin solución" if result is None else f"{result.num_routes} rutas, {len(result.dropped)} no asignados"
+        print(f"[{finished}/{len(jobs)}] {job['city']} - {job['group']}: {status}")
+
+    results = [r for r in run_solve_jobs(jobs, max_workers=workers, on_done=on_done) if r is not None]
+    write_outputs(results, df_unmatched, fuzzy_accepted, output_dir)
+    print(f"Done: {len(results)} of {len(jobs)} groups solved. Output in {output_dir}")
+    return 0 if results else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
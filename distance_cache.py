@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import numpy as np
+
+from vrp_solver import haversine_block, MATRIX_BLOCK_ROWS
+
+# --- CONFIGURATION ---
+DISTANCE_CACHE_DIR = "cache_distancias"
+# Offices per namespace (department) before the cache is rebuilt from scratch.
+# 20k x 20k int32 = 1.6 GB on disk, the most we want to memory-map.
+MAX_CACHED_OFFICES = 20000
+# Appended blocks per namespace before they are merged into one (a full rewrite, so rare)
+MAX_CACHE_BLOCKS = 64
+# Files the active version does not use are deleted once CURRENT has pointed to it this long
+PRUNE_GRACE_SECONDS = 600
+
+
+def office_key(office_id, lat, lon):
+    """Cache key for an office: master DB Id if known, otherwise its coordinates."""
+    if isinstance(office_id, float):
+        # Ids read from a column with blanks come back as floats
+        office_id = None if np.isnan(office_id) else (int(office_id) if office_id.is_integer() else office_id)
+    if office_id is not None and str(office_id).strip():
+        return f"id:{office_id}"
+    return f"xy:{lat:.6f},{lon:.6f}"
+
+
+class DistanceCache:
+    """
+    Persistent pairwise distance matrix (int32 meters) per namespace (department).
+
+    Layout on disk:
+        <cache_dir>/<namespace>/CURRENT          -> name of the active version
+        <cache_dir>/<namespace>/<version>.json   -> keys, coords and blocks of that version
+        <cache_dir>/<namespace>/<block>.npy      -> rows of slots first..first+r-1 against
+                                                    every slot 0..first+r-1
+
+    Distances are symmetric, so the matrix is kept as a lower triangle cut in row
+    blocks. New offices only add a block (their rows against every slot so far) and a
+    version file listing the old blocks plus the new one, switched in atomically:
+    nothing already written is copied or modified, and concurrent readers never see a
+    half-written file. An office whose coordinates changed gets a new slot; the old one
+    is left unused until the blocks are merged (MAX_CACHE_BLOCKS).
+    Only holds paths, so it can be pickled to worker processes.
+    """
+
+    def __init__(self, cache_dir=DISTANCE_CACHE_DIR, namespace="default"):
+        self.cache_dir = cache_dir
+        self.namespace = str(namespace).strip().upper().replace(os.sep, "_") or "DEFAULT"
+
+    @property
+    def root(self):
+        return os.path.join(self.cache_dir, self.namespace)
+
+    def _load(self):
+        """
+        Returns (version, keys, coords, blocks) of the active version, or an empty cache.
+        blocks: [(file name, first slot, memmap), ...]; keys[slot] is None for retired slots.
+        """
+        for _ in range(3):
+            try:
+                with open(os.path.join(self.root, "CURRENT"), "r", encoding="utf-8") as f:
+                    version = f.read().strip()
+            except OSError:
+                break # No cache yet
+            try:
+                with open(os.path.join(self.root, version + ".json"), "r", encoding="utf-8") as f:
+                    manifest = json.load(f)
+                keys = manifest['keys']
+                coords = np.asarray(manifest['coords'], dtype=float).reshape(-1, 2)
+                blocks = [(name, first, np.load(os.path.join(self.root, name), mmap_mode="r"))
+                          for name, first in manifest['blocks']]
+            except (OSError, ValueError, KeyError):
+                continue # CURRENT moved on while reading (or a folder of the old layout): read it again
+            slots = 0
+            for _, first, band in blocks:
+                if first != slots or band.ndim != 2 or band.shape[1] != first + band.shape[0]:
+                    break
+                slots += band.shape[0]
+            else:
+                if len(keys) == len(coords) == slots:
+                    return version, keys, coords, blocks
+            print(f"Distance cache {self.namespace} inconsistent. Rebuilding.")
+            break
+        return None, [], np.empty((0, 2)), []
+
+    def _prune_versions(self, version):
+        """
+        Deletes version files and blocks the active version does not use (and folders of
+        the old one-matrix-per-version layout). Only once CURRENT has pointed to it for
+        PRUNE_GRACE_SECONDS, so a reader that read an older pointer has long opened its
+        files, and only files at least that old, so a concurrent writer's next version is
+        left alone. Best effort: a block still mapped by a reader cannot be deleted on
+        Windows and is retried on a later call.
+        """
+        now = time.time()
+        try:
+            if now - os.path.getmtime(os.path.join(self.root, "CURRENT")) < PRUNE_GRACE_SECONDS:
+                return
+            with open(os.path.join(self.root, version + ".json"), "r", encoding="utf-8") as f:
+                used = {name for name, _ in json.load(f)['blocks']}
+            names = os.listdir(self.root)
+        except (OSError, ValueError, KeyError):
+            return
+        used |= {"CURRENT", version + ".json"}
+        for name in names:
+            path = os.path.join(self.root, name)
+            try:
+                stale = name not in used and now - os.path.getmtime(path) >= PRUNE_GRACE_SECONDS
+            except OSError:
+                continue
+            if not stale:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _write_block(self, coords, first):
+        """Computes the rows of slots first..len(coords)-1 against every slot up to them; returns the file name."""
+        n = len(coords)
+        name = f"{uuid.uuid4().hex[:12]}.npy"
+        band = np.lib.format.open_memmap(os.path.join(self.root, name), mode="w+", dtype=np.int32, shape=(n - first, n))
+        lats_rad = np.radians(coords[:, 0])
+        lons_rad = np.radians(coords[:, 1])
+        for start in range(first, n, MATRIX_BLOCK_ROWS):
+            stop = min(start + MATRIX_BLOCK_ROWS, n)
+            band[start - first:stop - first] = haversine_block(lats_rad[start:stop], lons_rad[start:stop], lats_rad, lons_rad)
+        band[np.arange(n - first), np.arange(first, n)] = 0
+        band.flush()
+        del band
+        return name
+
+    def _write_version(self, keys, coords, blocks, first):
+        """
+        Writes a version with len(keys) slots: the existing blocks plus one new block for
+        slots first.. (new or moved offices). Past MAX_CACHE_BLOCKS the live slots are
+        written again as a single block instead.
+        """
+        if len(blocks) >= MAX_CACHE_BLOCKS:
+            live = [slot for slot, k in enumerate(keys) if k is not None]
+            keys, coords = [keys[slot] for slot in live], coords[live]
+            entries = [(self._write_block(coords, 0), 0)]
+        else:
+            entries = [(name, start) for name, start, _ in blocks] + [(self._write_block(coords, first), first)]
+
+        version = uuid.uuid4().hex[:12]
+        tmp_manifest = os.path.join(self.root, f"{version}.json.tmp")
+        with open(tmp_manifest, "w", encoding="utf-8") as f:
+            json.dump({'keys': keys, 'coords': coords.tolist(), 'blocks': entries}, f)
+        os.replace(tmp_manifest, os.path.join(self.root, version + ".json"))
+
+        tmp_pointer = os.path.join(self.root, f"CURRENT.{version}.tmp")
+        with open(tmp_pointer, "w", encoding="utf-8") as f:
+            f.write(version)
+        os.replace(tmp_pointer, os.path.join(self.root, "CURRENT"))
+
+    def matrix(self, keys, lats, lons):
+        """
+        Distance matrix (int32 meters) for the given locations.
+        keys[i] = None marks a location that is never cached (e.g. the depot); its
+        row/column is always computed fresh (as is any office a concurrent writer lost). Everything else is sliced from disk,
+        extending the cache first with offices it has not seen yet.
+        """
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        n = len(keys)
+
+        version, cached_keys, cached_coords, blocks = self._load()
+        if version is not None:
+            self._prune_versions(version)
+        if len(cached_keys) >= MAX_CACHED_OFFICES:
+            print(f"Distance cache {self.namespace} full ({len(cached_keys)}). Starting over.")
+            cached_keys, cached_coords, blocks = [], np.empty((0, 2)), []
+        slot_of = {k: i for i, k in enumerate(cached_keys) if k is not None}
+
+        # New offices and offices whose coordinates changed in the master DB get a new slot
+        new_keys = list(cached_keys)
+        new_coords = [cached_coords]
+        for i, k in enumerate(keys):
+            if k is None:
+                continue
+            slot = slot_of.get(k)
+            if slot is not None and (slot >= len(cached_coords)
+                                     or np.allclose(cached_coords[slot], (lats[i], lons[i]), atol=1e-7)):
+                continue
+            if slot is not None:
+                new_keys[slot] = None # Retired: its distances are for the old coordinates
+            slot_of[k] = len(new_keys)
+            new_keys.append(k)
+            new_coords.append(np.array([[lats[i], lons[i]]]))
+
+        if len(new_keys) > len(cached_keys):
+            print(f"Distance cache {self.namespace}: computing {len(new_keys) - len(cached_keys)} new offices.")
+            os.makedirs(self.root, exist_ok=True)
+            self._write_version(new_keys, np.concatenate(new_coords), blocks, len(cached_keys))
+            # Drop the old mappings before loading again
+            del blocks
+            version, cached_keys, cached_coords, blocks = self._load()
+            # Another process may have switched versions in between
+            slot_of = {k: i for i, k in enumerate(cached_keys) if k is not None}
+
+        # Slice cached part
+        cached_pos = np.array([i for i, k in enumerate(keys) if k in slot_of], dtype=np.int64)
+        fresh_pos = np.array([i for i, k in enumerate(keys) if k not in slot_of], dtype=np.int64)
+        slots = np.array([slot_of[keys[i]] for i in cached_pos], dtype=np.int64)
+
+        dist = np.empty((n, n), dtype=np.int32)
+        if len(cached_pos):
+            # Each block holds the rows of its slots against every lower slot; the upper part is mirrored
+            order = np.argsort(slots, kind='stable')
+            sorted_slots = slots[order]
+            sub = np.empty((len(slots), len(slots)), dtype=np.int32)
+            for _, first, band in blocks:
+                lo, hi = np.searchsorted(sorted_slots, [first, first + band.shape[0]])
+                if lo == hi:
+                    continue
+                values = np.asarray(band[np.ix_(sorted_slots[lo:hi] - first, sorted_slots[:hi])])
+                sub[np.ix_(order[lo:hi], order[:hi])] = values
+                sub[np.ix_(order[:hi], order[lo:hi])] = values.T
+            dist[np.ix_(cached_pos, cached_pos)] = sub
+
+        # Depot(s) and other uncached rows/columns
+        if len(fresh_pos):
+            lats_rad = np.radians(lats)
+            lons_rad = np.radians(lons)
+            rows = haversine_block(lats_rad[fresh_pos], lons_rad[fresh_pos], lats_rad, lons_rad).astype(np.int32)
+            dist[fresh_pos] = rows
+            dist[:, fresh_pos] = rows.T
+
+        np.fill_diagonal(dist, 0)
+        return dist
@@ -0,0 +1,10 @@
+@echo off
+echo Planificacion de rutas por lote (JLRutas)...
+echo.
+cd /d "%~dp0"
+
+REM Uso: ejecutar_planificacion_lote.bat tickets.xlsx [opciones]
+REM Ver opciones: python batch_plan.py --help
+python batch_plan.py %*
+
+pause
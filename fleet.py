@@ -0,0 +1,131 @@
+import os
+import pandas as pd
+
+# --- CONFIGURATION ---
+# Sheet holding the vehicles table in planning workbooks (the first sheet is used otherwise)
+FLEET_SHEET = "3.Vehículos"
+# Default speed (km/h) per vehicle class
+CLASS_SPEEDS_KMH = {'Auto': 30, 'Moto': 35, 'Walker': 5.0}
+# Classes slowed down by the traffic factor
+TRAFFIC_CLASSES = ('Auto', 'Moto')
+# Names accepted in the 'Tipo' column (lowercase) for each class
+CLASS_ALIASES = {
+    'auto': 'Auto', 'carro': 'Auto', 'camioneta': 'Auto', 'car': 'Auto',
+    'moto': 'Moto', 'motocicleta': 'Moto', 'motorizado': 'Moto',
+    'walker': 'Walker', 'caminante': 'Walker', 'a pie': 'Walker', 'peaton': 'Walker', 'peatón': 'Walker',
+}
+# Fleet table: one row per group of identical vehicles. Empty optional cells take the
+# defaults of the solve (capacity, class speed, max_work_hours, the group depot).
+#   Departamento        only for that department (empty = every department)
+#   Tipo                vehicle class (CLASS_ALIASES)
+#   Numero de vehiculos how many (default 1)
+#   Capacidad           tickets per vehicle
+#   Velocidad (km/h)    speed before the traffic factor
+#   Jornada (h)         shift length
+#   Inicio / Fin        'Nombre' of the start / end depot row of the group
+#   Recurso             who drives / walks it (e.g. the walker's e-mail), kept on its route
+FLEET_COLUMNS = ['Departamento', 'Tipo', 'Numero de vehiculos', 'Capacidad', 'Velocidad (km/h)', 'Jornada (h)',
+                 'Inicio', 'Fin', 'Recurso']
+
+
+def vehicle_class(name):
+    """Canonical class ('Auto', 'Moto', 'Walker') of a 'Tipo' cell; ValueError if unknown."""
+    key = str(name).strip()
+    if key in CLASS_SPEEDS_KMH:
+        return key
+    try:
+        return CLASS_ALIASES[key.lower()]
+    except KeyError:
+        raise ValueError(f"Tipo de vehículo desconocido: '{name}' (use Auto, Moto o Caminante)")
+
+
+def default_fleet(num_cars, num_walkers, vehicle_capacity):
+    """Fleet table of the classic solve: num_cars cars, then num_walkers walkers, same capacity."""
+    rows = [{'Tipo': v_type, 'Numero de vehiculos': count, 'Capacidad': vehicle_capacity}
+            for v_type, count in (('Auto', num_cars), ('Walker', num_walkers)) if count > 0]
+    return normalize_fleet(pd.DataFrame(rows, columns=['Tipo', 'Numero de vehiculos', 'Capacidad']))
+
+
+def normalize_fleet(df):
+    """
+    Cleans a fleet table (read from a sheet or edited in the app): trims headers,
+    adds missing FLEET_COLUMNS, canonical 'Tipo', numeric counts/capacities/speeds/shifts
+    (NaN = default) and drops rows without vehicles. Raises ValueError (message for the
+    user) when 'Tipo' is missing or a value is invalid.
+    """
+    df = df.copy()
+    df.columns = [str(c).strip() for c in df.columns]
+    if 'Tipo' not in df.columns:
+        raise ValueError("La tabla de flota no tiene la columna 'Tipo'.")
+    df = df.dropna(subset=['Tipo'])
+    df = df[df['Tipo'].astype(str).str.strip() != ""]
+    for col in FLEET_COLUMNS:
+        if col not in df.columns:
+            df[col] = None
+    df['Tipo'] = df['Tipo'].map(vehicle_class)
+    df['Departamento'] = df['Departamento'].map(lambda v: "" if pd.isna(v) else str(v).strip().upper())
+    for col in ['Inicio', 'Fin', 'Recurso']:
+        df[col] = df[col].map(lambda v: None if pd.isna(v) or str(v).strip() == "" else str(v).strip())
+    for col in ['Numero de vehiculos', 'Capacidad', 'Velocidad (km/h)', 'Jornada (h)']:
+        values = pd.to_numeric(df[col], errors='coerce')
+        if (values.dropna() < 0).any():
+            raise ValueError(f"Valores negativos en la columna '{col}' de la flota.")
+        df[col] = values
+    df['Numero de vehiculos'] = df['Numero de vehiculos'].fillna(1).astype(int)
+    df = df[df['Numero de vehiculos'] > 0]
+    return df[FLEET_COLUMNS].reset_index(drop=True)
+
+
+def read_fleet_table(source, name=None):
+    """
+    Fleet table from an Excel workbook (FLEET_SHEET, or its first sheet) or a CSV file.
+    source: path or file-like object; name: file name when source is file-like.
+    """
+    name = name or str(source)
+    if os.path.splitext(name)[1].lower() == ".csv":
+        df = pd.read_csv(source)
+    else:
+        sheets = pd.ExcelFile(source)
+        df = sheets.parse(FLEET_SHEET if FLEET_SHEET in sheets.sheet_names else sheets.sheet_names[0])
+    return normalize_fleet(df)
+
+
+def city_fleet(fleet, city):
+    """Rows of `fleet` for a department (its own rows plus those without department), or None."""
+    if fleet is None:
+        return None
+    rows = fleet[fleet['Departamento'].isin(["", str(city).strip().upper()])]
+    return rows.reset_index(drop=True) if not rows.empty else None
+
+
+def fleet_size(fleet):
+    return int(fleet['Numero de vehiculos'].sum()) if fleet is not None else 0
+
+
+def one_per_vehicle(fleet):
+    """Same fleet table with one row (Numero de vehiculos = 1) per vehicle, in table order."""
+    vehicles = fleet.loc[fleet.index.repeat(fleet['Numero de vehiculos'])].reset_index(drop=True)
+    vehicles['Numero de vehiculos'] = 1
+    return vehicles
+
+
+def fleet_vehicles(fleet, vehicle_capacity, max_work_hours, traffic_factor=1.0):
+    """
+    One row per vehicle, in table order: Tipo, capacity (tickets), speed_ms, shift_s
+    (seconds), start / end depot names (None = the group depot) and name. Empty cells take
+    vehicle_capacity, the class speed and max_work_hours.
+    """
+    vehicles = one_per_vehicle(fleet)
+    speeds_kmh = vehicles['Velocidad (km/h)'].fillna(vehicles['Tipo'].map(CLASS_SPEEDS_KMH))
+    speeds_kmh = speeds_kmh.where(~vehicles['Tipo'].isin(TRAFFIC_CLASSES), speeds_kmh / traffic_factor)
+    if (speeds_kmh <= 0).any():
+        raise ValueError("La velocidad de todos los vehículos debe ser mayor que 0.")
+    return pd.DataFrame({
+        'Tipo': vehicles['Tipo'],
+        'capacity': vehicles['Capacidad'].fillna(vehicle_capacity).astype(int),
+        'speed_ms': speeds_kmh * (1000 / 3600),
+        'shift_s': (vehicles['Jornada (h)'].fillna(max_work_hours) * 3600).astype(int),
+        'start': vehicles['Inicio'],
+        'end': vehicles['Fin'],
+        'name': vehicles['Recurso'],
+    })
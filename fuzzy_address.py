@@ -0,0 +1,210 @@
+import os
+import re
+import unicodedata
+import numpy as np
+import pandas as pd
+
+# --- CONFIGURATION ---
+# Dice similarity (shared trigrams) at which a fuzzy match is accepted without review
+FUZZY_ACCEPT_SCORE = 0.85
+# ...and only if it beats the next-best office by at least this much
+FUZZY_ACCEPT_MARGIN = 0.05
+# Below this a candidate is not even suggested
+FUZZY_SUGGEST_SCORE = 0.5
+FUZZY_TOP_K = 3
+
+# Common Peruvian address abbreviations -> canonical word (after accents/punctuation are removed)
+ABBREVIATIONS = {
+    'av': 'avenida', 'avda': 'avenida', 'avenida': 'avenida',
+    'ca': 'calle', 'cl': 'calle', 'cll': 'calle', 'calle': 'calle',
+    'jr': 'jiron', 'jiron': 'jiron',
+    'psje': 'pasaje', 'pje': 'pasaje', 'pj': 'pasaje', 'pasaje': 'pasaje',
+    'urb': 'urbanizacion',
+    'mz': 'manzana', 'mza': 'manzana',
+    'lt': 'lote', 'lte': 'lote',
+    'aahh': 'asentamiento humano', 'aah': 'asentamiento humano', 'ah': 'asentamiento humano',
+    'asoc': 'asociacion',
+    'prol': 'prolongacion',
+    'sect': 'sector', 'sec': 'sector',
+    'cp': 'centro poblado',
+    'coop': 'cooperativa',
+    'sn': 'sn', 's/n': 'sn',
+    'nro': '', 'num': '',
+}
+
+# UTF-8 read as Latin-1 ("EspaÃ±a"), after lower() has already been applied
+MOJIBAKE = {
+    'ã¡': 'á', 'ã©': 'é', 'ã\xad': 'í', 'ã³': 'ó', 'ãº': 'ú', 'ã±': 'ñ', 'ã¼': 'ü',
+    'ã\x81': 'á', 'ã‰': 'é', 'ã\x8d': 'í', 'ã“': 'ó', 'ãš': 'ú', 'ã‘': 'ñ', 'âº': 'º', 'â°': '°',
+}
+_MOJIBAKE_RE = re.compile("|".join(re.escape(k) for k in sorted(MOJIBAKE, key=len, reverse=True)))
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:/[a-z0-9]+)?")
+_NUMBER_RE = re.compile(r"\d+")
+
+
+def fix_mojibake(text):
+    """Undoes UTF-8 text that was decoded as Latin-1, also when it was lowercased afterwards."""
+    if 'Ã' in text or 'Â' in text:
+        # Windows exports use cp1252 ("Ã‘"), others plain Latin-1 ("Ã±")
+        for codec in ('cp1252', 'latin-1'):
+            try:
+                text = text.encode(codec).decode('utf-8')
+                break
+            except (UnicodeEncodeError, UnicodeDecodeError):
+                pass
+    if 'ã' in text or 'â' in text:
+        text = _MOJIBAKE_RE.sub(lambda m: MOJIBAKE[m.group(0)], text)
+    return text
+
+
+def canonical_address(text):
+    """
+    Comparable form of an address or office name: mojibake repaired, accents
+    removed, lower case, abbreviations expanded, punctuation dropped.
+    "Av. España 123" and "AVENIDA ESPAÃ‘A 123" both become "avenida espana 123".
+    """
+    text = fix_mojibake(str(text)).lower()
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii')
+    # "aa.hh." / "c.p." style abbreviations: join dotted letters before tokenizing
+    text = re.sub(r"\b((?:[a-z]{1,2}\.){2,})", lambda m: m.group(1).replace('.', ''), text)
+    words = []
+    for token in _TOKEN_RE.findall(text):
+        word = ABBREVIATIONS.get(token, token)
+        if word:
+            words.append(word)
+    return " ".join(words)
+
+
+def address_numbers(canonical):
+    """House/block/lot numbers of a canonical address, in order ("jiron puno 1021 mz 3" -> ('1021', '3'))."""
+    return tuple(str(int(n)) for n in _NUMBER_RE.findall(canonical))
+
+
+def trigrams(text):
+    """Distinct character trigrams of a canonical string, padded so short words still count."""
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TrigramIndex:
+    """
+    Character-trigram inverted index over the master DB's canonical addresses/names.
+
+    Postings are stored CSR-style (offsets + one flat int32 array of document ids),
+    so scoring a query is a concatenation of a few postings lists and one bincount.
+    Score = Dice coefficient of the trigram sets: 2 * shared / (|query| + |doc|).
+    """
+
+    def __init__(self, doc_rows, doc_sizes, vocabulary, offsets, postings, doc_texts):
+        self.doc_rows = doc_rows
+        self.doc_sizes = doc_sizes
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.postings = postings
+        self.doc_texts = doc_texts
+
+    @classmethod
+    def build(cls, master, columns=('domicilio', 'Nombre')):
+        """One document per distinct (canonical text, master row) of the given columns."""
+        frames = []
+        for col in columns:
+            if col in master.columns:
+                values = master[col]
+                frames.append(pd.DataFrame({'text': values[values.notna()].astype(str).map(canonical_address).to_numpy(),
+                                            'row': np.flatnonzero(values.notna().to_numpy())}))
+        docs = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame({'text': [], 'row': []})
+        docs = docs[docs['text'] != ""].drop_duplicates(['text', 'row'], keep='first')
+        doc_texts = docs['text'].tolist()
+
+        vocabulary = {}
+        doc_ids, gram_ids, sizes = [], [], []
+        for doc_id, text in enumerate(doc_texts):
+            grams = trigrams(text)
+            sizes.append(len(grams))
+            for g in grams:
+                gram_ids.append(vocabulary.setdefault(g, len(vocabulary)))
+            doc_ids.extend([doc_id] * len(grams))
+
+        gram_ids = np.asarray(gram_ids, dtype=np.int32)
+        order = np.argsort(gram_ids, kind='stable')
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(gram_ids, minlength=len(vocabulary)), out=offsets[1:])
+        postings = np.asarray(doc_ids, dtype=np.int32)[order]
+        return cls(docs['row'].to_numpy(dtype=np.int32), np.asarray(sizes, dtype=np.int32),
+                   vocabulary, offsets, postings, doc_texts)
+
+    def __len__(self):
+        return len(self.doc_rows)
+
+    def save(self, path, token=""):
+        """Writes the index as .npz; `token` identifies the master version it was built from."""
+        terms = np.empty(len(self.vocabulary), dtype=object)
+        for gram, i in self.vocabulary.items():
+            terms[i] = gram
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, doc_rows=self.doc_rows, doc_sizes=self.doc_sizes, terms=terms.astype(str),
+                 offsets=self.offsets, postings=self.postings, doc_texts=np.array(self.doc_texts, dtype=str),
+                 token=np.array(token))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, token=""):
+        """Index saved by save(), or None if missing, unreadable or built for another version."""
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if str(data['token']) != token:
+                    return None
+                vocabulary = {gram: i for i, gram in enumerate(data['terms'].tolist())}
+                return cls(data['doc_rows'], data['doc_sizes'], vocabulary, data['offsets'],
+                           data['postings'], data['doc_texts'].tolist())
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def search(self, text, top_k=FUZZY_TOP_K, min_score=FUZZY_SUGGEST_SCORE):
+        """Best master rows for one address: [(row, score, matched canonical text), ...], best first."""
+        query = canonical_address(text)
+        grams = trigrams(query) if query else set()
+        ids = [self.vocabulary[g] for g in grams if g in self.vocabulary]
+        if not ids:
+            return []
+        hits = np.concatenate([self.postings[self.offsets[i]:self.offsets[i + 1]] for i in ids])
+        shared = np.bincount(hits, minlength=len(self.doc_rows))
+        candidates = np.flatnonzero(shared)
+        scores = 2.0 * shared[candidates] / (len(grams) + self.doc_sizes[candidates])
+
+        keep = scores >= min_score
+        candidates, scores = candidates[keep], scores[keep]
+        if len(candidates) > top_k * 4:
+            best = np.argpartition(-scores, top_k * 4)[:top_k * 4]
+            candidates, scores = candidates[best], scores[best]
+        results, seen = [], set()
+        for pos in np.argsort(-scores, kind='stable'):
+            row = int(self.doc_rows[candidates[pos]])
+            if row in seen:
+                continue
+            seen.add(row)
+            results.append((row, float(scores[pos]), self.doc_texts[candidates[pos]]))
+            if len(results) == top_k:
+                break
+        return results
+
+    def match_many(self, values, accept_score=FUZZY_ACCEPT_SCORE, accept_margin=FUZZY_ACCEPT_MARGIN):
+        """
+        Fuzzy-resolves distinct unmatched inputs. Returns a DataFrame indexed by input with
+        row (-1 if not accepted), score and the best candidate row/text for the review report.
+
+        A candidate is only accepted when its numbers are exactly those of the input and it
+        clearly beats the runner-up: trigrams barely see "123" vs "125", so a near miss on
+        the house number would otherwise send the walker to the neighbouring office.
+        Rejected candidates are still returned as suggestions.
+        """
+        records = []
+        for value in pd.unique(pd.Series(values, dtype=object)):
+            found = self.search(value, top_k=2)
+            row, score, text = found[0] if found else (-1, 0.0, "")
+            runner_up = found[1][1] if len(found) > 1 else 0.0
+            accepted = (score >= accept_score and score - runner_up >= accept_margin
+                        and address_numbers(canonical_address(value)) == address_numbers(text))
+            records.append({'input': value, 'row': row if accepted else -1,
+                            'candidate_row': row, 'score': round(score, 3), 'candidate': text})
+        return pd.DataFrame(records, columns=['input', 'row', 'candidate_row', 'score', 'candidate']).set_index('input')
@@ -0,0 +1,210 @@
+import os
+import json
+import shutil
+import hashlib
+import pandas as pd
+
+from address_index import AddressIndex
+from fuzzy_address import TrigramIndex
+
+# --- CONFIGURATION ---
+MASTER_FILE_PATH = "Base Arequipa .xlsx"
+MASTER_SHEET = 'Hoja2'
+# Compiled copies of the master workbook (typed, columns already mapped)
+MASTER_SNAPSHOT_DIR = "cache_maestra"
+# Bump when prepare_master changes, so old snapshots are rebuilt
+SNAPSHOT_FORMAT = 1
+
+# COLUMN MAPPING (New DB -> App Schema)
+# We map: Lat -> Latitud (y), Long -> Longitud (x), gerencia -> Habla a
+RENAME_MAP = {
+    'Lat': 'Latitud (y)',
+    'Long': 'Longitud (x)',
+    'gerencia': 'Habla a'
+}
+
+
+class MasterStore:
+    """
+    Read-only master DB plus the lookups built from it, created once per workbook
+    version and shared by every session of the process (st.cache_resource).
+    Nothing here is mutated. Sessions do not copy `df`: their ticket table
+    (st.session_state.daily_tickets) keeps only the TICKET_COLUMNS of each ticket,
+    a small per-ticket frame, since tickets may be edited or entered by hand.
+    """
+
+    def __init__(self, df, address_index=None, fuzzy_index=None):
+        self.df = df
+        self.name_col = 'domicilio' if 'domicilio' in df.columns else 'Nombre'
+        self.names = df[self.name_col].astype(str).to_numpy()
+        # Normalized key -> int32 row position, and district suffixes for the import fallback
+        self.address_index = address_index if address_index is not None else AddressIndex.build(df)
+        # Trigram index for addresses that still do not match exactly
+        self.fuzzy_index = fuzzy_index if fuzzy_index is not None else TrigramIndex.build(df)
+        self.clients = sorted(df['Habla a'].astype(str).unique().tolist()) if 'Habla a' in df.columns else []
+
+    def __len__(self):
+        return len(self.df)
+
+
+def source_version(path):
+    """Cheap change token for the workbook (mtime, size); None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def prepare_master(df):
+    """Column clean-up applied once, before the snapshot is written."""
+    df.columns = df.columns.str.strip()
+    df = df.rename(columns=RENAME_MAP)
+    # FORCE NUMERIC
+    for col in ['Latitud (y)', 'Longitud (x)']:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+    return df
+
+
+def read_master_workbook(path):
+    """Slow path: parses the workbook with openpyxl."""
+    try:
+        df = pd.read_excel(path, sheet_name=MASTER_SHEET)
+    except PermissionError:
+        # File might be open. Copy to temp and read.
+        try:
+            temp_path = "temp_master_copy.xlsm" # Consider renaming to .xlsx if source is xlsx
+            shutil.copy2(path, temp_path)
+        except Exception as e:
+            raise PermissionError(f"No se pudo copiar el archivo abierto: {e}") from e
+        df = pd.read_excel(temp_path, sheet_name=MASTER_SHEET)
+    return prepare_master(df)
+
+
+def file_digest(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _snapshot_paths(path, snapshot_dir):
+    stem = os.path.splitext(os.path.basename(path))[0].strip().replace(" ", "_") or "master"
+    return os.path.join(snapshot_dir, stem + ".meta.json"), os.path.join(snapshot_dir, stem)
+
+
+def _write_snapshot(df, data_base):
+    """Parquet when pyarrow can type every column, pickle otherwise. Returns the file written."""
+    try:
+        data_path = data_base + ".parquet"
+        tmp_path = data_path + ".tmp"
+        df.to_parquet(tmp_path, index=False)
+    except (ImportError, ValueError, TypeError) as e:
+        # No pyarrow, or a column mixing types (e.g. numeric and text Ids)
+        print(f"Parquet snapshot not possible ({e}). Using pickle.")
+        data_path = data_base + ".pkl"
+        tmp_path = data_path + ".tmp"
+        df.to_pickle(tmp_path)
+    os.replace(tmp_path, data_path)
+    return data_path
+
+
+def _read_snapshot(data_path):
+    if data_path.endswith(".parquet"):
+        return pd.read_parquet(data_path)
+    return pd.read_pickle(data_path)
+
+
+def _write_meta(meta_path, meta):
+    tmp_path = meta_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
+
+def _read_meta(meta_path):
+    """Snapshot meta if it is present, current format and its data file exists; None otherwise."""
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get('format') == SNAPSHOT_FORMAT and os.path.exists(meta.get('data', '')):
+            return meta
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def load_master_snapshot(path, snapshot_dir=MASTER_SNAPSHOT_DIR):
+    """
+    Master DB from the compiled snapshot when the workbook is unchanged, otherwise
+    parses the workbook once and writes a new snapshot.
+
+    The snapshot is valid while the workbook's mtime and size match (no read at all),
+    or, if those changed (file copied/touched), while its SHA-1 still matches.
+    Returns None if the workbook does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+    meta_path, data_base = _snapshot_paths(path, snapshot_dir)
+    stat = os.stat(path)
+
+    meta = _read_meta(meta_path)
+
+    digest = None
+    if meta is not None:
+        if meta['mtime_ns'] == stat.st_mtime_ns and meta['size'] == stat.st_size:
+            return _read_snapshot(meta['data'])
+        digest = file_digest(path)
+        if meta['sha1'] == digest:
+            df = _read_snapshot(meta['data'])
+            meta.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+            try:
+                _write_meta(meta_path, meta)
+            except OSError:
+                pass
+            return df
+
+    print(f"Compiling master DB snapshot from {path}...")
+    digest = digest or file_digest(path)
+    df = read_master_workbook(path)
+    try:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        data_path = _write_snapshot(df, data_base)
+        _write_meta(meta_path, {'format': SNAPSHOT_FORMAT, 'source': os.path.abspath(path), 'sha1': digest,
+                                'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'data': data_path})
+    except OSError as e:
+        # Read-only deployments still work, just without the fast path
+        print(f"Could not write master DB snapshot: {e}")
+    return df
+
+
+def open_master_store(path, snapshot_dir=MASTER_SNAPSHOT_DIR):
+    """
+    MasterStore for the workbook: snapshot frame plus its AddressIndex and
+    TrigramIndex, each loaded from <snapshot>.index.npz / .fuzzy.npz when it was
+    built from the same workbook (SHA-1), otherwise built once and saved there.
+    None if the workbook does not exist.
+    """
+    df = load_master_snapshot(path, snapshot_dir)
+    if df is None:
+        return None
+    meta_path, data_base = _snapshot_paths(path, snapshot_dir)
+    meta = _read_meta(meta_path)
+    if meta is None:
+        # Snapshot could not be written (read-only deployment): index in memory only
+        return MasterStore(df)
+
+    indexes = []
+    for cls, suffix in ((AddressIndex, ".index.npz"), (TrigramIndex, ".fuzzy.npz")):
+        index_path = data_base + suffix
+        index = cls.load(index_path, token=meta['sha1'])
+        if index is None:
+            index = cls.build(df)
+            try:
+                index.save(index_path, token=meta['sha1'])
+            except OSError as e:
+                print(f"Could not write {cls.__name__}: {e}")
+        indexes.append(index)
+    return MasterStore(df, *indexes)
@@ -0,0 +1,310 @@
+import os
+import json
+import time
+import queue
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import pandas as pd
+
+from vrp_solver import solve_vrp_data
+from vrp_decomposition import solve_vrp_decomposed
+from vrp_incremental import solve_vrp_incremental
+from vrp_portfolio import solve_vrp_portfolio, spawn_context, worker_main
+from route_result import RouteResult
+from fleet import normalize_fleet, FLEET_COLUMNS
+from walker_bases import BASE_PREFIX
+from time_windows import WINDOW_COLUMNS, DAY_START
+from distance_cache import DistanceCache, DISTANCE_CACHE_DIR
+from solution_store import SolutionStore, SOLUTION_STORE_DIR
+
+# --- CONFIGURATION ---
+# Solver processes per "Calcular Rutas" run (each city/district group is one job)
+DEFAULT_SOLVER_WORKERS = max(1, min(4, os.cpu_count() or 1))
+# One JSON line per solved group (solver profile), to compare time limits and spot regressions across days
+SOLVER_PROFILE_LOG = "perfil_solver.jsonl"
+
+GROUP_KEYS = ['Nombre', 'Latitud (y)', 'Longitud (x)', 'Habla a', 'Provincia', 'Distrito']
+
+DEPARTMENT_DEPOTS = {
+    "AREQUIPA": (-16.398803, -71.536906), # Plaza de Armas Arequipa
+    "LIMA": (-12.046374, -77.042793), # Plaza Mayor Lima
+    "CUSCO": (-13.516806, -71.979043), # Plaza de Armas Cusco
+    "LA LIBERTAD": (-8.111867, -79.028689), # Plaza de Armas Trujillo
+    "LAMBAYEQUE": (-6.771373, -79.840883), # Parque Principal Chiclayo
+    "PIURA": (-5.194493, -80.632821), # Plaza de Armas Piura
+    "JUNIN": (-12.065133, -75.204863), # Plaza Constitución Huancayo
+    "ANCASH": (-9.527376, -77.528414), # Plaza de Armas Huaraz
+    "ICA": (-14.063852, -75.729092), # Plaza de Armas Ica
+    "TACNA": (-18.013998, -70.252378), # Plaza de Armas Tacna
+    "PUNO": (-15.840291, -70.028249), # Plaza de Armas Puno
+    "CAJAMARCA": (-7.163784, -78.500272), # Plaza de Armas Cajamarca
+    "LORETO": (-3.749117, -73.244367), # Plaza de Armas Iquitos
+    "SAN MARTIN": (-6.495000, -76.368300), # Plaza de Armas Tarapoto approx
+    "HUANUCO": (-9.929562, -76.239617), # Plaza de Armas Huánuco
+    "AYACUCHO": (-13.160444, -74.225725) # Plaza Mayor Ayacucho
+}
+
+# Grouping strategies per department (the labels shown in the app)
+STRATEGY_GLOBAL = "Global (Por Ciudad)"
+STRATEGY_DISTRICT = "Por Distrito"
+STRATEGY_ZONES = "Por Zonas (Clusters)"
+STRATEGIES = [STRATEGY_GLOBAL, STRATEGY_DISTRICT, STRATEGY_ZONES]
+
+
+def group_offices(tickets):
+    """One row per office, summing its tickets. Opening hours: the latest opening and earliest closing of its tickets."""
+    windows = {}
+    if all(c in tickets.columns for c in WINDOW_COLUMNS):
+        # "HH:MM" strings sort as times; empty cells are skipped
+        windows = {WINDOW_COLUMNS[0]: 'max', WINDOW_COLUMNS[1]: 'min'}
+    return tickets.groupby(GROUP_KEYS).agg({
+        'Importe de la entrega': 'sum',
+        'Ticket': lambda x: ', '.join(x.astype(str)),
+        'Familia': lambda x: ', '.join(x.unique()),
+        **({'Id': 'first'} if 'Id' in tickets.columns else {}),
+        **windows
+    }).reset_index()
+
+
+def build_group_frame(tickets, depot_name, depot_lat, depot_lon, city, depot_district):
+    """Solver input for one group: depot row first, then the grouped offices."""
+    depot_row = pd.DataFrame([{
+        'Nombre': depot_name,
+        'Latitud (y)': depot_lat,
+        'Longitud (x)': depot_lon,
+        'Habla a': 'JLMarketing',
+        'Importe de la entrega': 0,
+        'Ticket': 'Inicio',
+        'Familia': 'Base',
+        'Provincia': city,
+        'Distrito': depot_district
+    }])
+    return pd.concat([depot_row, group_offices(tickets)], ignore_index=True)
+
+
+def city_group(city_tickets, city, strategy, districts):
+    """
+    Solver input for one department under a strategy: (group label, use_zones, frame).
+        Global / Zonas   tickets of the `districts` list, depot at the department capital
+                         (the tickets' mean point for departments without a known capital)
+        Por Distrito     tickets of the single district `districts`, depot at their mean point
+    Raises ValueError (message for the user) when there is nothing to solve.
+    """
+    if strategy in (STRATEGY_GLOBAL, STRATEGY_ZONES):
+        # Default to all if missing
+        if not districts:
+            districts = sorted(city_tickets['Distrito'].unique())
+        group_tickets = city_tickets[city_tickets['Distrito'].isin(districts)]
+        if group_tickets.empty:
+            raise ValueError(f"No hay tickets en los distritos seleccionados para {city} (Global).")
+        
+        # Depot Location (Department Capital)
+        depot_lat, depot_lon = DEPARTMENT_DEPOTS.get(city, (-16.398803, -71.536906))
+        if city not in DEPARTMENT_DEPOTS and city != "Desconocida":
+            depot_lat = group_tickets['Latitud (y)'].mean()
+            depot_lon = group_tickets['Longitud (x)'].mean()
+        
+        use_zones = strategy == STRATEGY_ZONES
+        df_final = build_group_frame(group_tickets, f'DEPOT {city} (Plaza de Armas)', depot_lat, depot_lon, city, 'BASE')
+        return ("Zonas" if use_zones else "Global"), use_zones, df_final
+
+    if strategy == STRATEGY_DISTRICT:
+        if not districts:
+            raise ValueError(f"No se seleccionó ningún distrito para {city}.")
+        group_tickets = city_tickets[city_tickets['Distrito'] == districts]
+        if group_tickets.empty:
+            raise ValueError(f"No hay tickets en {districts}.")
+        # Depot: Mean of district (Start/End in district)
+        df_final = build_group_frame(group_tickets, f'DEPOT {city}-{districts} (Calculado: Promedio de Tickets)',
+                                     group_tickets['Latitud (y)'].mean(), group_tickets['Longitud (x)'].mean(),
+                                     city, districts)
+        return districts, False, df_final
+
+    raise ValueError(f"Estrategia desconocida para {city}: {strategy}")
+
+
+def add_walker_bases(df_final, bases, fleet=None):
+    """
+    Walkers that start and end at their own base (home or assigned base) instead of the group depot.
+    bases: the department's walkers (walker_bases.city_bases). One depot row per walker
+    ("BASE <name>") is appended to df_final, and the fleet gets one walker per base
+    starting and ending there, with the walker's e-mail (or name) as its Recurso.
+    Non-walker rows of `fleet` are kept; its first walker row (if any) gives the
+    capacity, speed and shift of the walkers.
+    Returns (df_final, fleet table).
+    """
+    walker_defaults = {}
+    kept_rows = []
+    if fleet is not None:
+        fleet_walkers = fleet[fleet['Tipo'] == 'Walker']
+        if not fleet_walkers.empty:
+            walker_defaults = fleet_walkers.iloc[0][['Capacidad', 'Velocidad (km/h)', 'Jornada (h)']].to_dict()
+        kept_rows = fleet[fleet['Tipo'] != 'Walker'].to_dict('records')
+
+    taken = set(df_final['Nombre'].astype(str))
+    depot_rows, walker_rows = [], []
+    for _, walker in bases.iterrows():
+        # Unique row name: two walkers may share a name, an office may be called like one
+        name, n = f"{BASE_PREFIX} {walker['Encuestador']}", 2
+        while name in taken:
+            name, n = f"{BASE_PREFIX} {walker['Encuestador']} ({n})", n + 1
+        taken.add(name)
+        depot_rows.append({
+            'Nombre': name,
+            'Latitud (y)': walker['Latitud (y)'],
+            'Longitud (x)': walker['Longitud (x)'],
+            'Habla a': walker['Encuestador'],
+            'Importe de la entrega': 0,
+            'Ticket': 'Inicio',
+            'Familia': 'Base',
+            'Provincia': df_final['Provincia'].iat[0],
+            'Distrito': walker['Distrito'] or 'BASE',
+        })
+        walker_rows.append({**walker_defaults, 'Tipo': 'Walker', 'Numero de vehiculos': 1, 'Inicio': name, 'Fin': name,
+                            'Recurso': walker['Correo'] or walker['Encuestador']})
+    df_final = pd.concat([df_final, pd.DataFrame(depot_rows)], ignore_index=True)
+    return df_final, normalize_fleet(pd.DataFrame(kept_rows + walker_rows, columns=FLEET_COLUMNS))
+
+
+def group_solver_kwargs(city, service_time, max_work_hours, max_seconds, max_distance_km, traffic_factor=1.0,
+                        fleet=None, day_start=DAY_START):
+    """
+    solve_vrp_data keyword arguments shared by every group of a department: adaptive
+    time budget under max_seconds, its distance cache and its solution store.
+    fleet: the department's fleet table (fleet.city_fleet), or None for num_walkers walkers.
+    day_start: shift start ("HH:MM"), the reference of the offices' opening hours.
+    """
+    return dict(
+        traffic_factor=traffic_factor,
+        service_time_per_ticket_mins=service_time, max_work_hours=max_work_hours, day_start=day_start,
+        max_seconds=max_seconds, adaptive_time=True,
+        max_distance_km=max_distance_km,
+        fleet=fleet,
+        distance_cache=DistanceCache(DISTANCE_CACHE_DIR, city),
+        # Warm start from earlier solves of (nearly) the same offices
+        solution_store=SolutionStore(SOLUTION_STORE_DIR, city)
+    )
+
+
+def build_job(city, group, df_final, num_walkers, max_capacity, use_zones, solver_kwargs, previous=None,
+              portfolio_workers=0):
+    """Job dict for solve_group / run_solve_jobs."""
+    return {
+        'city': city,
+        'group': group,
+        'df_final': df_final,
+        'num_walkers': num_walkers,
+        'max_capacity': max_capacity,
+        'use_zones': use_zones,
+        'portfolio_workers': portfolio_workers,
+        'solver_kwargs': solver_kwargs,
+        # Last routes of this group, if re-optimizing incrementally
+        'previous': previous
+    }
+
+
+def solve_group(job, status_callback=None):
+    """
+    Process pool worker: solves one city/district group and returns its RouteResult (None if unsolved).
+    job: dict with city, group, df_final, num_walkers, max_capacity, use_zones and
+    solver_kwargs (extra keyword arguments for solve_vrp_data). With 'previous' (the
+    group's last RouteResult) the group is re-planned incrementally from it. With
+    'portfolio_workers' > 1 a global group is solved by a portfolio race of that many processes.
+    status_callback(message) receives the solver's progress messages.
+    """
+    started = time.monotonic()
+    solver_kwargs = job['solver_kwargs']
+    if status_callback is not None:
+        solver_kwargs = {**solver_kwargs, 'status_callback': status_callback}
+    if job.get('previous') is not None:
+        solution, routing, manager, data, df_loc = solve_vrp_incremental(
+            job['df_final'], 0, job['num_walkers'], job['max_capacity'], job['previous'], **solver_kwargs)
+    elif not job.get('use_zones') and job.get('portfolio_workers', 0) > 1:
+        solution, routing, manager, data, df_loc = solve_vrp_portfolio(
+            job['df_final'], 0, job['num_walkers'], job['max_capacity'], workers=job['portfolio_workers'],
+            **solver_kwargs)
+    else:
+        solve_fn = solve_vrp_decomposed if job.get('use_zones') else solve_vrp_data
+        solution, routing, manager, data, df_loc = solve_fn(
+            job['df_final'], 0, job['num_walkers'], job['max_capacity'], **solver_kwargs)
+    if not solution:
+        return None
+    # Only the compact result leaves this function; the model and matrices are released here
+    result = RouteResult.from_solution(solution, routing, manager, data, df_loc, job['city'], job['group'])
+    if result.profile is not None:
+        result.profile['total_seconds'] = round(time.monotonic() - started, 3)
+    return result
+
+
+# Progress queue of a pool worker process (set by _init_pool_worker)
+_status_queue = None
+
+
+def _init_pool_worker(status_queue):
+    global _status_queue
+    _status_queue = status_queue
+
+
+def _solve_pooled_group(i, job):
+    """solve_group in a pool worker; its progress messages go back to run_solve_jobs as (i, message)."""
+    return solve_group(job, status_callback=lambda message: _status_queue.put((i, message)))
+
+
+def run_solve_jobs(jobs, max_workers=DEFAULT_SOLVER_WORKERS, on_done=None, on_status=None):
+    """
+    Solves every job, in parallel processes when max_workers > 1.
+    With a single worker (or job) the solve runs in this process.
+    on_done(finished_count, job, result) is called in this process as each job finishes,
+    on_status(job, message) with each progress message of a job's solve.
+    Returns results in job order.
+    """
+    results = [None] * len(jobs)
+    if max_workers <= 1 or len(jobs) <= 1:
+        for i, job in enumerate(jobs):
+            callback = (lambda message, job=job: on_status(job, message)) if on_status else None
+            results[i] = solve_group(job, status_callback=callback)
+            if on_done: on_done(i + 1, job, results[i])
+        return results
+
+    ctx = spawn_context()
+    status_queue = ctx.Queue()
+    finished_jobs = set()
+
+    def forward_status():
+        while True:
+            try:
+                i, message = status_queue.get_nowait()
+            except queue.Empty:
+                return
+            # Late messages of a finished job would overwrite its on_done progress
+            if on_status and i not in finished_jobs:
+                on_status(jobs[i], message)
+
+    try:
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(jobs)), mp_context=ctx,
+                                 initializer=_init_pool_worker, initargs=(status_queue,)) as pool:
+            # Workers are spawned on submit, so all of them start from worker_main()
+            with worker_main():
+                futures = {pool.submit(_solve_pooled_group, i, job): i for i, job in enumerate(jobs)}
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                forward_status()
+                for future in done:
+                    i = futures[future]
+                    results[i] = future.result()
+                    finished_jobs.add(i)
+                    if on_done: on_done(len(finished_jobs), jobs[i], results[i])
+    finally:
+        status_queue.close()
+        status_queue.cancel_join_thread()
+    return results
+
+
+def append_profiles(results, path=SOLVER_PROFILE_LOG):
+    """Appends the solver profile of every solved group to a JSON lines file (date, city, group, profile)."""
+    stamp = time.strftime("%Y-%m-%dT%H:%M:%S")
+    with open(path, "a", encoding="utf-8") as f:
+        for res in results:
+            if res is None or getattr(res, 'profile', None) is None:
+                continue
+            f.write(json.dumps({'timestamp': stamp, 'city': res.city, 'group': res.group, **res.profile}) + "\n")
@@ -0,0 +1,163 @@
+import numpy as np
+
+
+class RouteResult:
+    """
+    Compact, picklable result of one group solve (city or city-district).
+
+    Routes are stored CSR-style: route r covers positions offsets[r]:offsets[r+1] of the
+    flat per-stop arrays (start depot ... end depot). Cumulative values are measured
+    from the route start at each stop:
+        nodes       node index into `stops` (the cleaned solver input, depot = row 0)
+        arrival_s   travel + service time (seconds), same as the arc cost, plus the
+                    wait at offices that open later (time_windows; shift start = 0)
+        load        tickets served so far
+        distance_m  meters walked/driven
+    vehicle_names holds the fleet table's 'Recurso' of each route (None when unnamed).
+    profile holds the solver telemetry of the solve (vrp_solver.record_profile), or None.
+    No OR-Tools objects or N x N matrices are kept, so it is cheap to hold in
+    session_state and to send back from worker processes.
+    """
+
+    def __init__(self, city, group, stops, vehicle_ids, vehicle_types, offsets, nodes, arrival_s, load, distance_m, dropped,
+                 profile=None, vehicle_names=None):
+        self.city = city
+        self.group = group
+        self.stops = stops
+        self.vehicle_ids = vehicle_ids
+        self.vehicle_types = vehicle_types
+        self.offsets = offsets
+        self.nodes = nodes
+        self.arrival_s = arrival_s
+        self.load = load
+        self.distance_m = distance_m
+        self.dropped = dropped
+        self.profile = profile
+        self.vehicle_names = vehicle_names if vehicle_names is not None else [None] * len(vehicle_ids)
+        self._views = None
+
+    def __getstate__(self):
+        # Views are rebuilt lazily: they hold one DataFrame per route
+        state = self.__dict__.copy()
+        state['_views'] = None
+        return state
+
+    @classmethod
+    def from_solution(cls, solution, routing, manager, data, df_loc, city, group):
+        """Walks every used vehicle once and copies what the UI and exports need."""
+        demands = data['demands']
+        dist = data['distance_matrix']
+        depots = set(data['depot_nodes'])
+        # Earliest arrival schedule: a walker reaching an office before it opens waits there
+        opens = data.get('window_open')
+
+        vehicle_ids, vehicle_types, vehicle_names, offsets = [], [], [], [0]
+        nodes, arrival_s, load, distance_m = [], [], [], []
+        for vehicle_id in range(data['num_vehicles']):
+            if not routing.IsVehicleUsed(solution, vehicle_id): continue
+
+            index = routing.Start(vehicle_id)
+            node = manager.IndexToNode(index)
+            t, q, d = 0, 0, 0
+            while True:
+                nodes.append(node)
+                arrival_s.append(t)
+                load.append(q)
+                distance_m.append(d)
+                if routing.IsEnd(index):
+                    break
+                previous_index, previous_node = index, node
+                index = solution.Value(routing.NextVar(index))
+                node = manager.IndexToNode(index)
+                t += routing.GetArcCostForVehicle(previous_index, index, vehicle_id)
+                if opens is not None and not routing.IsEnd(index):
+                    t = max(t, int(opens[node]))
+                q += demands[node] if not routing.IsEnd(index) else 0
+                d += int(dist[previous_node][node])
+
+            vehicle_ids.append(vehicle_id)
+            vehicle_types.append(data['vehicle_types'][vehicle_id])
+            vehicle_names.append(data['vehicle_names'][vehicle_id])
+            offsets.append(len(nodes))
+
+        visited = np.zeros(len(demands), dtype=bool)
+        visited[nodes] = True
+        dropped = [n for n in np.flatnonzero(~visited) if n not in depots]
+
+        return cls(
+            city, group, df_loc.reset_index(drop=True),
+            np.asarray(vehicle_ids, dtype=np.int32), vehicle_types,
+            np.asarray(offsets, dtype=np.int64), np.asarray(nodes, dtype=np.int32),
+            np.asarray(arrival_s, dtype=np.int32), np.asarray(load, dtype=np.int32),
+            np.asarray(distance_m, dtype=np.int32), np.asarray(dropped, dtype=np.int32),
+            profile=data.get('profile'), vehicle_names=vehicle_names)
+
+    @property
+    def num_routes(self):
+        return len(self.vehicle_ids)
+
+    def route_slice(self, r):
+        """Positions of route r in the flat per-stop arrays."""
+        return slice(self.offsets[r], self.offsets[r + 1])
+
+    def route_nodes(self, r):
+        return self.nodes[self.route_slice(r)]
+
+    def route_distance_m(self, r):
+        return int(self.distance_m[self.offsets[r + 1] - 1])
+
+    def route_duration_s(self, r):
+        return int(self.arrival_s[self.offsets[r + 1] - 1])
+
+    def route_load(self, r):
+        return int(self.load[self.offsets[r + 1] - 1])
+
+    def route_views(self):
+        """
+        Everything the results stage draws, built in one pass over the flat arrays
+        using vectorized take on the stop columns. One dict per route with:
+            vehicle_id, vehicle_type, vehicle_name, distance_km, load, stops
+            geometry   [(lat, lon), ...] start depot ... end depot
+            markers    [(lat, lon, popup), ...] start depot + visits
+            itinerary  DataFrame of visits (columns expected by render_route_details)
+        Memoized, so Streamlit reruns only redraw.
+        """
+        if self._views is not None:
+            return self._views
+
+        lats = self.stops['Latitud (y)'].to_numpy(dtype=float)
+        lons = self.stops['Longitud (x)'].to_numpy(dtype=float)
+        popups = (self.stops['Nombre'].astype(str) + " (" + self.stops['Habla a'].astype(str) + ") - "
+                  + (self.stops['Ticket'].astype(str) if 'Ticket' in self.stops.columns else "")).to_numpy()
+
+        views = []
+        for r in range(self.num_routes):
+            sl = self.route_slice(r)
+            nodes = self.nodes[sl]
+            route_lats, route_lons = lats.take(nodes), lons.take(nodes)
+            visits = nodes[1:-1]
+
+            itinerary = self.stops.take(visits).reset_index(drop=True)
+            itinerary['AccumulatedDuration_Mins'] = self.arrival_s[sl][1:-1] // 60
+            # Names expected by render_route_details / assignments.json
+            itinerary['LocationName'] = itinerary['Nombre']
+            if 'Habla a' in itinerary.columns:
+                itinerary['Client'] = itinerary['Habla a']
+            itinerary['Latitude'] = route_lats[1:-1]
+            itinerary['Longitude'] = route_lons[1:-1]
+            itinerary['OrderInRoute'] = np.arange(1, len(visits) + 1)
+
+            views.append({
+                'vehicle_id': int(self.vehicle_ids[r]),
+                'vehicle_type': self.vehicle_types[r],
+                'vehicle_name': self.vehicle_names[r],
+                'distance_km': self.route_distance_m(r) / 1000,
+                'load': self.route_load(r),
+                'stops': len(visits),
+                'geometry': list(zip(route_lats.tolist(), route_lons.tolist())),
+                'markers': list(zip(route_lats[:-1].tolist(), route_lons[:-1].tolist(), popups.take(nodes[:-1]).tolist())),
+                'itinerary': itinerary
+            })
+
+        self._views = views
+        return views
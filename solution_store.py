@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+
+# --- CONFIGURATION ---
+SOLUTION_STORE_DIR = "cache_soluciones"
+# Solutions kept per namespace (city); the oldest are dropped first
+MAX_SOLUTIONS_PER_CITY = 60
+# Smallest office overlap (Jaccard) for a prior solution to be worth seeding from
+MIN_WARM_START_OVERLAP = 0.5
+
+
+def fingerprint(keys):
+    """Order-independent fingerprint of a set of office keys."""
+    h = hashlib.sha1()
+    for k in sorted(set(keys)):
+        h.update(k.encode("utf-8"))
+        h.update(b"\n")
+    return h.hexdigest()[:16]
+
+
+class SolutionStore:
+    """
+    Routes of previous solves per namespace (city), keyed by the fingerprint of the
+    grouped office set, to warm-start the next solve of the same or a similar set.
+
+    Layout on disk:
+        <store_dir>/<namespace>/<fingerprint>.json -> offices, routes (office keys per vehicle), objective
+
+    Routes are stored as office keys (distance_cache.office_key), not node numbers,
+    so they can be mapped onto any later model. Only holds paths, so it can be
+    pickled to worker processes.
+    """
+
+    def __init__(self, store_dir=SOLUTION_STORE_DIR, namespace="default"):
+        self.store_dir = store_dir
+        self.namespace = str(namespace).strip().upper().replace(os.sep, "_") or "DEFAULT"
+
+    @property
+    def root(self):
+        return os.path.join(self.store_dir, self.namespace)
+
+    def _entries(self):
+        try:
+            names = [n for n in os.listdir(self.root) if n.endswith(".json")]
+        except OSError:
+            return []
+        return [os.path.join(self.root, n) for n in names]
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def closest(self, keys, min_overlap=MIN_WARM_START_OVERLAP):
+        """
+        Prior solution for this office set: the exact fingerprint if stored, otherwise
+        the one sharing the most offices (Jaccard >= min_overlap). Returns the entry
+        dict (with 'routes' and 'overlap') or None.
+        """
+        keys = set(keys)
+        if not keys:
+            return None
+        exact = self._read(os.path.join(self.root, fingerprint(keys) + ".json"))
+        if exact is not None:
+            exact['overlap'] = 1.0
+            return exact
+
+        best, best_overlap = None, min_overlap
+        for path in self._entries():
+            entry = self._read(path)
+            if entry is None:
+                continue
+            offices = set(entry.get('offices', []))
+            overlap = len(keys & offices) / len(keys | offices)
+            if overlap >= best_overlap:
+                best, best_overlap = entry, overlap
+        if best is not None:
+            best['overlap'] = best_overlap
+        return best
+
+    def save(self, keys, routes, objective):
+        """Stores routes (office keys per vehicle) for this office set, replacing an older one."""
+        os.makedirs(self.root, exist_ok=True)
+        entry = {'offices': sorted(set(keys)), 'routes': routes, 'objective': int(objective), 'saved': time.time()}
+        path = os.path.join(self.root, fingerprint(keys) + ".json")
+        tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+        self._prune()
+
+    def _prune(self):
+        entries = self._entries()
+        if len(entries) <= MAX_SOLUTIONS_PER_CITY:
+            return
+        entries.sort(key=lambda p: os.path.getmtime(p) if os.path.exists(p) else 0)
+        for path in entries[:len(entries) - MAX_SOLUTIONS_PER_CITY]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import time
+import uuid
+import pickle
+import shutil
+import subprocess
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from route_planning import run_solve_jobs, append_profiles
+
+# --- CONFIGURATION ---
+SOLVE_QUEUE_DIR = "cola_optimizacion"
+# Runs solved at the same time by this server; later submissions wait in the queue.
+# Each run still solves its groups with its own process pool (run_solve_jobs).
+MAX_CONCURRENT_RUNS = 1
+# Finished runs kept on disk; the oldest are deleted first
+MAX_KEPT_RUNS = 50
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+STATE_LABELS = {QUEUED: "En cola", RUNNING: "En proceso", DONE: "Terminado", FAILED: "Fallido"}
+
+
+class SolveQueue:
+    """
+    Local job queue for "Calcular Rutas" runs, independent of the Streamlit session
+    that submitted them. A run is the list of group jobs of one click; it gets an id
+    and a directory:
+        <queue_dir>/<run_id>/input.pkl     jobs (deleted once the run finishes)
+        <queue_dir>/<run_id>/status.json   state, progress, message, owner, timestamps
+        <queue_dir>/<run_id>/results.pkl   list of RouteResult
+    Runs execute on a thread pool of max_concurrent threads, so the host never solves
+    more than that many runs at once. Each thread only waits for its run's own solver
+    process (`python solve_queue.py <queue_dir> <run_id>`, see execute_run): under
+    Streamlit, processes spawned from the server would re-import the page (app.py is
+    __main__ there) and a solve in a server thread would hold the GIL.
+    Sessions only poll status(); a page reload just reads the same files again. After a
+    server restart, queued runs are resumed and runs that were in progress are marked failed.
+    """
+
+    def __init__(self, queue_dir=SOLVE_QUEUE_DIR, max_concurrent=MAX_CONCURRENT_RUNS):
+        self.queue_dir = queue_dir
+        os.makedirs(queue_dir, exist_ok=True)
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="solve-queue")
+        self._recover()
+
+    def _path(self, run_id, name):
+        return run_path(self.queue_dir, run_id, name)
+
+    def _write_status(self, run_id, **changes):
+        return write_status(self.queue_dir, run_id, **changes)
+
+    def status(self, run_id):
+        """Status dict of a run, or None if it does not exist."""
+        return read_status(self.queue_dir, run_id)
+
+    def results(self, run_id):
+        """RouteResult list of a finished run, or None."""
+        try:
+            with open(self._path(run_id, "results.pkl"), "rb") as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def runs(self, owner=None, limit=10):
+        """Most recent runs (status dicts, newest first), optionally only those of `owner`."""
+        try:
+            run_ids = sorted(os.listdir(self.queue_dir), reverse=True)
+        except OSError:
+            return []
+        found = []
+        for run_id in run_ids:
+            status = self.status(run_id)
+            if status is None or (owner is not None and status.get('owner') != owner):
+                continue
+            found.append(status)
+            if len(found) == limit:
+                break
+        return found
+
+    def position(self, run_id):
+        """Runs submitted earlier that are still waiting or solving (0 = next / running)."""
+        return sum(1 for s in self.runs(limit=MAX_KEPT_RUNS)
+                   if s['run_id'] < run_id and s['state'] in (QUEUED, RUNNING))
+
+    def submit(self, jobs, owner="", max_workers=1, label=""):
+        """Queues the jobs of one run; returns its id."""
+        # Sortable by submission time
+        run_id = time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+        os.makedirs(os.path.join(self.queue_dir, run_id))
+        with open(self._path(run_id, "input.pkl"), "wb") as f:
+            pickle.dump({'jobs': jobs, 'max_workers': max_workers}, f)
+        self._write_status(run_id, owner=owner, label=label, state=QUEUED, groups=len(jobs),
+                           finished_groups=0, progress=0.0, message="En cola", submitted=time.time())
+        self._prune()
+        self._pool.submit(self._run, run_id)
+        return run_id
+
+    def _run(self, run_id):
+        try:
+            completed = subprocess.run([sys.executable, os.path.abspath(__file__), self.queue_dir, run_id])
+            returncode = completed.returncode
+        except OSError as e:
+            returncode = e
+        status = self.status(run_id) or {}
+        if status.get('state') not in (DONE, FAILED):
+            # Killed (memory, task manager) before it could record the outcome itself
+            self._write_status(run_id, state=FAILED, finished=time.time(),
+                               message=f"Error calculando rutas: el proceso de optimización terminó inesperadamente ({returncode})")
+        try:
+            os.remove(self._path(run_id, "input.pkl"))
+        except OSError:
+            pass
+
+    def _recover(self):
+        """Picks up runs left by a previous server process."""
+        for status in reversed(self.runs(limit=MAX_KEPT_RUNS)):
+            run_id = status['run_id']
+            if status['state'] == RUNNING:
+                self._write_status(run_id, state=FAILED, message="Interrumpido: el servidor se reinició")
+            elif status['state'] == QUEUED and os.path.exists(self._path(run_id, "input.pkl")):
+                self._pool.submit(self._run, run_id)
+
+    def _prune(self):
+        finished = [s['run_id'] for s in self.runs(limit=10 ** 6) if s['state'] in (DONE, FAILED)]
+        for run_id in finished[MAX_KEPT_RUNS:]:
+            shutil.rmtree(os.path.join(self.queue_dir, run_id), ignore_errors=True)
+
+
+def run_path(queue_dir, run_id, name):
+    return os.path.join(queue_dir, run_id, name)
+
+
+def read_status(queue_dir, run_id):
+    try:
+        with open(run_path(queue_dir, run_id, "status.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_status(queue_dir, run_id, **changes):
+    """Merges `changes` into the run's status.json (atomic replace, so readers never see half a file)."""
+    status = read_status(queue_dir, run_id) or {'run_id': run_id}
+    status.update(changes)
+    path = run_path(queue_dir, run_id, "status.json")
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(status, f)
+    os.replace(tmp_path, path)
+    return status
+
+
+def execute_run(queue_dir, run_id):
+    """Solves one queued run (its solver process): reads input.pkl, writes progress, results.pkl and the outcome."""
+    try:
+        with open(run_path(queue_dir, run_id, "input.pkl"), "rb") as f:
+            run_input = pickle.load(f)
+        jobs = run_input['jobs']
+        write_status(queue_dir, run_id, state=RUNNING, started=time.time(), pid=os.getpid(),
+                     message=f"Resolviendo {len(jobs)} grupos...")
+
+        def group_name(job):
+            return job['city'] if job['group'] in ("Global", "Zonas") else f"{job['city']}-{job['group']}"
+
+        def on_done(finished, job, result):
+            write_status(queue_dir, run_id, finished_groups=finished, progress=finished / max(1, len(jobs)),
+                         message=f"Finalizado {group_name(job)}")
+
+        def on_status(job, message):
+            # Progress within a group (matrix, zones, portfolio...), shown until the next one
+            write_status(queue_dir, run_id, message=f"{group_name(job)}: {message}")
+
+        results = run_solve_jobs(jobs, max_workers=run_input['max_workers'], on_done=on_done, on_status=on_status)
+        solved = [r for r in results if r is not None]
+        with open(run_path(queue_dir, run_id, "results.pkl"), "wb") as f:
+            pickle.dump(solved, f)
+        # Solver telemetry of the day, one JSON line per group
+        try:
+            append_profiles(solved)
+        except OSError as e:
+            print(f"Could not write solver profile log: {e}")
+        write_status(queue_dir, run_id, state=DONE, progress=1.0, finished=time.time(), solved=len(solved),
+                     message=f"{len(solved)} de {len(jobs)} grupos resueltos")
+        return 0
+    except Exception as e:
+        traceback.print_exc()
+        write_status(queue_dir, run_id, state=FAILED, finished=time.time(), message=f"Error calculando rutas: {e}")
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(execute_run(sys.argv[1], sys.argv[2]))
@@ -0,0 +1,169 @@
+import io
+import numpy as np
+import pandas as pd
+
+from address_index import normalize_keys, match_addresses, build_ticket_frame, empty_tickets
+from time_windows import ticket_windows, WINDOW_COLUMNS
+
+# --- CONFIGURATION ---
+# Rows parsed, matched and released at a time during a bulk import
+IMPORT_CHUNK_ROWS = 2000
+
+
+def detect_columns(columns):
+    """(col_oficina, col_ticket, col_familia) guessed from the upload headers; None when missing."""
+    # Guess column names - Prioritize Domicilio/Direccion
+    col_oficina = next((c for c in columns if 'domicilio' in c.lower() or 'direccion' in c.lower()), None)
+    if not col_oficina:
+        col_oficina = next((c for c in columns if 'oficina' in c.lower() or 'nombre' in c.lower()), None)
+    col_ticket = next((c for c in columns if 'ticket' in c.lower() or 'numero' in c.lower()), None)
+    col_familia = next((c for c in columns if 'familia' in c.lower()), None)
+    return col_oficina, col_ticket, col_familia
+
+
+def _header(values):
+    # Same names pd.read_excel gives to blank headers
+    return [str(v).strip() if v is not None else f"Unnamed: {i}" for i, v in enumerate(values)]
+
+
+def _upload_size(upload):
+    size = getattr(upload, 'size', None)
+    if size is None:
+        pos = upload.tell()
+        size = upload.seek(0, io.SEEK_END)
+        upload.seek(pos)
+    return max(int(size), 1)
+
+
+def iter_upload_chunks(upload, name, chunk_rows=IMPORT_CHUNK_ROWS):
+    """
+    Yields (chunk DataFrame, progress 0..1) without parsing the whole file first.
+        .csv   pandas chunked reader, progress = bytes consumed
+        .xlsx  openpyxl read-only row iterator, progress = rows / sheet dimension
+        .xls   no streaming reader exists: parsed at once, then sliced
+    """
+    upload.seek(0)
+    lower = name.lower()
+    if lower.endswith('.csv'):
+        size = _upload_size(upload)
+        for chunk in pd.read_csv(upload, chunksize=chunk_rows):
+            yield chunk, min(upload.tell() / size, 1.0)
+
+    elif lower.endswith(('.xlsx', '.xlsm')):
+        from openpyxl import load_workbook
+        wb = load_workbook(upload, read_only=True, data_only=True)
+        try:
+            ws = wb.worksheets[0]
+            total = max((ws.max_row or 0) - 1, 1)
+            rows = ws.iter_rows(values_only=True)
+            columns = _header(next(rows, ()))
+            width = len(columns)
+            done, buffer = 0, []
+            for values in rows:
+                if all(v is None for v in values):
+                    continue
+                buffer.append(tuple(values[:width]) + (None,) * (width - len(values)))
+                if len(buffer) >= chunk_rows:
+                    done += len(buffer)
+                    yield pd.DataFrame(buffer, columns=columns), min(done / total, 1.0)
+                    buffer = []
+            if buffer:
+                yield pd.DataFrame(buffer, columns=columns), 1.0
+        finally:
+            wb.close()
+
+    else:
+        df = pd.read_excel(upload)
+        for start in range(0, len(df), chunk_rows):
+            yield df.iloc[start:start + chunk_rows], min((start + chunk_rows) / max(len(df), 1), 1.0)
+
+
+def read_preview(upload, name, rows=3):
+    """First rows of the upload, for the preview, without reading the rest."""
+    upload.seek(0)
+    if name.lower().endswith('.csv'):
+        df = pd.read_csv(upload, nrows=rows)
+    elif name.lower().endswith(('.xlsx', '.xlsm')):
+        df = next(iter_upload_chunks(upload, name, chunk_rows=rows), (pd.DataFrame(), 1.0))[0]
+    else:
+        df = pd.read_excel(upload, nrows=rows)
+    upload.seek(0)
+    return df
+
+
+def match_chunk(chunk, columns, master_store):
+    """
+    Resolves one chunk of the upload against the shared MasterStore.
+    Returns (new tickets, unmatched rows for the report, fuzzy matches to review).
+    """
+    col_oficina, col_ticket, col_familia = columns
+    master_db = master_store.df
+    # Same normalization as the master keys: stripped, lower case, blanks -> ""
+    inputs = normalize_keys(chunk[col_oficina]).set_axis(chunk.index)
+    rows = match_addresses(inputs, master_store.address_index)
+
+    # Fuzzy pass over what is still missing (trigram index, see fuzzy_address.py)
+    missing = rows < 0
+    fuzzy = master_store.fuzzy_index.match_many(inputs[missing])
+    rows[missing] = inputs[missing].map(fuzzy['row']).to_numpy(dtype=np.int32)
+    fuzzy_accepted = fuzzy[fuzzy['row'] >= 0]
+    matched = rows >= 0
+
+    new_tickets = build_ticket_frame(
+        master_db, rows[matched],
+        chunk.loc[matched, col_ticket].to_numpy() if col_ticket else np.full(matched.sum(), "N/A"),
+        chunk.loc[matched, col_familia].to_numpy() if col_familia else np.full(matched.sum(), "General"))
+    # Opening hours from the upload, else from the master DB office
+    windows = ticket_windows(chunk[matched], master_db.iloc[rows[matched]])
+    if windows is not None:
+        new_tickets[WINDOW_COLUMNS] = windows.to_numpy()
+
+    # Record failures
+    df_unmatched = chunk[~matched].copy()
+    df_unmatched['Razón'] = 'No encontrado en Base Maestra'
+    df_unmatched['Input Normalizado'] = inputs[~matched]
+    # Best candidate that was not auto-accepted (low score, other number, close runner-up), to speed up manual fixing
+    names = master_store.names
+    candidate_rows = inputs[~matched].map(fuzzy['candidate_row']).fillna(-1).astype(int)
+    df_unmatched['Sugerencia'] = [names[r] if r >= 0 else "" for r in candidate_rows]
+    df_unmatched['Similitud'] = inputs[~matched].map(fuzzy['score']).fillna(0).to_numpy()
+
+    df_fuzzy = pd.DataFrame({
+        'Dirección Ingresada': fuzzy_accepted.index,
+        'Coincidencia en Base': names[fuzzy_accepted['row'].to_numpy()],
+        'Similitud': fuzzy_accepted['score'].to_numpy()
+    })
+    return new_tickets, df_unmatched, df_fuzzy
+
+
+def import_tickets(upload, name, master_store, on_progress=None):
+    """
+    Streams the whole upload through match_chunk.
+    Returns (tickets, unmatched rows, fuzzy matches to review); raises ValueError if
+    no address column is found. on_progress(progress 0..1, tickets so far, unmatched so far)
+    is called after every chunk.
+    """
+    columns = None
+    ticket_parts, unmatched_parts, fuzzy_parts = [], [], []
+    added = unmatched = 0
+    for chunk, progress in iter_upload_chunks(upload, name):
+        chunk.columns = chunk.columns.astype(str)
+        if columns is None:
+            # Column Mapping Logic
+            # We need 'Domicilio' (to match Master DB), 'Ticket', 'Familia'
+            columns = detect_columns(list(chunk.columns))
+            if not columns[0]:
+                raise ValueError("No se encontró columna para 'Domicilio', 'Direccion' o 'Oficina'.")
+
+        new_tickets, df_unmatched, df_fuzzy = match_chunk(chunk, columns, master_store)
+        ticket_parts.append(new_tickets)
+        unmatched_parts.append(df_unmatched)
+        fuzzy_parts.append(df_fuzzy)
+        added += len(new_tickets)
+        unmatched += len(df_unmatched)
+        if on_progress: on_progress(progress, added, unmatched)
+
+    tickets = pd.concat(ticket_parts, ignore_index=True) if ticket_parts else empty_tickets()
+    df_unmatched = pd.concat(unmatched_parts, ignore_index=True) if unmatched_parts else pd.DataFrame()
+    fuzzy_accepted = pd.concat(fuzzy_parts, ignore_index=True).drop_duplicates() if fuzzy_parts else pd.DataFrame()
+    return tickets, df_unmatched, fuzzy_accepted
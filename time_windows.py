@@ -0,0 +1,187 @@
+import datetime
+import re
+import unicodedata
+import numpy as np
+import pandas as pd
+
+# --- CONFIGURATION ---
+# Office opening hours, as "HH:MM" clock times in these ticket / solver input columns
+# (empty = no limit on that side). An office with several tickets keeps the
+# intersection of their windows (latest opening, earliest closing).
+WINDOW_COLUMNS = ['Hora apertura', 'Hora cierre']
+# Header names recognized in the ticket upload and the master DB, compared whole
+# after normalizing (lowercase, no accents, units in parentheses and "de" dropped)
+OPEN_ALIASES = ('hora apertura', 'apertura', 'abre', 'hora inicio', 'desde')
+CLOSE_ALIASES = ('hora cierre', 'cierre', 'cierra', 'hora fin', 'hasta')
+# Single column holding both ends, e.g. "09:00-13:00"
+HOURS_ALIASES = ('horario',)
+# Clock time at which shifts start (Time dimension 0)
+DAY_START = "08:00"
+# Rows per block when checking arcs, as MATRIX_BLOCK_ROWS in vrp_solver
+ARC_BLOCK_ROWS = 256
+
+
+def parse_clock(values):
+    """
+    Seconds since midnight (float, NaN when empty or unreadable) of clock values:
+    "9", "09:30", "9:30:00", "9.5" (hours), datetime.time / Timestamp cells and
+    Excel day fractions (0.375 = 09:00).
+    """
+    def one(value):
+        if value is None or (not isinstance(value, str) and pd.isna(value)):
+            return np.nan
+        if isinstance(value, (datetime.time, datetime.datetime)):
+            return value.hour * 3600 + value.minute * 60 + value.second
+        if isinstance(value, (int, float, np.number)):
+            hours = float(value) * 24 if 0 < float(value) < 1 else float(value)
+            return hours * 3600 if 0 <= hours <= 24 else np.nan
+        text = str(value).strip().lower().replace('h', ':').rstrip(':')
+        if not text:
+            return np.nan
+        try:
+            parts = [float(p) for p in text.split(':')]
+        except ValueError:
+            return np.nan
+        if len(parts) > 3 or not 0 <= parts[0] <= 24:
+            return np.nan
+        return sum(p * s for p, s in zip(parts, (3600, 60, 1)))
+    return np.array([one(v) for v in values], dtype=float)
+
+
+def format_clock(seconds):
+    """"HH:MM" strings (None where NaN) for seconds since midnight; zero-padded, so they sort as times."""
+    return [None if pd.isna(s) else f"{int(s) // 3600:02d}:{int(s) % 3600 // 60:02d}" for s in seconds]
+
+
+def _header_name(column):
+    """Normalized header: "Hora de Cierre (HH:MM)" -> "hora cierre"."""
+    text = unicodedata.normalize('NFKD', str(column)).encode('ascii', 'ignore').decode().lower()
+    text = re.sub(r'\(.*?\)', ' ', text)
+    return " ".join(w for w in re.split(r'[\s_.:]+', text) if w and w != 'de')
+
+
+def _split_hours(values):
+    """(open, close) text Series of "09:00-13:00" / "9 a 13" cells."""
+    ends = values.astype(str).str.replace(' a ', '-', regex=False).str.split('-', n=1, expand=True)
+    ends = ends.reindex(columns=[0, 1])
+    return ends[0], ends[1]
+
+
+def detect_window_columns(df):
+    """
+    (col_open, col_close, col_hours) of a frame, None when missing. Headers must match
+    an alias whole (so "Fecha de cierre" is not a closing time) and the column must
+    hold at least one readable time ("Hasta nuevo aviso" notes are skipped).
+    """
+    names = {c: _header_name(c) for c in df.columns}
+
+    def readable(column, hours):
+        values = df[column]
+        if hours:
+            return any(np.isfinite(parse_clock(side)).any() for side in _split_hours(values))
+        return np.isfinite(parse_clock(values)).any()
+
+    def find(aliases, hours=False):
+        return next((c for a in aliases for c in df.columns if names[c] == a and readable(c, hours)), None)
+    return find(OPEN_ALIASES), find(CLOSE_ALIASES), find(HOURS_ALIASES, hours=True)
+
+
+def read_windows(df):
+    """
+    WINDOW_COLUMNS frame ("HH:MM" or None, same index as df) from the window
+    columns of an upload or master DB frame. All None when df has none.
+    """
+    col_open, col_close, col_hours = detect_window_columns(df)
+    opens = parse_clock(df[col_open]) if col_open else np.full(len(df), np.nan)
+    closes = parse_clock(df[col_close]) if col_close else np.full(len(df), np.nan)
+    if col_hours:
+        # "09:00-13:00" / "9 a 13": fills the sides without their own column
+        open_text, close_text = _split_hours(df[col_hours])
+        opens = np.where(np.isnan(opens), parse_clock(open_text), opens)
+        closes = np.where(np.isnan(closes), parse_clock(close_text), closes)
+    return pd.DataFrame({WINDOW_COLUMNS[0]: format_clock(opens), WINDOW_COLUMNS[1]: format_clock(closes)},
+                        index=df.index)
+
+
+def ticket_windows(upload_rows, master_rows):
+    """
+    Opening hours of imported tickets (WINDOW_COLUMNS, positional with the rows): the
+    upload's own columns first, the master DB office's where the upload leaves them
+    empty. None when neither has window columns.
+    """
+    sources = [read_windows(df).reset_index(drop=True) for df in (upload_rows, master_rows)
+               if any(detect_window_columns(df))]
+    if not sources:
+        return None
+    windows = sources[0]
+    for more in sources[1:]:
+        windows = windows.fillna(more)
+    return windows
+
+
+def has_windows(df):
+    return all(c in df.columns for c in WINDOW_COLUMNS) and df[WINDOW_COLUMNS].notna().to_numpy().any()
+
+
+def window_seconds(df_loc, horizon, day_start=DAY_START):
+    """
+    (open_s, close_s) int64 arrays, seconds after the shift start (day_start), per row
+    of the solver input. Missing sides become 0 / horizon; windows that open before the
+    shift start at 0 and closing times before it stay negative (never reachable).
+    """
+    n = len(df_loc)
+    if not all(c in df_loc.columns for c in WINDOW_COLUMNS):
+        return np.zeros(n, dtype=np.int64), np.full(n, horizon, dtype=np.int64)
+    start = parse_clock([day_start])[0]
+    start = 0 if np.isnan(start) else start
+    opens = parse_clock(df_loc[WINDOW_COLUMNS[0]]) - start
+    closes = parse_clock(df_loc[WINDOW_COLUMNS[1]]) - start
+    open_s = np.where(np.isnan(opens), 0, np.maximum(opens, 0)).astype(np.int64)
+    close_s = np.where(np.isnan(closes), horizon, np.minimum(closes, horizon)).astype(np.int64)
+    return open_s, close_s
+
+
+def unreachable_offices(distance_matrix, starts, ends, speeds_ms, shifts, service_s, open_s, close_s, offices):
+    """
+    Vectorized pre-check before the model is built: offices no vehicle can serve in
+    their window, i.e. for every vehicle either it cannot arrive (straight from its
+    start depot) before closing, or serving there (waiting for the opening if early)
+    and going straight back to its end depot overruns its shift. Vehicles with the
+    same depots, speed and shift are checked once. Returns the sorted node array.
+    """
+    offices = np.asarray(offices, dtype=np.int64)
+    if len(offices) == 0:
+        return offices
+    profiles = pd.DataFrame({'start': starts, 'end': ends, 'speed': speeds_ms, 'shift': shifts}).drop_duplicates()
+    service_s = np.asarray(service_s, dtype=np.int64)
+    speeds = profiles['speed'].to_numpy()[:, None]
+    # Same whole seconds as the transit matrices (vrp_solver.build_time_matrix)
+    arrival = np.floor(distance_matrix[np.ix_(profiles['start'], offices)] / speeds) + service_s[profiles['start']][:, None]
+    back = np.floor(distance_matrix[np.ix_(offices, profiles['end'])].T / speeds) + service_s[offices]
+    begin = np.maximum(arrival, open_s[offices])
+    feasible = (arrival <= close_s[offices]) & (begin + back <= profiles['shift'].to_numpy()[:, None])
+    empty = open_s[offices] > close_s[offices]
+    return np.sort(offices[~feasible.any(axis=0) | empty])
+
+
+def infeasible_arcs(fastest_time_matrix, open_s, close_s, nodes, horizon):
+    """
+    Arc pruning by reachability: for each node i (of `nodes`), the nodes j that can
+    never follow it, because even the fastest vehicle leaving i right at its opening
+    (transit includes the service at i) arrives at j after j closes. Only nodes with a
+    closing time (close_s below horizon) can be unreachable. Returns {i: array of j}
+    for nodes with at least one pruned successor.
+    """
+    nodes = np.asarray(nodes, dtype=np.int64)
+    targets = nodes[close_s[nodes] < horizon]
+    pruned = {}
+    if len(targets) == 0:
+        return pruned
+    for start in range(0, len(nodes), ARC_BLOCK_ROWS):
+        rows = nodes[start:start + ARC_BLOCK_ROWS]
+        late = open_s[rows][:, None] + fastest_time_matrix[np.ix_(rows, targets)] > close_s[targets]
+        late &= rows[:, None] != targets  # never prune the node itself (inactive)
+        for i, mask in zip(rows, late):
+            if mask.any():
+                pruned[int(i)] = targets[mask]
+    return pruned
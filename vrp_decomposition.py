@@ -0,0 +1,242 @@
+import math
+import time
+import numpy as np
+import pandas as pd
+from ortools.constraint_solver import routing_enums_pb2
+
+from fleet import default_fleet, one_per_vehicle
+from vrp_solver import (solve_vrp_data, build_vrp_model, adaptive_time_budget, ObjectiveTrace, record_profile,
+                        nearest_neighbors, restrict_to_candidates, KNN_NEIGHBORS, clean_locations,
+                        location_demands, depot_nodes_of, haversine_block)
+from vrp_incremental import remember_solution, close_model_for_restore
+
+# --- CONFIGURATION ---
+# Below these sizes a group is solved in one piece
+CLUSTER_MAX_LOCATIONS = 250
+CLUSTER_MAX_VEHICLES = 6
+# Share of max_seconds spent on the boundary repair pass over the whole group
+REPAIR_TIME_SHARE = 0.25
+MIN_CLUSTER_SECONDS = 2
+
+
+def split_counts(total, weights, minimum=1):
+    """Splits `total` into len(weights) integers proportional to weights (largest remainder)."""
+    weights = np.asarray(weights, dtype=float)
+    k = len(weights)
+    if k == 0:
+        return np.zeros(0, dtype=int)
+    base = np.full(k, min(minimum, total // k), dtype=int)
+    rest = total - base.sum()
+    if rest <= 0 or weights.sum() <= 0:
+        return base
+    share = weights / weights.sum() * rest
+    counts = base + np.floor(share).astype(int)
+    leftover = total - counts.sum()
+    counts[np.argsort(-(share - np.floor(share)))[:leftover]] += 1
+    return counts
+
+
+def share_vehicles(classes, vehicles_per_cluster, costs=None):
+    """
+    Cluster of each vehicle: cluster c gets vehicles_per_cluster[c] vehicles and every
+    class (cars, motorbikes, walkers) is spread over the clusters in proportion to their size.
+    costs: optional (vehicle x cluster) array, e.g. how far each vehicle's depots are
+    from each cluster; within a class the cheapest pairs are taken first, so walkers
+    starting from their own base work the zone nearest to it.
+    """
+    classes = np.asarray(classes)
+    room = np.asarray(vehicles_per_cluster, dtype=int).copy()
+    cluster_of = np.empty(len(classes), dtype=int)
+    for v_class in pd.unique(classes):
+        members = np.flatnonzero(classes == v_class)
+        counts = np.minimum(split_counts(len(members), room, minimum=0), room)
+        # Vehicles cut by the cap go to the clusters with the most room left
+        for c in np.argsort(-(room - counts)):
+            extra = min(len(members) - counts.sum(), room[c] - counts[c])
+            if extra <= 0:
+                break
+            counts[c] += extra
+        if costs is None:
+            cluster_of[members] = np.repeat(np.arange(len(room)), counts)
+        else:
+            left = counts.copy()
+            unassigned = set(members.tolist())
+            pair_costs = np.asarray(costs)[members]
+            for flat in np.argsort(pair_costs, axis=None, kind='stable'):
+                m, c = divmod(int(flat), len(room))
+                if members[m] in unassigned and left[c] > 0:
+                    cluster_of[members[m]] = c
+                    unassigned.discard(members[m])
+                    left[c] -= 1
+        room -= counts
+    return cluster_of
+
+
+def sweep_clusters(lats, lons, demands, depot_lat, depot_lon, num_clusters):
+    """
+    Geographic clusters by angular sweep around the depot, cut so every cluster
+    carries about the same demand. Returns a cluster label per location.
+    """
+    n = len(lats)
+    if num_clusters <= 1 or n == 0:
+        return np.zeros(n, dtype=int)
+    # Local planar projection around the depot
+    x = (np.asarray(lons) - depot_lon) * math.cos(math.radians(depot_lat))
+    y = np.asarray(lats) - depot_lat
+    angles = np.arctan2(y, x)
+    order = np.argsort(angles)
+    # Start the sweep at the widest empty sector so no dense area is cut in two
+    sorted_angles = angles[order]
+    gaps = np.diff(np.concatenate([sorted_angles, sorted_angles[:1] + 2 * math.pi]))
+    order = np.roll(order, -((int(np.argmax(gaps)) + 1) % n))
+
+    weights = np.maximum(np.asarray(demands, dtype=float)[order], 1)
+    cum = np.cumsum(weights)
+    labels_sorted = np.minimum((cum - weights / 2) * num_clusters // cum[-1], num_clusters - 1).astype(int)
+    labels = np.empty(n, dtype=int)
+    labels[order] = labels_sorted
+    return labels
+
+
+def solve_vrp_decomposed(df_loc, num_cars, num_walkers, vehicle_capacity, start_node_index=0, max_seconds=30,
+                         status_callback=None, adaptive_time=False, **model_kwargs):
+    """
+    Cluster-first, route-second solve for department-scale groups.
+
+    1. Offices (every row but the depots) are split into demand-balanced sweep clusters,
+       as many as needed so each has at most CLUSTER_MAX_LOCATIONS offices and
+       CLUSTER_MAX_VEHICLES vehicles.
+    2. Vehicles are shared out by cluster demand and each cluster is solved as an
+       independent small VRP, built from that cluster's rows only.
+    3. The cluster routes seed the full model and a short local search (restricted to
+       nearest neighbours) repairs the boundaries between neighbouring clusters.
+
+    Limitation: the repair model of step 3 is still the dense N x N model (one native
+    transit matrix per speed class), because OR-Tools only registers dense matrices and
+    callers get one model over the whole group; only its NextVar domains are sparse.
+    It is built after the cluster solves, so they never hold it in memory.
+
+    With a fleet table every vehicle class is shared out proportionally, and each
+    cluster model also holds the depot rows its vehicles start / end at.
+    Takes the same arguments as solve_vrp_data and returns the same tuple. With
+    adaptive_time the whole group gets adaptive_time_budget() seconds and every
+    cluster solve stops early on its own plateau.
+    """
+    if adaptive_time:
+        max_seconds = adaptive_time_budget(len(df_loc), max_seconds)
+    # Same cleaning as build_vrp_model, so cluster and full model share node numbers
+    df_loc = clean_locations(df_loc)
+    # Global vehicle v = row v (same order as build_vrp_model)
+    fleet = model_kwargs.pop('fleet', None)
+    if fleet is None:
+        fleet = default_fleet(num_cars, num_walkers, vehicle_capacity)
+    vehicles = one_per_vehicle(fleet)
+    num_vehicles = len(vehicles)
+    starts, ends = depot_nodes_of(df_loc, vehicles['Inicio'], vehicles['Fin'], start_node_index)
+    depot_nodes = set(starts) | set(ends) | {start_node_index}
+    offices = np.array([i for i in range(len(df_loc)) if i not in depot_nodes], dtype=int)
+    num_clusters = max(math.ceil(len(offices) / CLUSTER_MAX_LOCATIONS), math.ceil(num_vehicles / CLUSTER_MAX_VEHICLES))
+    num_clusters = min(num_clusters, num_vehicles, len(offices))
+
+    if num_clusters <= 1:
+        return solve_vrp_data(df_loc, num_cars, num_walkers, vehicle_capacity, start_node_index=start_node_index,
+                              max_seconds=max_seconds, status_callback=status_callback,
+                              adaptive_time=adaptive_time, fleet=fleet, **model_kwargs)
+
+    # Dense domains in the full model; they are cut to nearest neighbours plus the stitched arcs before the repair
+    model_kwargs.pop('knn_neighbors', None)
+    # Zones seed themselves from the clusters; the store only records the final routes
+    solution_store = model_kwargs.pop('solution_store', None)
+    if status_callback: status_callback(f"Dividiendo en {num_clusters} zonas...")
+    demands = np.asarray(location_demands(df_loc))
+    lats = df_loc['Latitud (y)'].to_numpy(dtype=float)
+    lons = df_loc['Longitud (x)'].to_numpy(dtype=float)
+
+    depot = df_loc.iloc[start_node_index]
+    labels = sweep_clusters(lats[offices], lons[offices], demands[offices],
+                            depot['Latitud (y)'], depot['Longitud (x)'], num_clusters)
+    cluster_demand = np.bincount(labels, weights=np.maximum(demands[offices], 1), minlength=num_clusters)
+    cluster_sizes = np.bincount(labels, minlength=num_clusters)
+    vehicles_per_cluster = split_counts(num_vehicles, cluster_demand)
+    costs = None
+    if len(depot_nodes) > 1:
+        # Vehicles with their own depots: mean distance from the start and to the end depot over each cluster's offices
+        lats_rad, lons_rad = np.radians(lats), np.radians(lons)
+        depot_legs = (haversine_block(lats_rad[starts], lons_rad[starts], lats_rad[offices], lons_rad[offices])
+                      + haversine_block(lats_rad[ends], lons_rad[ends], lats_rad[offices], lons_rad[offices]))
+        costs = np.stack([depot_legs[:, labels == c].mean(axis=1) if cluster_sizes[c] else np.zeros(num_vehicles)
+                          for c in range(num_clusters)], axis=1)
+    cluster_of_vehicle = share_vehicles(vehicles['Tipo'], vehicles_per_cluster, costs)
+
+    cluster_budget = max_seconds * (1 - REPAIR_TIME_SHARE)
+    search_started = time.monotonic()
+    route_nodes = [[] for _ in range(num_vehicles)]
+
+    for c in range(num_clusters):
+        members = offices[labels == c]
+        c_vehicles = np.flatnonzero(cluster_of_vehicle == c)
+        if len(members) == 0 or len(c_vehicles) == 0:
+            continue
+        # Cluster model: the group depot, the other depots its vehicles use, then its offices
+        c_depots = [start_node_index] + sorted(({starts[v] for v in c_vehicles} | {ends[v] for v in c_vehicles})
+                                               - {start_node_index})
+        c_nodes = np.concatenate([c_depots, members]).astype(int)
+        df_cluster = df_loc.iloc[c_nodes].reset_index(drop=True)
+        c_seconds = max(MIN_CLUSTER_SECONDS, int(cluster_budget * cluster_sizes[c] / len(offices)))
+        if status_callback: status_callback(f"Zona {c + 1}/{num_clusters}: {len(members)} oficinas, {len(c_vehicles)} recursos")
+
+        # Its distances come from its own rows (or the distance cache), never from an N x N matrix
+        c_solution, c_routing, c_manager, c_data, _ = solve_vrp_data(
+            df_cluster, 0, 0, vehicle_capacity, start_node_index=0,
+            max_seconds=c_seconds, adaptive_time=adaptive_time, fleet=vehicles.iloc[c_vehicles], **model_kwargs)
+        if not c_solution:
+            continue
+
+        # Map cluster vehicles/nodes back onto the group's node numbers
+        for v, global_v in enumerate(c_vehicles):
+            index = c_solution.Value(c_routing.NextVar(c_routing.Start(v)))
+            while not c_routing.IsEnd(index):
+                route_nodes[global_v].append(int(c_nodes[c_manager.IndexToNode(index)]))
+                index = c_solution.Value(c_routing.NextVar(index))
+        del c_solution, c_routing, c_manager, c_data
+
+    # --- BOUNDARY REPAIR ---
+    if status_callback: status_callback("Reparando fronteras entre zonas...")
+    routing, manager, data, df_loc, search_parameters = build_vrp_model(
+        df_loc, num_cars, num_walkers, vehicle_capacity, start_node_index=start_node_index,
+        status_callback=status_callback, knn_neighbors=0, fleet=fleet, **model_kwargs)
+    routes = [[manager.NodeToIndex(node) for node in nodes] for nodes in route_nodes]
+    # Sparse repair model: each node keeps its k nearest neighbours plus its successor in the
+    # stitched routes, so the seed stays feasible and boundary moves stay local
+    k = min(KNN_NEIGHBORS, len(df_loc) - 1)
+    candidates = nearest_neighbors(data['distance_matrix'], k, exclude=depot_nodes | set(data['window_rejected']))
+    for nodes in route_nodes:
+        for node, next_node in zip(nodes, nodes[1:]):
+            candidates[node] = np.append(candidates[node], next_node)
+    restrict_to_candidates(routing, manager, candidates, depot_nodes)
+    print(f"Zone repair: arcs restricted to {k} nearest neighbours and the stitched routes (GLS).")
+    data['profile']['sparse_neighbors'] = k
+    search_parameters.local_search_metaheuristic = routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH
+    search_parameters.ls_operator_neighbors_ratio = k / len(df_loc)
+    search_parameters.ls_operator_min_neighbors = k
+    search_parameters.time_limit.seconds = max(1, int(max_seconds * REPAIR_TIME_SHARE))
+    trace = ObjectiveTrace(routing)
+    close_model_for_restore(routing, search_parameters)
+    initial = routing.ReadAssignmentFromRoutes(routes, True)
+    if initial is not None:
+        solution = routing.SolveFromAssignmentWithParameters(initial, search_parameters)
+        # Keep the stitched routes if the repair ran out of time without a solution
+        solution = solution or initial
+    else:
+        print("Stitched cluster routes rejected by the full model. Solving it directly.")
+        search_parameters.time_limit.seconds = max_seconds
+        solution = routing.SolveWithParameters(search_parameters)
+    # Trace of the repair pass, on the same clock as the cluster solves before it
+    offset = trace.started - search_started
+    data['objective_trace'] = [(round(t + offset, 3), o) for t, o in trace.points]
+    record_profile(data, solution, routing, data['objective_trace'], trace.solutions, time.monotonic() - search_started,
+                   solver='zonas', budget_seconds=max_seconds, clusters=num_clusters,
+                   repair_seconds=round(time.monotonic() - trace.started, 3))
+    if solution and solution_store is not None:
+        remember_solution(solution_store, solution, routing, manager, data)
+    return solution, routing, manager, data, df_loc
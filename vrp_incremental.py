@@ -0,0 +1,296 @@
+import time
+import numpy as np
+from ortools.constraint_solver import pywrapcp
+
+from vrp_solver import solve_vrp_data, build_vrp_model, ObjectiveTrace, record_profile
+
+# --- CONFIGURATION ---
+# Local search budget for a mid-day re-plan (the previous routes are already good)
+INCREMENTAL_SECONDS = 3
+# ReadAssignmentFromRoutes runs under the time limit the model was closed with and
+# can burn all of it; restoring a complete set of routes takes milliseconds
+RESTORE_TIME_LIMIT_MS = 200
+
+
+def office_key_of(df):
+    """Identity of an office row across solves: name + coordinates."""
+    return list(zip(df['Nombre'].astype(str),
+                    df['Latitud (y)'].astype(float).round(6),
+                    df['Longitud (x)'].astype(float).round(6)))
+
+
+def seed_routes(prior_routes, node_of, num_vehicles):
+    """
+    Maps routes of office keys (from an earlier solve) onto the nodes of a new model.
+    Offices no longer present are skipped, so are vehicles beyond num_vehicles.
+    Returns (routes as node lists per vehicle, nodes not in any route).
+    """
+    routes = [[] for _ in range(num_vehicles)]
+    kept = set()
+    for v, keys in enumerate(prior_routes[:num_vehicles]):
+        for key in keys:
+            node = node_of.get(key)
+            if node is not None and node not in kept:
+                routes[v].append(node)
+                kept.add(node)
+    return routes, [n for n in node_of.values() if n not in kept]
+
+
+def num_nodes_in(routes):
+    return sum(len(r) for r in routes)
+
+
+def route_cost(path, matrix):
+    path = np.asarray(path)
+    return int(matrix[path[:-1], path[1:]].sum())
+
+
+def route_schedule(path, time_matrix, open_s, close_s, shift):
+    """
+    (begin, latest) service start times along a path (start depot ... end depot):
+    earliest start, waiting for openings, and latest start that still lets every later
+    stop keep its window and the vehicle end its shift.
+    """
+    path = np.asarray(path)
+    transit = time_matrix[path[:-1], path[1:]].astype(np.int64)
+    begin = np.zeros(len(path), dtype=np.int64)
+    latest = np.zeros(len(path), dtype=np.int64)
+    begin[0] = open_s[path[0]]
+    for k in range(1, len(path)):
+        begin[k] = max(open_s[path[k]], begin[k - 1] + transit[k - 1])
+    latest[-1] = min(close_s[path[-1]], shift)
+    for k in range(len(path) - 2, -1, -1):
+        latest[k] = min(close_s[path[k]], latest[k + 1] - transit[k])
+    return begin, latest
+
+
+def cheapest_insertion(routes, new_nodes, data, max_distance=0):
+    """
+    Inserts each new node where it adds the least distance, skipping positions that
+    would break a vehicle's capacity, its shift (data['vehicle_shifts']), the opening
+    hours of the node or of any later stop (data['window_open'] / data['window_close'],
+    arriving early means waiting) or max_distance meters (when > 0). Arcs the model
+    removed (data['pruned_successors']) are never proposed. Nodes that fit nowhere are
+    left out; the solver sees them as dropped and its local search may still insert
+    them. Modifies `routes` (lists of nodes, depots excluded) in place.
+    """
+    if not routes:
+        return routes
+    dist, demands = data['distance_matrix'], data['demands']
+    starts, ends = data['starts'], data['ends']
+    time_of = [data['time_matrices'][c] for c in data['vehicle_classes']]
+    shifts = data['vehicle_shifts']
+    horizon = max(shifts)
+    open_s = data.get('window_open', np.zeros(len(dist), dtype=np.int64))
+    close_s = data.get('window_close', np.full(len(dist), horizon, dtype=np.int64))
+
+    loads = [sum(demands[n] for n in r) for r in routes]
+    paths = [[starts[v]] + r + [ends[v]] for v, r in enumerate(routes)]
+    lengths = [route_cost(p, dist) for p in paths]
+    schedules = [route_schedule(p, time_of[v], open_s, close_s, shifts[v]) for v, p in enumerate(paths)]
+    pruned = data.get('pruned_successors', {})
+    pruned_predecessors = {}
+    for i, late in pruned.items():
+        for j in late:
+            pruned_predecessors.setdefault(int(j), set()).add(i)
+
+    # Far-from-depot nodes first: they have the fewest good positions
+    for node in sorted(new_nodes, key=lambda n: -int(dist[starts[0], n])):
+        best = None
+        for v, r in enumerate(routes):
+            if loads[v] + demands[node] > data['vehicle_capacities'][v]:
+                continue
+            path = np.array([starts[v]] + r + [ends[v]])
+            a, b = path[:-1], path[1:]
+            delta = dist[a, node].astype(np.int64) + dist[node, b] - dist[a, b]
+            begin, latest = schedules[v]
+            at_node = np.maximum(begin[:-1] + time_of[v][a, node], open_s[node])
+            ok = (at_node <= close_s[node]) & (at_node + time_of[v][node, b] <= latest[1:])
+            if node in pruned_predecessors:
+                ok &= ~np.isin(a, list(pruned_predecessors[node]))
+            if node in pruned:
+                ok &= ~np.isin(b, pruned[node])
+            if max_distance > 0:
+                ok &= lengths[v] + delta <= max_distance
+            if not ok.any():
+                continue
+            pos = int(np.argmin(np.where(ok, delta, np.iinfo(np.int64).max)))
+            if best is None or delta[pos] < best[0]:
+                best = (int(delta[pos]), v, pos)
+        if best is None:
+            continue
+        delta, v, pos = best
+        routes[v].insert(pos, node)
+        loads[v] += demands[node]
+        lengths[v] += delta
+        schedules[v] = route_schedule([starts[v]] + routes[v] + [ends[v]], time_of[v], open_s, close_s, shifts[v])
+    return routes
+
+
+def drop_late_stops(routes, data):
+    """
+    Takes out of `routes` (in place) every node the seed cannot keep in this model:
+    reached through an arc the model removed (data['pruned_successors']), after its
+    closing time, or too late to still get back within the vehicle's shift. Seeds saved
+    on a day without opening hours are typical. Returns the nodes taken out, to be
+    inserted again.
+    """
+    pruned = data.get('pruned_successors', {})
+    shifts = data['vehicle_shifts']
+    horizon = max(shifts, default=0)
+    open_s = data.get('window_open', np.zeros(len(data['distance_matrix']), dtype=np.int64))
+    close_s = data.get('window_close', np.full(len(data['distance_matrix']), horizon, dtype=np.int64))
+    removed = []
+    for v, route in enumerate(routes):
+        time_matrix = data['time_matrices'][data['vehicle_classes'][v]]
+        last, clock, kept = data['starts'][v], int(open_s[data['starts'][v]]), []
+        for node in route:
+            begin = max(int(open_s[node]), clock + int(time_matrix[last, node]))
+            if (node in pruned.get(last, ()) or begin > close_s[node]
+                    or begin + time_matrix[node, data['ends'][v]] > shifts[v]):
+                removed.append(node)
+                continue
+            last, clock = node, begin
+            kept.append(node)
+        routes[v] = kept
+    return removed
+
+
+def solution_routes(solution, routing, manager, num_vehicles):
+    """Visited nodes (depots excluded) per vehicle."""
+    routes = []
+    for v in range(num_vehicles):
+        route = []
+        index = solution.Value(routing.NextVar(routing.Start(v)))
+        while not routing.IsEnd(index):
+            route.append(manager.IndexToNode(index))
+            index = solution.Value(routing.NextVar(index))
+        routes.append(route)
+    return routes
+
+
+def close_model_for_restore(routing, search_parameters):
+    """Closes the model with the search parameters, but a short time limit for reading routes back."""
+    params = pywrapcp.DefaultRoutingSearchParameters()
+    params.CopyFrom(search_parameters)
+    params.time_limit.FromMilliseconds(min(RESTORE_TIME_LIMIT_MS, search_parameters.time_limit.ToMilliseconds()))
+    routing.CloseModelWithParameters(params)
+
+
+def warm_start_assignment(routing, manager, data, routes, new_nodes, search_parameters, max_distance=0):
+    """
+    Closes the model and turns seed routes (node lists per vehicle, depots excluded)
+    into an initial assignment: new_nodes are added by cheapest insertion first. If the
+    model rejects that, the seed routes alone are tried (the search then inserts the
+    rest). Returns None when neither is feasible. Modifies `routes` in place.
+    Solve from it with SolveFromAssignmentWithParameters(initial, search_parameters),
+    which restores the full time limit.
+    """
+    # Offices rejected by the time window pre-check are inactive in the model
+    rejected = set(data.get('window_rejected', ()))
+    if rejected:
+        routes[:] = [[n for n in r if n not in rejected] for r in routes]
+        new_nodes = [n for n in new_nodes if n not in rejected]
+    # Seed stops out of their opening hours would reject the whole assignment: re-insert them
+    moved = drop_late_stops(routes, data)
+    if moved:
+        print(f"Warm start: {len(moved)} offices taken out of the seed routes for their opening hours")
+        new_nodes = list(new_nodes) + moved
+    kept_routes = [list(r) for r in routes]
+    cheapest_insertion(routes, new_nodes, data, max_distance=max_distance)
+    close_model_for_restore(routing, search_parameters)
+    initial = routing.ReadAssignmentFromRoutes([[manager.NodeToIndex(n) for n in r] for r in routes], True)
+    if initial is None:
+        # Insertions rejected by a constraint the check above does not see: let the search insert them
+        print("Warm start: seed routes with inserted offices rejected by the model. Trying the seed routes alone.")
+        initial = routing.ReadAssignmentFromRoutes([[manager.NodeToIndex(n) for n in r] for r in kept_routes], True)
+    return initial
+
+
+def warm_start_from_store(store, routing, manager, data, search_parameters, max_distance=0):
+    """
+    Initial assignment adapted from the closest solution in `store` (a SolutionStore)
+    for this office set: shared offices keep their vehicle and order, the rest are
+    inserted. None when there is no usable prior solution (model left open).
+    """
+    keys = data['location_keys']
+    node_of = {k: node for node, k in enumerate(keys) if k is not None}
+    try:
+        prior = store.closest(node_of.keys())
+    except OSError as e:
+        print(f"Solution store unavailable: {e}")
+        return None
+    if prior is None:
+        return None
+    routes, new_nodes = seed_routes(prior['routes'], node_of, data['num_vehicles'])
+    print(f"Warm start: {num_nodes_in(routes)} offices from a prior solution (overlap {prior['overlap']:.0%}), "
+          f"inserting {len(new_nodes)}")
+    initial = warm_start_assignment(routing, manager, data, routes, new_nodes, search_parameters, max_distance=max_distance)
+    if initial is None:
+        print("Prior solution not feasible for this model. Using the default first solution.")
+    return initial
+
+
+def remember_solution(store, solution, routing, manager, data):
+    """Saves the solution's routes (as office keys) in `store` for later warm starts."""
+    keys = data['location_keys']
+    routes = [[keys[n] for n in r] for r in solution_routes(solution, routing, manager, data['num_vehicles'])]
+    try:
+        store.save([k for k in keys if k is not None], routes, solution.ObjectiveValue())
+    except OSError as e:
+        print(f"Could not save solution: {e}")
+
+
+def solve_vrp_incremental(df_loc, num_cars, num_walkers, vehicle_capacity, previous, start_node_index=0,
+                          max_seconds=30, repair_seconds=INCREMENTAL_SECONDS, status_callback=None,
+                          solution_store=None, adaptive_time=False, **model_kwargs):
+    """
+    Re-plans a group after tickets were added or cancelled, starting from `previous`
+    (the RouteResult of the last solve of the same group).
+
+    1. Offices still present keep their vehicle and order; cancelled ones are skipped.
+    2. New offices are put in by cheapest insertion.
+    3. A short local search (repair_seconds) repairs the result, so walker
+       assignments stay mostly the same as in the morning plan.
+
+    Falls back to a full solve_vrp_data (max_seconds, or its adaptive budget with
+    adaptive_time) when the previous routes cannot be reused.
+    Takes the same arguments as solve_vrp_data (plus `previous`) and returns the same tuple.
+    """
+    routing, manager, data, df_loc, search_parameters = build_vrp_model(
+        df_loc, num_cars, num_walkers, vehicle_capacity, start_node_index=start_node_index,
+        status_callback=status_callback, **model_kwargs)
+    num_vehicles = data['num_vehicles']
+    depots = set(data['depot_nodes'])
+
+    # Previous stops -> nodes of the new model
+    node_of = {key: node for node, key in enumerate(office_key_of(df_loc)) if node not in depots}
+    previous_keys = office_key_of(previous.stops)
+    prior_routes = [[] for _ in range(num_vehicles)]
+    for r in range(previous.num_routes):
+        v = int(previous.vehicle_ids[r])
+        if v < num_vehicles:  # Fewer walkers today: its offices are re-inserted
+            prior_routes[v] = [previous_keys[n] for n in previous.route_nodes(r)[1:-1]]
+    routes, new_nodes = seed_routes(prior_routes, node_of, num_vehicles)
+    kept = num_nodes_in(routes)
+    if status_callback: status_callback(f"Re-optimizando: {kept} oficinas conservadas, {len(new_nodes)} nuevas")
+    print(f"Incremental re-plan: kept {kept} offices, inserting {len(new_nodes)}")
+
+    search_parameters.time_limit.seconds = max(1, int(repair_seconds))
+    trace = ObjectiveTrace(routing)
+    initial = warm_start_assignment(routing, manager, data, routes, new_nodes, search_parameters,
+                                    max_distance=int(model_kwargs.get('max_distance_km', 0) * 1000))
+    if initial is None:
+        print("Previous routes not feasible for the new model. Solving from scratch.")
+        return solve_vrp_data(df_loc, num_cars, num_walkers, vehicle_capacity, start_node_index=start_node_index,
+                              max_seconds=max_seconds, status_callback=status_callback,
+                              solution_store=solution_store, adaptive_time=adaptive_time, **model_kwargs)
+    # Keep the repaired routes if the search ran out of time without improving
+    solution = routing.SolveFromAssignmentWithParameters(initial, search_parameters) or initial
+    data['objective_trace'] = trace.points
+    record_profile(data, solution, routing, trace.points, trace.solutions, time.monotonic() - trace.started,
+                   solver='incremental', budget_seconds=search_parameters.time_limit.seconds,
+                   kept=kept, inserted=len(new_nodes))
+    if solution_store is not None:
+        remember_solution(solution_store, solution, routing, manager, data)
+    return solution, routing, manager, data, df_loc
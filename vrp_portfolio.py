@@ -0,0 +1,237 @@
+import os
+import sys
+import time
+import types
+import queue
+import shutil
+import tempfile
+import multiprocessing
+from contextlib import contextmanager
+import numpy as np
+from ortools.constraint_solver import routing_enums_pb2
+
+from vrp_solver import solve_vrp_data, build_vrp_model, adaptive_time_budget, record_profile
+from vrp_incremental import close_model_for_restore, remember_solution
+
+# --- CONFIGURATION ---
+# (first solution strategy, metaheuristic) raced by the portfolio, in priority order:
+# with N workers the first N are used, so the top of the list covers every family
+PORTFOLIO_CONFIGS = [
+    ('PATH_CHEAPEST_ARC', 'GUIDED_LOCAL_SEARCH'),
+    ('SAVINGS', 'TABU_SEARCH'),
+    ('PARALLEL_CHEAPEST_INSERTION', 'SIMULATED_ANNEALING'),
+    ('CHRISTOFIDES', 'GUIDED_LOCAL_SEARCH'),
+    ('PATH_CHEAPEST_ARC', 'TABU_SEARCH'),
+    ('SAVINGS', 'GUIDED_LOCAL_SEARCH'),
+    ('PARALLEL_CHEAPEST_INSERTION', 'GUIDED_LOCAL_SEARCH'),
+    ('PATH_CHEAPEST_ARC', 'SIMULATED_ANNEALING'),
+]
+DEFAULT_PORTFOLIO_WORKERS = max(1, min(len(PORTFOLIO_CONFIGS), os.cpu_count() or 1))
+# Stop every worker once the best objective has not improved by PORTFOLIO_MIN_GAIN
+# for this fraction of max_seconds (never less than PORTFOLIO_MIN_PLATEAU_SECONDS)
+PORTFOLIO_PLATEAU_FRACTION = 0.25
+PORTFOLIO_MIN_PLATEAU_SECONDS = 3
+PORTFOLIO_MIN_GAIN = 0.001
+# Extra wall-clock time over max_seconds for the workers to import and build their models
+PORTFOLIO_STARTUP_SECONDS = 15
+
+# Objective sentinel for "no solution yet" (fits the shared 'q' value)
+NO_OBJECTIVE = 2 ** 62
+
+
+def spawn_context():
+    """
+    "spawn" multiprocessing context for solver workers (safe with the threads Streamlit
+    runs, and the only option on Windows). Start the workers inside worker_main().
+    """
+    return multiprocessing.get_context("spawn")
+
+
+@contextmanager
+def worker_main():
+    """
+    Non-app entry point for worker processes started in this block.
+    Spawned children re-import the parent's __main__ from its file. Under Streamlit
+    that is app.py (replaced on every rerun), so every worker would run the whole page.
+    While the block runs, __main__ is a bare module with no file or spec, so children
+    import only the modules of the functions they run. The previous __main__ is put
+    back unless someone else replaced it in the meantime.
+    """
+    main = sys.modules.get('__main__')
+    stand_in = types.ModuleType('__main__')
+    sys.modules['__main__'] = stand_in
+    try:
+        yield
+    finally:
+        if sys.modules.get('__main__') is stand_in and main is not None:
+            sys.modules['__main__'] = main
+
+
+def _current_routes(routing, manager, num_vehicles):
+    """Visited nodes (depots excluded) per vehicle, read from the search's current solution."""
+    routes = []
+    for v in range(num_vehicles):
+        route = []
+        index = routing.NextVar(routing.Start(v)).Value()
+        while not routing.IsEnd(index):
+            route.append(manager.IndexToNode(index))
+            index = routing.NextVar(index).Value()
+        routes.append(route)
+    return routes
+
+
+def _portfolio_worker(worker_id, config, df_loc, matrix_path, num_cars, num_walkers, vehicle_capacity,
+                      start_node_index, max_seconds, model_kwargs, best_objective, cancel, results):
+    """
+    Portfolio process: builds its own model over the shared memory-mapped distance
+    matrix and searches with one configuration. Every solution that beats the best
+    objective of all workers is sent to `results` as (worker_id, objective, routes);
+    (worker_id, None, None) marks the end of its search.
+    """
+    try:
+        matrix = np.load(matrix_path, mmap_mode='r')
+        routing, manager, data, _, search_parameters = build_vrp_model(
+            df_loc, num_cars, num_walkers, vehicle_capacity, start_node_index=start_node_index,
+            distance_matrix=matrix, **model_kwargs)
+        first_solution, metaheuristic = config
+        search_parameters.first_solution_strategy = getattr(routing_enums_pb2.FirstSolutionStrategy, first_solution)
+        search_parameters.local_search_metaheuristic = getattr(routing_enums_pb2.LocalSearchMetaheuristic, metaheuristic)
+        search_parameters.time_limit.seconds = max_seconds
+
+        def on_solution():
+            if cancel.is_set():
+                routing.solver().FinishCurrentSearch()
+                return
+            objective = routing.CostVar().Value()
+            with best_objective.get_lock():
+                if objective >= best_objective.value:
+                    return
+                best_objective.value = objective
+            results.put((worker_id, objective, _current_routes(routing, manager, data['num_vehicles'])))
+
+        routing.AddAtSolutionCallback(on_solution)
+        routing.SolveWithParameters(search_parameters)
+    except Exception as e:
+        print(f"Portfolio worker {worker_id} {config} failed: {e}")
+    finally:
+        results.put((worker_id, None, None))
+
+
+def solve_vrp_portfolio(df_loc, num_cars, num_walkers, vehicle_capacity, start_node_index=0, max_seconds=30,
+                        status_callback=None, solution_store=None, workers=None, configs=PORTFOLIO_CONFIGS,
+                        plateau_seconds=None, adaptive_time=False, **model_kwargs):
+    """
+    Races several search configurations (first solution strategy x metaheuristic) in
+    parallel processes on the same model and keeps the best objective.
+
+    The distance matrix is built once here and shared with the workers as a
+    memory-mapped .npy file; each worker builds its own routing model on it (OR-Tools
+    holds the GIL while solving, so threads would not run in parallel). The race ends
+    when every worker finished (max_seconds each), when the best objective plateaus
+    (plateau_seconds without a PORTFOLIO_MIN_GAIN improvement), or at the wall-clock cap
+    of max_seconds + PORTFOLIO_STARTUP_SECONDS. The winning routes are then read back
+    into this process's model.
+
+    With a single worker this is a plain solve_vrp_data. Takes the same arguments as
+    solve_vrp_data (plus workers/configs/plateau_seconds) and returns the same tuple.
+    adaptive_time sizes max_seconds with adaptive_time_budget(); the plateau stop is always on.
+    """
+    configs = list(configs)[:workers or DEFAULT_PORTFOLIO_WORKERS]
+    if len(configs) <= 1:
+        return solve_vrp_data(df_loc, num_cars, num_walkers, vehicle_capacity, start_node_index=start_node_index,
+                              max_seconds=max_seconds, status_callback=status_callback,
+                              solution_store=solution_store, adaptive_time=adaptive_time, **model_kwargs)
+    if adaptive_time:
+        max_seconds = adaptive_time_budget(len(df_loc), max_seconds)
+
+    routing, manager, data, df_loc, search_parameters = build_vrp_model(
+        df_loc, num_cars, num_walkers, vehicle_capacity, start_node_index=start_node_index,
+        status_callback=status_callback, **model_kwargs)
+    search_parameters.time_limit.seconds = max_seconds
+    if plateau_seconds is None:
+        plateau_seconds = max(PORTFOLIO_MIN_PLATEAU_SECONDS, max_seconds * PORTFOLIO_PLATEAU_FRACTION)
+    # The cache only served the parent's matrix; workers read the saved copy
+    worker_kwargs = {k: v for k, v in model_kwargs.items() if k != 'distance_cache'}
+
+    tmp_dir = tempfile.mkdtemp(prefix="vrp_portfolio_")
+    ctx = spawn_context()
+    best_objective = ctx.Value('q', NO_OBJECTIVE)
+    cancel = ctx.Event()
+    results = ctx.Queue()
+    processes = []
+    best = None  # (objective, worker_id, routes)
+    trace = []  # (seconds, objective) of every new best, as solve_vrp_data's data['objective_trace']
+    try:
+        matrix_path = os.path.join(tmp_dir, "distance_matrix.npy")
+        np.save(matrix_path, data['distance_matrix'])
+
+        if status_callback: status_callback(f"Portafolio: {len(configs)} búsquedas en paralelo...")
+        print(f"Portfolio: racing {len(configs)} configurations for {max_seconds}s "
+              f"(plateau {plateau_seconds:.0f}s)")
+        with worker_main():
+            for worker_id, config in enumerate(configs):
+                p = ctx.Process(target=_portfolio_worker, daemon=True,
+                                args=(worker_id, config, df_loc, matrix_path, num_cars, num_walkers, vehicle_capacity,
+                                      start_node_index, max_seconds, worker_kwargs, best_objective, cancel, results))
+                p.start()
+                processes.append(p)
+
+        started = time.monotonic()
+        deadline = started + max_seconds + PORTFOLIO_STARTUP_SECONDS
+        last_gain = started
+        running = len(processes)
+        stopped_early = False
+        while running and time.monotonic() < deadline:
+            if best is not None and time.monotonic() - last_gain >= plateau_seconds:
+                print(f"Portfolio: no improvement for {plateau_seconds:.0f}s, stopping.")
+                stopped_early = True
+                break
+            try:
+                worker_id, objective, routes = results.get(timeout=0.2)
+            except queue.Empty:
+                if not any(p.is_alive() for p in processes):
+                    break  # Crashed without reporting
+                continue
+            if objective is None:
+                running -= 1
+                continue
+            if best is not None and objective >= best[0]:
+                continue
+            if best is None or objective < best[0] * (1 - PORTFOLIO_MIN_GAIN):
+                last_gain = time.monotonic()
+                if status_callback:
+                    status_callback(f"Portafolio: mejor costo {objective} ({' + '.join(configs[worker_id])})")
+            best = (objective, worker_id, routes)
+            trace.append((round(time.monotonic() - started, 3), objective))
+    finally:
+        cancel.set()
+        for p in processes:
+            p.join(timeout=1)
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+                p.join()
+        results.close()
+        results.cancel_join_thread()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    data['objective_trace'] = trace
+    search_seconds = time.monotonic() - started
+    if best is None:
+        print("Portfolio: no worker found a solution.")
+        record_profile(data, None, routing, trace, len(trace), search_seconds, solver='portafolio',
+                       budget_seconds=max_seconds, workers=len(configs), stopped_early=stopped_early)
+        return None, routing, manager, data, df_loc
+
+    objective, worker_id, routes = best
+    print(f"Portfolio: best objective {objective} from {' + '.join(configs[worker_id])} "
+          f"after {search_seconds:.1f}s")
+    close_model_for_restore(routing, search_parameters)
+    solution = routing.ReadAssignmentFromRoutes([[manager.NodeToIndex(n) for n in r] for r in routes], True)
+    # 'solutions' counts new bests reported by the workers, not every solution they visited
+    record_profile(data, solution, routing, trace, len(trace), search_seconds, solver='portafolio',
+                   budget_seconds=max_seconds, workers=len(configs), stopped_early=stopped_early,
+                   winner=' + '.join(configs[worker_id]))
+    if solution and solution_store is not None:
+        remember_solution(solution_store, solution, routing, manager, data)
+    return solution, routing, manager, data, df_loc
@@ -0,0 +1,126 @@
+import os
+import numpy as np
+import pandas as pd
+
+# --- CONFIGURATION ---
+# Walker bases (home or assigned base) read from the personnel list, the same workbook
+# extract_users.py reads: one row per walker. Columns are found by name, as there:
+#   CORREO                          e-mail (login of the app, kept on the walker's route)
+#   ENCUESTADOR / NOMBRE            name
+#   CIUDAD / SEDE / BASE / DEPARTAMENTO   department (or its capital city)
+#   DISTRITO                        home district, located at the middle of its offices
+#   LATITUD / LONGITUD              exact home or base coordinates (optional)
+BASE_COLUMNS = ['Encuestador', 'Correo', 'Departamento', 'Distrito', 'Latitud (y)', 'Longitud (x)']
+# Capital cities used as "city" in the personnel list -> department of the tickets
+CITY_DEPARTMENTS = {
+    'TRUJILLO': 'LA LIBERTAD',
+    'CHICLAYO': 'LAMBAYEQUE',
+    'HUANCAYO': 'JUNIN',
+    'HUARAZ': 'ANCASH',
+    'IQUITOS': 'LORETO',
+    'TARAPOTO': 'SAN MARTIN',
+    'CALLAO': 'CALLAO',
+}
+# Depot rows of the walkers are named "<BASE_PREFIX> <name>"
+BASE_PREFIX = "BASE"
+
+
+def _find_column(columns, *words):
+    """First column containing a word, trying the words in priority order."""
+    return next((c for w in words for c in columns if w in c), None)
+
+
+def _text(value):
+    return "" if pd.isna(value) else str(value).strip()
+
+
+def normalize_bases(df):
+    """
+    Personnel table -> BASE_COLUMNS (one row per walker with a name or e-mail).
+    Missing coordinates stay NaN; locate_bases fills them from the district.
+    Raises ValueError (message for the user) when there is no department column.
+    """
+    df = df.copy()
+    df.columns = [str(c).strip().upper() for c in df.columns]
+    col_correo = _find_column(df.columns, 'CORREO', 'EMAIL')
+    col_nombre = _find_column(df.columns, 'ENCUESTADOR', 'NOMBRE', 'CAMINANTE')
+    col_ciudad = _find_column(df.columns, 'DEPARTAMENTO', 'CIUDAD', 'SEDE', 'BASE')
+    col_distrito = _find_column(df.columns, 'DISTRITO')
+    col_lat = _find_column(df.columns, 'LATITUD', 'LAT')
+    col_lon = _find_column(df.columns, 'LONGITUD', 'LONG', 'LON')
+    if col_ciudad is None or (col_correo is None and col_nombre is None):
+        raise ValueError("La lista de personal necesita columnas de departamento (CIUDAD / SEDE / DEPARTAMENTO) "
+                         "y de nombre o correo.")
+
+    bases = pd.DataFrame({
+        'Correo': df[col_correo].map(_text) if col_correo else "",
+        'Encuestador': df[col_nombre].map(_text) if col_nombre else "",
+        'Departamento': df[col_ciudad].map(_text).str.upper(),
+        'Distrito': df[col_distrito].map(_text).str.upper() if col_distrito else "",
+        'Latitud (y)': pd.to_numeric(df[col_lat], errors='coerce') if col_lat else np.nan,
+        'Longitud (x)': pd.to_numeric(df[col_lon], errors='coerce') if col_lon else np.nan,
+    })
+    bases = bases[(bases['Correo'] != "") | (bases['Encuestador'] != "")]
+    bases = bases[~bases['Departamento'].isin(["", "NAN"])]
+    # Fallback name as in extract_users.py: the e-mail user
+    no_name = bases['Encuestador'] == ""
+    bases.loc[no_name, 'Encuestador'] = bases.loc[no_name, 'Correo'].str.split('@').str[0].str.capitalize()
+    bases['Departamento'] = bases['Departamento'].replace(CITY_DEPARTMENTS)
+    return bases[BASE_COLUMNS].reset_index(drop=True)
+
+
+def read_personnel_bases(source, name=None):
+    """
+    Walker bases from the personnel list (.xlsx / .xls / .csv). source: path or
+    file-like object; name: file name when source is file-like. The header may be on
+    the first or the second row (the personnel workbook has a title row).
+    """
+    name = name or str(source)
+    is_csv = os.path.splitext(name)[1].lower() == ".csv"
+    df = pd.read_csv(source) if is_csv else pd.read_excel(source)
+    try:
+        return normalize_bases(df)
+    except ValueError:
+        if is_csv:
+            raise
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    return normalize_bases(pd.read_excel(source, header=1))
+
+
+def district_centers(master_df):
+    """{(DEPARTAMENTO, DISTRITO): (lat, lon)} median point of the master DB offices of each district."""
+    if not {'departamento', 'distrito'} <= set(master_df.columns):
+        return {}
+    offices = pd.DataFrame({
+        'dep': master_df['departamento'].astype(str).str.strip().str.upper(),
+        'dist': master_df['distrito'].astype(str).str.strip().str.upper(),
+        'lat': pd.to_numeric(master_df['Latitud (y)'], errors='coerce'),
+        'lon': pd.to_numeric(master_df['Longitud (x)'], errors='coerce'),
+    }).dropna(subset=['lat', 'lon'])
+    centers = offices.groupby(['dep', 'dist'])[['lat', 'lon']].median()
+    return {key: (row.lat, row.lon) for key, row in centers.iterrows()}
+
+
+def locate_bases(bases, master_df):
+    """
+    Fills missing coordinates with the walker's district center (district_centers of the
+    master DB frame, MasterStore.df). Walkers still without one keep NaN.
+    """
+    bases = bases.copy()
+    centers = district_centers(master_df)
+    missing = bases['Latitud (y)'].isna() | bases['Longitud (x)'].isna()
+    for i in bases.index[missing]:
+        center = centers.get((bases.at[i, 'Departamento'], bases.at[i, 'Distrito']))
+        if center is not None:
+            bases.at[i, 'Latitud (y)'], bases.at[i, 'Longitud (x)'] = center
+    return bases
+
+
+def city_bases(bases, city):
+    """Located walkers of a department, or None."""
+    if bases is None:
+        return None
+    rows = bases[(bases['Departamento'] == str(city).strip().upper()) & bases['Latitud (y)'].notna()
+                 & bases['Longitud (x)'].notna()]
+    return rows.reset_index(drop=True) if not rows.empty else None